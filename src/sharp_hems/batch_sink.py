@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+計測値をまとめて、バックグラウンドで送る送信先の共通部分。
+
+emit() は計測値を上限付きのキューに積むだけで、送信は専用のスレッドが行う。
+スレッドは件数 (batch_size) か時間 (flush_sec) で区切った計測値を _write_batch() で送る。
+送信に失敗したら間隔を倍にしながら retry_max 回まで再送し、それでも失敗したら破棄する。
+想定外の例外も、ログに出して破棄するだけで送信スレッドは止めない。
+スプール (spool.Spool) を指定した場合は、破棄する代わりにディスクに溜めておき、
+復旧後に replay_rate 件/秒までの速さで古い順に送り直す。
+送信先が遅い・繋がらない場合でも、パケットを受信するスレッドは止まらない。
+liveness を指定した場合は、送信先に届け終えた時点で更新するので、送信先が止まれば healthz も失敗する。
+
+送信先毎のクラス (FluentdSink / InfluxDBSink / MetricsSink) は、_write_batch() と
+_close_connection() を実装する。ロガーは送信先毎にキューと送信スレッドを持つので、
+1 つの送信先が遅い・止まっていても、他の送信先には影響しない。
+"""
+
+import contextlib
+import logging
+import queue
+import threading
+import time
+import typing
+
+import sharp_hems.spool
+
+BATCH_SIZE_DEFAULT = 100
+FLUSH_SEC_DEFAULT = 1.0
+QUEUE_SIZE_DEFAULT = 10000
+RETRY_MAX_DEFAULT = 5
+# 再送の間隔 (秒)。失敗する毎に倍にし、RETRY_SEC_MAX で頭打ちにする
+RETRY_SEC_DEFAULT = 0.5
+RETRY_SEC_MAX = 30
+TIMEOUT_SEC_DEFAULT = 5.0
+# close() でキューに残った計測値を送り切るのを待つ時間 (秒)
+DRAIN_SEC_DEFAULT = 10.0
+
+# NOTE: close() で、キューを待っている送信スレッドを起こすための印
+_WAKE = object()
+
+
+class SinkStats(typing.NamedTuple):
+    """送信先 1 つ分の、前回の集計からの送信数・失敗数・破棄数と、キューの深さ・遅延。"""
+
+    name: str
+    sent: int
+    failed: int
+    dropped: int
+    backlog: int
+    # NOTE: 受信時刻から送信し終えるまでの秒数 (スプールから送り直した分は含めない)
+    latency_avg: float
+    latency_max: float
+
+
+class RejectedError(Exception):
+    """送信先が計測値そのものを受け付けなかった (再送しても同じ結果になる) ことを表す。"""
+
+
+class BatchSink:
+    """計測値をまとめて、バックグラウンドで送る。"""
+
+    # NOTE: ログ・エラーメッセージに使う送信先の名前
+    NAME = "sink"
+    # NOTE: 再送する (送信先の復旧を待つ) 例外
+    RETRY_ERRORS = (OSError, ValueError)
+
+    def __init__(  # noqa: PLR0913
+        self,
+        *,
+        batch_size=BATCH_SIZE_DEFAULT,
+        flush_sec=FLUSH_SEC_DEFAULT,
+        queue_size=QUEUE_SIZE_DEFAULT,
+        retry_max=RETRY_MAX_DEFAULT,
+        retry_sec=RETRY_SEC_DEFAULT,
+        timeout_sec=TIMEOUT_SEC_DEFAULT,
+        spool=None,
+        replay_rate=sharp_hems.spool.REPLAY_RATE_DEFAULT,
+        liveness=None,
+    ):
+        """まとめ方・再送・スプール・liveness の設定を初期化し、送信スレッドを開始します。"""
+        self.batch_size = batch_size
+        self.flush_sec = flush_sec
+        self.retry_max = retry_max
+        self.retry_sec = retry_sec
+        self.timeout_sec = timeout_sec
+        # NOTE: 送れなかった計測値を溜めておく sharp_hems.spool.Spool (無ければ破棄する)
+        self.spool = spool
+        self.replay_rate = replay_rate
+        # NOTE: 送り終えたら touch() する liveness.LivenessWriter (無ければ None)
+        self.liveness = liveness
+
+        self.last_error = None
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.spooled = 0
+
+        self._replay_next = 0.0
+        self._replay_backoff = 0
+
+        # NOTE: (件数, 合計, 最大) を送信スレッドが足し込み、take_stats() で取り出す
+        self._latency = (0, 0.0, 0.0)
+        self._reported = (0, 0, 0)
+        self._stats_lock = threading.Lock()
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"{self.NAME.lower()}-sink", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def spool_from_config(sink_config):
+        """送信先の設定の spool セクションから (Spool, 送り直す速さ) を作る。無ければ (None, 既定値)。"""
+        spool_config = sink_config.get("spool")
+        if spool_config is None:
+            return None, sharp_hems.spool.REPLAY_RATE_DEFAULT
+
+        spool = sharp_hems.spool.Spool(
+            spool_config["path"],
+            max_records=spool_config.get("max_records", sharp_hems.spool.MAX_RECORDS_DEFAULT),
+        )
+        return spool, spool_config.get("replay_rate", sharp_hems.spool.REPLAY_RATE_DEFAULT)
+
+    @property
+    def target(self):
+        """エラーメッセージに使う送信先のアドレス。"""
+        raise NotImplementedError
+
+    @property
+    def depth(self):
+        """キューに溜まっている計測値の数。"""
+        return self._queue.qsize()
+
+    def emit(self, label, record, timestamp=None):
+        """
+        計測値をキューに積む。キューが一杯・停止済みなら False を返す。
+
+        my_lib.fluentd_util.send() から、fluent-logger の FluentSender と同じように呼べる。
+        """
+        if self._stop.is_set():
+            self.last_error = f"{self.NAME} sink is closed"
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+
+        try:
+            self._queue.put_nowait((label, timestamp, record))
+        except queue.Full:
+            self.dropped += 1
+            self.last_error = f"{self.NAME} send queue is full ({self._queue.maxsize} records)"
+            return False
+
+        return True
+
+    def emit_with_time(self, label, timestamp, record):
+        """受信時刻を指定して emit() する。fluent-logger の FluentSender と同じ引数の順。"""
+        return self.emit(label, record, timestamp)
+
+    def take_stats(self):
+        """前回呼び出し時からの SinkStats を返す。"""
+        with self._stats_lock:
+            latency_count, latency_sum, latency_max = self._latency
+            self._latency = (0, 0.0, 0.0)
+
+        current = (self.sent, self.failed, self.dropped)
+        sent, failed, dropped = (
+            value - reported for value, reported in zip(current, self._reported, strict=True)
+        )
+        self._reported = current
+
+        return SinkStats(
+            self.NAME,
+            sent,
+            failed,
+            dropped,
+            self.depth,
+            latency_sum / latency_count if latency_count != 0 else 0.0,
+            latency_max,
+        )
+
+    def close(self, timeout=DRAIN_SEC_DEFAULT):
+        """送信スレッドを止める。キューに残った計測値は、timeout 秒まで待って送り切る。"""
+        self._stop.set()
+        # NOTE: キューが一杯なら送信スレッドは待っていない
+        with contextlib.suppress(queue.Full):
+            self._queue.put_nowait(_WAKE)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.warning("Gave up draining %s send queue (%d record(s) left)", self.NAME, self.depth)
+
+        logging.info(
+            "%s sink: sent %d, spooled %d, failed %d, dropped %d record(s)",
+            self.NAME,
+            self.sent,
+            self.spooled,
+            self.failed,
+            self.dropped,
+        )
+
+    # ---------- 送信先毎に実装する ----------
+
+    def _write_batch(self, batch):
+        """[(ラベル, 受信時刻, 計測値)] を送る。失敗したら OSError / ValueError / RejectedError を投げる。"""
+        raise NotImplementedError
+
+    def _close_connection(self):
+        """送信先との接続を閉じる。次の _write_batch() で繋ぎ直す。"""
+        raise NotImplementedError
+
+    # ---------- 送信スレッド ----------
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._collect()
+                if batch:
+                    self._send_batch(batch)
+                elif self._stop.is_set():
+                    break
+                self._maybe_replay()
+        finally:
+            self._close_connection()
+            if self.spool is not None:
+                if self.spool.depth != 0:
+                    logging.info("Keep %d record(s) in spool for next start", self.spool.depth)
+                self.spool.close()
+
+    def _collect(self):
+        """キューから最大 batch_size 件、最初の 1 件から flush_sec 経つまで取り出す。"""
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            # NOTE: 停止要求後は待たずに、残っている分をまとめて取り出す
+            stopping = self._stop.is_set()
+            timeout = self.flush_sec if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(block=not stopping, timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _WAKE:
+                continue
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_sec
+
+        return batch
+
+    def _send_batch(self, batch):
+        if (self.spool is not None) and (self.spool.depth != 0):
+            # NOTE: 順序を保つため、スプールを送り切るまでは新しい計測値もスプールの末尾に積む
+            self._push_spool(batch)
+            return False
+
+        rejected = False
+        for attempt in range(self.retry_max + 1):
+            try:
+                self._write_all(batch)
+            except RejectedError:
+                rejected = True
+                break
+            except self.RETRY_ERRORS:
+                if attempt == self.retry_max:
+                    break
+                logging.warning("%s, retry (%d/%d)", self.last_error, attempt + 1, self.retry_max)
+                # NOTE: 停止要求後は、待たずに再送する
+                self._stop.wait(min(self.retry_sec * (2**attempt), RETRY_SEC_MAX))
+            except Exception:
+                # NOTE: 送信先毎の処理の不具合は再送しても直らないので、破棄して次の計測値を送る
+                logging.exception("%s, discard %d record(s)", self.last_error, len(batch))
+                self.failed += len(batch)
+                return False
+            else:
+                self.sent += len(batch)
+                self.last_error = None
+                self._add_latency(batch)
+                self._touch_liveness()
+                return True
+
+        # NOTE: 送信先が受け付けない計測値は、スプールしても送れないので破棄する
+        if (self.spool is not None) and not rejected:
+            self._push_spool(batch)
+        else:
+            logging.error("%s, discard %d record(s)", self.last_error, len(batch))
+            self.failed += len(batch)
+        return False
+
+    def _write_all(self, batch):
+        try:
+            self._write_batch(batch)
+        except Exception as e:
+            self._close_connection()
+            self.last_error = f"Failed to send to {self.NAME} ({self.target}): {e}"
+            raise
+
+    def _add_latency(self, batch):
+        now = time.time()
+        latency_list = [now - timestamp for _, timestamp, _ in batch]
+        with self._stats_lock:
+            latency_count, latency_sum, latency_max = self._latency
+            self._latency = (
+                latency_count + len(latency_list),
+                latency_sum + sum(latency_list),
+                max(latency_max, *latency_list),
+            )
+
+    def _touch_liveness(self):
+        if self.liveness is not None:
+            self.liveness.touch()
+
+    # ---------- スプール ----------
+
+    def _push_spool(self, batch):
+        try:
+            self.spool.push(batch)
+        except Exception:
+            logging.exception("Failed to write spool, discard %d record(s)", len(batch))
+            self.failed += len(batch)
+            return
+
+        self.spooled += len(batch)
+        logging.info("Spool %d record(s) (depth: %d)", len(batch), self.spool.depth)
+
+    def _maybe_replay(self, now=None):
+        """スプールに溜まった計測値を、1 秒毎に replay_rate 件まで古い順に送り直す。"""
+        if (self.spool is None) or (self.spool.depth == 0) or self._stop.is_set():
+            return
+        if now is None:
+            now = time.monotonic()
+        if now < self._replay_next:
+            return
+
+        row_list = self.spool.peek(self.replay_rate)
+        rejected = False
+        try:
+            self._write_all([(label, timestamp, record) for _, label, timestamp, record in row_list])
+        except RejectedError:
+            rejected = True
+        except self.RETRY_ERRORS:
+            # NOTE: 復旧を待つ間は、確認の間隔を倍にしていく
+            self._replay_backoff = min(max(self._replay_backoff * 2, self.retry_sec), RETRY_SEC_MAX)
+            self._replay_next = now + self._replay_backoff
+            return
+        except Exception:
+            logging.exception("%s, discard %d spooled record(s)", self.last_error, len(row_list))
+            self.spool.remove(row_list[-1][0])
+            self.failed += len(row_list)
+            return
+
+        self.spool.remove(row_list[-1][0])
+        if rejected:
+            # NOTE: 送り直しても受け付けられないものは捨てて、後ろを詰まらせない
+            logging.error("%s, discard %d spooled record(s)", self.last_error, len(row_list))
+            self.failed += len(row_list)
+            return
+        self.sent += len(row_list)
+        self.last_error = None
+        self._touch_liveness()
+        self._replay_backoff = 0
+        self._replay_next = now + 1
+        logging.info("Replay %d record(s) from spool (depth: %d)", len(row_list), self.spool.depth)
@@ -7,6 +7,7 @@ JSON Schema (config.schema / device.schema) の代替として、Pydantic モデ
 """
 
 import logging
+from typing import Literal
 
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -24,11 +25,34 @@ class FluentdDataConfig(_Model):
     tag: str
     label: str
     field: str
+    energy_field: str = "energy"
+
+
+class SpoolConfig(_Model):
+    path: str
+    max_records: int = Field(default=500000, gt=0)
+    replay_rate: int = Field(default=100, gt=0)
 
 
 class FluentdConfig(_Model):
     host: str
     data: FluentdDataConfig
+    port: int = Field(default=24224, gt=0)
+    batch_size: int = Field(default=100, gt=0)
+    flush_sec: float = Field(default=1.0, gt=0)
+    queue_size: int = Field(default=10000, gt=0)
+    retry_max: int = Field(default=5, ge=0)
+    require_ack: bool = False
+    spool: SpoolConfig | None = None
+
+
+class InfluxDBWriteConfig(_Model):
+    tag_keys: list[str] = Field(default_factory=lambda: ["hostname"])
+    batch_size: int = Field(default=1000, gt=0)
+    flush_sec: float = Field(default=1.0, gt=0)
+    queue_size: int = Field(default=10000, gt=0)
+    retry_max: int = Field(default=5, ge=0)
+    spool: SpoolConfig | None = None
 
 
 class InfluxDBConfig(_Model):
@@ -36,6 +60,8 @@ class InfluxDBConfig(_Model):
     token: str
     org: str
     bucket: str
+    # NOTE: 指定すると、ロガーは Fluentd を経由せずに直接書き込む
+    write: InfluxDBWriteConfig | None = None
 
 
 class DeviceFileConfig(_Model):
@@ -66,12 +92,20 @@ class CalibrationConfig(_Model):
     smartmeter: SmartMeterConfig
 
 
+class ReplayConfig(_Model):
+    port: int
+    count: int = Field(default=1000, gt=0)
+    age_sec: int = Field(default=3600, gt=0)
+    state: str | None = None
+
+
 class LivenessFileConfig(_Model):
     measure: str
 
 
 class LivenessConfig(_Model):
     file: LivenessFileConfig
+    flush_sec: int = Field(default=10, gt=0)
 
 
 class AppConfig(_Model):
@@ -85,6 +119,9 @@ class AppConfig(_Model):
     sensor: SensorConfig | None = None
     alert: AlertConfig | None = None
     calibration: CalibrationConfig | None = None
+    replay: ReplayConfig | None = None
+    # NOTE: 省略時は fluentd (influxdb.write があれば influxdb) と metrics
+    sink: list[Literal["fluentd", "influxdb", "metrics"]] | None = None
 
 
 class DeviceEntry(_Model):
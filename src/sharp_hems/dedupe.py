@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+計測パケット (0x2C) の重複除去の状態を保持します。
+
+JH-AG01 は同じ計測パケットを 2 回送ることがあり、順序が入れ替わって届くこともあるため、
+dev_id 毎に直近 window 件の (カウンタ, 現在時刻) を覚えておき、一致したものを重複とする。
+状態は一定間隔でファイルに書き出し、ロガーの再起動をまたいでも重複をはじけるようにする。
+"""
+
+import collections
+import json
+import logging
+import pathlib
+import time
+
+# dev_id 毎に覚えておく (カウンタ, 現在時刻) の数
+WINDOW_DEFAULT = 8
+# 状態をファイルに書き出す間隔 (秒)
+SNAPSHOT_SEC_DEFAULT = 60
+
+
+def make_key(counter, cur_time):
+    return (counter << 16) | cur_time
+
+
+def state_path(dev_cache_file):
+    """dev_id キャッシュに対応する、重複除去の状態の書き出し先のパスを返す。"""
+    dev_cache_file = pathlib.Path(dev_cache_file)
+    return dev_cache_file.with_name(dev_cache_file.name + ".dedupe")
+
+
+class DedupeState:
+    """dev_id 毎の直近の (カウンタ, 現在時刻) を保持し、定期的にファイルへ書き出す。"""
+
+    def __init__(self, state_file=None, window=WINDOW_DEFAULT, snapshot_sec=SNAPSHOT_SEC_DEFAULT):
+        """書き出し先 (None なら書き出さない)・窓の大きさ・書き出し間隔を初期化します。"""
+        self.state_file = pathlib.Path(state_file) if state_file is not None else None
+        self.window = window
+        self.snapshot_sec = snapshot_sec
+        self.window_map = {}
+        self.last_snapshot = time.monotonic()
+        self._dirty = False
+
+        if self.state_file is not None:
+            self.load()
+
+    def get(self, dev_id):
+        """dev_id の直近のキーの列 (古い順) を返す。"""
+        window = self.window_map.get(dev_id)
+        if window is None:
+            window = collections.deque(maxlen=self.window)
+            self.window_map[dev_id] = window
+        return window
+
+    def check(self, dev_id, counter, cur_time):
+        """重複なら True を返す。重複でなければ窓に記録する。"""
+        key = make_key(counter, cur_time)
+        window = self.get(dev_id)
+        if key in window:
+            return True
+
+        window.append(key)
+        self._dirty = True
+        return False
+
+    def check_batch(self, dev_id, counter, cur_time):
+        """
+        check() を NumPy の配列に対してまとめて行い、重複かどうかの bool 配列を返す。
+
+        NOTE: バッチ内では、同じ dev_id の直前 window 件 (重複したものも含む) と比べる。
+        重複が続いた直後だけは、check() を 1 件ずつ呼ぶよりも遡る範囲が狭くなる。
+        """
+        import numpy as np
+
+        count = len(dev_id)
+        if count == 0:
+            return np.zeros(0, dtype=bool)
+
+        key = (counter.astype(np.int64) << 16) | cur_time
+        order = np.argsort(dev_id, kind="stable")
+        sorted_dev_id = dev_id[order]
+        sorted_key = key[order]
+
+        # NOTE: dev_id 毎のグループ内での順位
+        position = np.arange(count)
+        is_first = np.ones(count, dtype=bool)
+        is_first[1:] = sorted_dev_id[1:] != sorted_dev_id[:-1]
+        rank = position - np.maximum.accumulate(np.where(is_first, position, 0))
+
+        duplicate = np.zeros(count, dtype=bool)
+        for distance in range(1, self.window + 1):
+            duplicate[distance:] |= (sorted_key[distance:] == sorted_key[:-distance]) & (
+                rank[distance:] >= distance
+            )
+
+        # NOTE: グループの先頭 window 件は、これまでに記録したキーのうち、
+        # 窓から押し出されていないものとも比べる
+        for index in np.flatnonzero(rank < self.window).tolist():
+            window = self.window_map.get(int(sorted_dev_id[index]))
+            if not window:
+                continue
+            drop = max(0, len(window) + int(rank[index]) - self.window)
+            if int(sorted_key[index]) in list(window)[drop:]:
+                duplicate[index] = True
+
+        start_list = np.flatnonzero(is_first).tolist()
+        for start, end in zip(start_list, [*start_list[1:], count], strict=True):
+            key_list = sorted_key[start:end][~duplicate[start:end]][-self.window :].tolist()
+            if key_list:
+                self.get(int(sorted_dev_id[start])).extend(key_list)
+                self._dirty = True
+
+        result = np.empty(count, dtype=bool)
+        result[order] = duplicate
+        return result
+
+    def load(self):
+        if not self.state_file.exists():
+            return
+
+        try:
+            state = json.loads(self.state_file.read_text())
+            for dev_id, key_list in state.items():
+                window = self.get(int(dev_id))
+                window.extend(make_key(counter, cur_time) for counter, cur_time in key_list)
+        except Exception:
+            logging.exception("Failed to load dedupe state, starting fresh")
+            self.window_map = {}
+            return
+
+        logging.info("Load dedupe state (%d device(s))", len(self.window_map))
+
+    def maybe_store(self, now=None):
+        """前回の書き出しから snapshot_sec 経っていれば、状態を書き出す。"""
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_snapshot < self.snapshot_sec:
+            return
+        self.last_snapshot = now
+        self.store()
+
+    def store(self):
+        """前回の書き出し以降に変化があれば、状態をファイルに書き出す。"""
+        if (self.state_file is None) or not self._dirty:
+            return
+
+        state = {
+            str(dev_id): [[key >> 16, key & 0xFFFF] for key in window]
+            for dev_id, window in self.window_map.items()
+        }
+        try:
+            # NOTE: プロセス異常終了によるファイル破損を避けるためアトミックに書き込む
+            tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+            tmp_file.write_text(json.dumps(state))
+            tmp_file.replace(self.state_file)
+            self._dirty = False
+        except Exception:
+            logging.exception("Failed to store dedupe state: %s", self.state_file)
@@ -1,59 +1,205 @@
 #!/usr/bin/env python3
 """device.yaml で定義されたデバイス一覧を管理します。"""
 
+import ctypes
+import ctypes.util
 import logging
+import os
 import pathlib
+import select
+import threading
+import types
+import typing
 
 import my_lib.config
 
 import sharp_hems.config
 
+# device.yaml の変更を確認する間隔 (秒)。inotify が使える場合も、取りこぼしに備えてこの間隔で確認する
+WATCH_INTERVAL_SEC = 10
+
+# inotify のイベント (linux/inotify.h)
+_IN_CLOSE_WRITE = 0x0008
+_IN_MOVED_TO = 0x0080
+_IN_CREATE = 0x0100
+_INOTIFY_READ_SIZE = 4096
+
+
+class DeviceSnapshot(typing.NamedTuple):
+    """ある時点の device.yaml の内容。読み込み直す時は丸ごと差し替える。"""
+
+    dev_list: list
+    by_addr: typing.Mapping
+    mtime: float | None
+    generation: int
+
+
+_EMPTY_SNAPSHOT = DeviceSnapshot([], types.MappingProxyType({}), None, 0)
+
+
+def _inotify_open(directory):
+    """ディレクトリ内のファイルの書き込み・置き換えを監視する inotify の fd を返す。使えなければ None。"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        # NOTE: エディタや ConfigMap はファイルを rename で置き換えるので、ディレクトリを監視する
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+    except (OSError, AttributeError, TypeError):
+        return None
+    else:
+        return fd
+
 
 class DeviceRegistry:
-    """device.yaml のロードとアドレス⇔名前の解決を行う (mtime キャッシュ付き)。"""
+    """
+    device.yaml のロードとアドレス⇔名前の解決を行う (mtime キャッシュ付き)。
+
+    watch() を呼ぶと、バックグラウンドのスレッドが変更を検出して読み込み直すので、
+    名前の解決ではファイル I/O を行わない。
+    """
 
     def __init__(self):
         """レジストリを初期化します。"""
-        self._dev_list = []
-        self._mtime = None
-        self._by_addr = {}
+        self._snapshot = _EMPTY_SNAPSHOT
+        self._lock = threading.Lock()
+        self._watch_lock = threading.Lock()
+        self._watch_file = None
+        self._wake_fd = None
+        self._thread = None
+
+    @property
+    def generation(self):
+        """読み込み直す度に増える値。利用側は値の変化でキャッシュを作り直す。"""
+        return self._snapshot.generation
 
     def reload(self, dev_define_file):
         dev_define_file = pathlib.Path(dev_define_file)
 
-        mtime = dev_define_file.stat().st_mtime
-        if self._mtime == mtime:
-            return self._dev_list
-
-        logging.info("Load device list...")
-
-        self._dev_list = sharp_hems.config.validate_device_list(my_lib.config.load(dev_define_file))
-        self._by_addr = {dev_info["addr"].lower(): dev_info for dev_info in self._dev_list}
-        self._mtime = mtime
-
-        return self._dev_list
+        with self._lock:
+            snapshot = self._snapshot
+            mtime = dev_define_file.stat().st_mtime
+            if snapshot.mtime == mtime:
+                return snapshot.dev_list
+
+            logging.info("Load device list...")
+
+            dev_list = sharp_hems.config.validate_device_list(my_lib.config.load(dev_define_file))
+            # NOTE: 参照側がロック無しで一貫した内容を読めるよう、新しいスナップショットを作って差し替える
+            self._snapshot = DeviceSnapshot(
+                dev_list,
+                types.MappingProxyType({dev_info["addr"].lower(): dev_info for dev_info in dev_list}),
+                mtime,
+                snapshot.generation + 1,
+            )
+
+        return dev_list
+
+    def watch(self, dev_define_file, interval_sec=WATCH_INTERVAL_SEC):
+        """
+        device.yaml を読み込み、以降の変更をバックグラウンドで反映する。
+
+        既に同じファイルを監視している場合は何もしない。
+        """
+        dev_define_file = pathlib.Path(dev_define_file).resolve()
+        with self._watch_lock:
+            if (self._watch_file == dev_define_file) and (self._thread is not None):
+                return self._snapshot.dev_list
+
+            self._stop_watch()
+            dev_list = self.reload(dev_define_file)
+
+            # NOTE: 停止要求で select() から即座に抜けられるよう、パイプの読み出し側も待つ
+            wake_r, self._wake_fd = os.pipe()
+            self._watch_file = dev_define_file
+            self._thread = threading.Thread(
+                target=self._watch, args=(dev_define_file, interval_sec, wake_r), daemon=True
+            )
+            self._thread.start()
+
+        return dev_list
+
+    def stop_watch(self):
+        with self._watch_lock:
+            self._stop_watch()
+
+    def _stop_watch(self):
+        if self._thread is None:
+            return
+
+        os.close(self._wake_fd)
+        self._thread.join()
+        self._thread = None
+        self._wake_fd = None
+        self._watch_file = None
+
+    def _watch(self, dev_define_file, interval_sec, wake_fd):
+        inotify_fd = _inotify_open(dev_define_file.parent)
+        logging.info(
+            "Watch device list: %s (%s)", dev_define_file, "inotify" if inotify_fd is not None else "polling"
+        )
+
+        fd_list = [wake_fd] if inotify_fd is None else [wake_fd, inotify_fd]
+        try:
+            while True:
+                readable, _, _ = select.select(fd_list, [], [], interval_sec)
+                if wake_fd in readable:
+                    # NOTE: 書き込み側が閉じられた = 停止要求
+                    break
+                if inotify_fd in readable:
+                    # NOTE: どのファイルのイベントかは見ず、mtime の比較に任せる
+                    os.read(inotify_fd, _INOTIFY_READ_SIZE)
+
+                self._reload_safe(dev_define_file)
+        finally:
+            os.close(wake_fd)
+            if inotify_fd is not None:
+                os.close(inotify_fd)
+
+    def _reload_safe(self, dev_define_file):
+        try:
+            self.reload(dev_define_file)
+        except Exception:
+            # NOTE: 編集途中などで不正な内容でも、直前のスナップショットを使い続ける
+            logging.exception("Failed to reload device list: %s", dev_define_file)
 
     def get_name(self, addr):
-        dev_info = self._by_addr.get(addr.lower())
+        dev_info = self._snapshot.by_addr.get(addr.lower())
         return dev_info["name"] if dev_info is not None else None
 
     def get_scale(self, addr):
         """デバイス毎の電力倍率 (未定義なら None)。"""
-        dev_info = self._by_addr.get(addr.lower())
+        dev_info = self._snapshot.by_addr.get(addr.lower())
         return dev_info.get("scale") if dev_info is not None else None
 
     def get_list(self):
-        return [dev_info["name"] for dev_info in self._dev_list]
+        return [dev_info["name"] for dev_info in self._snapshot.dev_list]
 
 
 # NOTE: 互換のためのモジュールレベル API (既定のレジストリに委譲)
 _default_registry = DeviceRegistry()
 
 
+def get_registry():
+    return _default_registry
+
+
 def reload(dev_define_file):
     return _default_registry.reload(dev_define_file)
 
 
+def watch(dev_define_file, interval_sec=WATCH_INTERVAL_SEC):
+    return _default_registry.watch(dev_define_file, interval_sec)
+
+
+def stop_watch():
+    _default_registry.stop_watch()
+
+
 def get_name(addr):
     return _default_registry.get_name(addr)
 
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+JH-AG01 のシリアル出力を模擬します。
+
+仮想プラグ毎に計測パケット (0x2C) を一定間隔で生成し、定期的に IEEE アドレス通知 (0x08) と
+dev_id 通知 (0x12) の周期を挟む。実機で見られる重複送信・カウンタの折り返し・
+ノイズによるバイト化けも指定した確率で混ぜるので、pty 経由でサーバーに流せば
+ハードウェア無しで長時間の負荷試験ができる。
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import random
+import struct
+import time
+
+import sharp_hems.sniffer
+from sharp_hems.serial_pubsub import SER_SYNC_BYTE
+
+# 計測パケットの送信間隔 (秒)。実機は約 6 分毎。
+MEASURE_INTERVAL_SEC = 360
+# IEEE アドレス・dev_id 通知の周期 (秒)
+ANNOUNCE_INTERVAL_SEC = 3600
+
+PLUG_COUNT_DEFAULT = 10
+DUPLICATE_RATE_DEFAULT = 0.05
+CORRUPT_RATE_DEFAULT = 0.01
+
+
+def _build_packet(packet_type):
+    packet = bytearray(2 + packet_type + 3)
+    packet[0] = SER_SYNC_BYTE
+    packet[1] = packet_type
+    return packet
+
+
+def build_ieee_addr_packet(addr):
+    packet = _build_packet(sharp_hems.sniffer.PACKET_TYPE_IEEE_ADDR)
+    packet[4:12] = bytes(int(x, 16) for x in reversed(addr.split(":")))
+    return bytes(packet[:2]), bytes(packet[2:])
+
+
+def build_dev_id_packet(dev_id, index):
+    packet = _build_packet(sharp_hems.sniffer.PACKET_TYPE_DEV_ID)
+    struct.pack_into("<H", packet, 4, dev_id)
+    packet[6] = index
+    return bytes(packet[:2]), bytes(packet[2:])
+
+
+def build_measure_packet(dev_id, counter, cur_time, cur_power, pre_time, pre_power):  # noqa: PLR0913, PLR0917
+    packet = _build_packet(sharp_hems.sniffer.PACKET_TYPE_MEASURE)
+    struct.pack_into("<H", packet, 5, dev_id)
+    packet[14] = counter
+    struct.pack_into("<H", packet, 19, cur_time)
+    struct.pack_into("<I", packet, 26, cur_power)
+    struct.pack_into("<H", packet, 35, pre_time)
+    struct.pack_into("<I", packet, 42, pre_power)
+    return bytes(packet[:2]), bytes(packet[2:])
+
+
+class VirtualPlug:
+    """計測カウンタ (時刻・積算電力・通し番号) を持つ仮想プラグ。"""
+
+    def __init__(self, index, dev_id, rng):
+        """プラグの状態を初期化します。"""
+        self.addr = f"00:12:4B:00:00:00:{(index + 1) >> 8:02X}:{(index + 1) & 0xFF:02X}"
+        self.dev_id = dev_id
+        self.watt = rng.uniform(5, 1500)
+
+        # NOTE: 折り返しの処理を早めに通るよう、各カウンタは上限の少し手前から始める
+        self.counter = 0x100 - rng.randrange(1, 8)
+        self.time = 0x10000 - MEASURE_INTERVAL_SEC * rng.randrange(1, 8)
+        self.power = 0x100000000 - int(self.watt * MEASURE_INTERVAL_SEC * rng.randrange(1, 8))
+
+    def measure(self, rng, interval=MEASURE_INTERVAL_SEC):
+        """カウンタを interval 秒分進めて、計測パケットを返す。"""
+        pre_time, pre_power = self.time, self.power
+
+        watt = self.watt * rng.uniform(0.9, 1.1)
+        self.time = (self.time + interval) & 0xFFFF
+        self.power = (self.power + round(watt * interval)) & 0xFFFFFFFF
+        self.counter = (self.counter + 1) & 0xFF
+
+        return build_measure_packet(self.dev_id, self.counter, self.time, self.power, pre_time, pre_power)
+
+
+class Emulator:
+    """JH-AG01 のシリアル出力を、エミュレーション上の時刻付きのバイト列として生成する。"""
+
+    def __init__(
+        self,
+        plug_count=PLUG_COUNT_DEFAULT,
+        *,
+        duplicate_rate=DUPLICATE_RATE_DEFAULT,
+        corrupt_rate=CORRUPT_RATE_DEFAULT,
+        seed=None,
+    ):
+        """仮想プラグとノイズの設定を初期化します。"""
+        self.rng = random.Random(seed)  # noqa: S311
+        self.duplicate_rate = duplicate_rate
+        self.corrupt_rate = corrupt_rate
+
+        dev_id_list = self.rng.sample(range(1, 0x10000), plug_count)
+        self.plug_list = [VirtualPlug(index, dev_id, self.rng) for index, dev_id in enumerate(dev_id_list)]
+
+        self.packet_count = 0
+        self.measure_count = 0
+        self.duplicate_count = 0
+        self.corrupt_count = 0
+
+    def announce(self):
+        """IEEE アドレス通知の列と、それに続く dev_id 通知の列を返す。"""
+        return [build_ieee_addr_packet(plug.addr) for plug in self.plug_list] + [
+            build_dev_id_packet(plug.dev_id, index) for index, plug in enumerate(self.plug_list)
+        ]
+
+    def events(self):
+        """(エミュレーション上の経過秒, 送信するバイト列) を時刻順に返し続ける。"""
+        # NOTE: 実機と同様、プラグ毎の送信タイミングは間隔内でばらける
+        schedule = [
+            (MEASURE_INTERVAL_SEC * index / len(self.plug_list), index)
+            for index in range(len(self.plug_list))
+        ]
+        heapq.heapify(schedule)
+        next_announce = 0
+
+        while True:
+            emu_time, index = heapq.heappop(schedule)
+            if emu_time >= next_announce:
+                yield next_announce, self.encode(self.announce())
+                next_announce += ANNOUNCE_INTERVAL_SEC
+
+            self.measure_count += 1
+            yield emu_time, self.encode([self.plug_list[index].measure(self.rng)], duplicate=True)
+            heapq.heappush(schedule, (emu_time + MEASURE_INTERVAL_SEC, index))
+
+    def generate(self, count):
+        """先頭から count イベント分のバイト列を連結して返す。"""
+        return b"".join(event_data for _emu_time, event_data in itertools.islice(self.events(), count))
+
+    def encode(self, packet_list, *, duplicate=False):
+        """パケットの列をシリアルに流れるバイト列にし、確率に応じて重複とノイズを混ぜる。"""
+        data = bytearray()
+        for header, payload in packet_list:
+            packet = header + payload
+            data += self._corrupt(packet) if self.rng.random() < self.corrupt_rate else packet
+            self.packet_count += 1
+
+            if duplicate and self.rng.random() < self.duplicate_rate:
+                data += packet
+                self.duplicate_count += 1
+
+        return bytes(data)
+
+    def _corrupt(self, packet):
+        self.corrupt_count += 1
+
+        kind = self.rng.randrange(3)
+        if kind == 0:
+            # 同期バイトの前にゴミ
+            return self.rng.randbytes(self.rng.randrange(1, 8)) + packet
+        elif kind == 1:
+            # 途中で途切れる (後続のパケットが残りに食われて再同期する)
+            return packet[: self.rng.randrange(1, len(packet))]
+        else:
+            # ペイロード中のバイト化け
+            packet = bytearray(packet)
+            packet[self.rng.randrange(2, len(packet))] ^= 1 << self.rng.randrange(8)
+            return bytes(packet)
+
+    def run(self, fd, speed=1.0, duration_sec=None):
+        """
+        バイト列を fd (pty のマスター側など) に書き込み続ける。
+
+        speed 倍速でエミュレーション上の時刻を進め、duration_sec 秒分送ったら戻る。
+        """
+        start = time.monotonic()
+        for emu_time, data in self.events():
+            if (duration_sec is not None) and (emu_time >= duration_sec):
+                break
+
+            delay = start + emu_time / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            os.write(fd, data)
+            logging.debug("Write %d byte(s) at %.1f sec", len(data), emu_time)
+
+        logging.info(
+            "Emulation finished (packets: %d, duplicates: %d, corrupted: %d)",
+            self.packet_count,
+            self.duplicate_count,
+            self.corrupt_count,
+        )
+
+
+class MemorySerial:
+    """バイト列を読み出すだけのシリアルポート。フレーミングの速度計測に使う。"""
+
+    def __init__(self, data):
+        """読み出すバイト列を設定します。"""
+        self.data = memoryview(data)
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        """読み出せる残りのバイト数を返します。"""
+        return len(self.data) - self.pos
+
+    def read(self, size):
+        data = bytes(self.data[self.pos : self.pos + size])
+        self.pos += len(data)
+        return data
+
+
+def open_pty():
+    """新しい pty を開いて (マスター側の fd, スレーブ側の fd, スレーブ側のパス) を返す。"""
+    import tty
+
+    master_fd, slave_fd = os.openpty()
+    # NOTE: サーバーが開くまでの間に、端末の行編集でバイト列が書き換わらないようにする
+    tty.setraw(slave_fd)
+
+    return master_fd, slave_fd, os.ttyname(slave_fd)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+計測パケット (0x2C) の積算電力カウンタから、デバイス毎の積算電力量を求めます。
+
+計測パケットには前回と現在の (時刻, 積算電力) が入っているので、dev_id 毎に直前に受け取った
+カウンタを覚えておき、その差分を足し込む。パケットを取りこぼしても、次に届いたパケットの
+現在のカウンタとの差分で取りこぼした区間の電力量も数えられる。
+遅れて届いた古いパケットの区間は数え済みなので、フレームカウンタで見分けて読み飛ばす。
+積算値は IEEE アドレス毎に持ち、カウンタと一緒に一定間隔でファイルに書き出すので、
+ロガーを再起動しても続きから数えられる。
+"""
+
+import json
+import logging
+import pathlib
+import time
+
+# 取りこぼした区間の差分として信用する、平均電力の上限 (倍率を掛ける前の W)。
+# これを超える差分はカウンタのリセット等とみなし、パケット自身の区間だけを数える
+WATT_MAX = 5000
+# 状態をファイルに書き出す間隔 (秒)
+SNAPSHOT_SEC_DEFAULT = 60
+
+_TIME_MASK = 0xFFFF
+_POWER_MASK = 0xFFFFFFFF
+# NOTE: 16 ビットの時刻の差がこれ以上なら、時刻が戻った (古いパケット・リセット) とみなす
+_TIME_GAP_MAX = 0x8000
+# NOTE: 8 ビットのフレームカウンタの差がこれ以上なら、遅れて届いた古いパケットとみなす
+_COUNTER_MASK = 0xFF
+_COUNTER_GAP_MAX = 0x80
+# NOTE: 遅れたパケットの判定をまとめて行う際の、繰り返しの上限。超えたら 1 件ずつ処理する
+_BATCH_ITERATION_MAX = 8
+
+WS_PER_KWH = 3600 * 1000
+
+
+def state_path(dev_cache_file):
+    """dev_id キャッシュに対応する、積算電力量の状態の書き出し先のパスを返す。"""
+    dev_cache_file = pathlib.Path(dev_cache_file)
+    return dev_cache_file.with_name(dev_cache_file.name + ".energy")
+
+
+def is_late(last, counter):
+    """直前のカウンタ last (無ければ None) より前に送られた、遅れて届いたパケットなら True を返す。"""
+    if (last is None) or (last[2] is None):
+        return False
+    return ((counter - last[2]) & _COUNTER_MASK) >= _COUNTER_GAP_MAX
+
+
+def count_delta(last, cur_time, cur_power, pre_time, pre_power):
+    """
+    直前のカウンタ last (無ければ None) から、今回のパケットまでに増えた積算電力を返す。
+
+    時刻・積算電力はそれぞれ 16 ビット・32 ビットで折り返すので、差分は同じ幅で求める。
+    """
+    dif_power = (cur_power - pre_power) & _POWER_MASK
+    if (last is None) or (last[:2] == (pre_time, pre_power)):
+        return dif_power
+
+    # NOTE: 間のパケットを取りこぼした場合は、直前のカウンタからの差分を数える
+    last_time, last_power, _ = last
+    time_gap = (cur_time - last_time) & _TIME_MASK
+    power_gap = (cur_power - last_power) & _POWER_MASK
+    if (0 < time_gap < _TIME_GAP_MAX) and (power_gap <= time_gap * WATT_MAX):
+        return power_gap
+
+    logging.info("Energy counter is not continuous, count only this interval")
+    return dif_power
+
+
+class EnergyMeter:
+    """
+    dev_id 毎の直前のカウンタと、IEEE アドレス毎の積算電力量 (倍率適用後の W·s) を保持する。
+
+    直前のカウンタは (時刻, 積算電力, フレームカウンタ) で、フレームカウンタは古い状態ファイルでは None。
+    """
+
+    def __init__(self, state_file=None, snapshot_sec=SNAPSHOT_SEC_DEFAULT):
+        """書き出し先 (None なら書き出さない) と書き出し間隔を初期化します。"""
+        self.state_file = pathlib.Path(state_file) if state_file is not None else None
+        self.snapshot_sec = snapshot_sec
+        self.counter_map = {}
+        self.total_map = {}
+        self.last_snapshot = time.monotonic()
+        self._dirty = False
+
+        if self.state_file is not None:
+            self.load()
+
+    def update(self, dev_id, addr, counter, cur_time, cur_power, pre_time, pre_power, scale):  # noqa: PLR0913, PLR0917
+        """計測値 1 件分の電力量を足し込み、addr の積算電力量 (kWh) を返す。"""
+        last = self.counter_map.get(dev_id)
+        if is_late(last, counter):
+            # NOTE: 区間は数え済み。直前のカウンタも戻さない
+            logging.debug("Skip energy of late packet (dev_id: 0x%04X)", dev_id)
+            return round(self.total_map.get(addr, 0.0) / WS_PER_KWH, 4)
+
+        delta = count_delta(last, cur_time, cur_power, pre_time, pre_power)
+        self.counter_map[dev_id] = (cur_time, cur_power, counter)
+
+        total = self.total_map.get(addr, 0.0) + delta * scale
+        self.total_map[addr] = total
+        self._dirty = True
+
+        return round(total / WS_PER_KWH, 4)
+
+    def update_batch(self, dev_id, addr_index, addr_list, record, scale):
+        """
+        update() を NumPy の配列に対してまとめて行い、各計測値の時点の積算電力量 (kWh) の配列を返す。
+
+        record は counter, cur_time, cur_power, pre_time, pre_power を持つ構造化配列、
+        addr_index は addr_list の添字。
+        """
+        import numpy as np
+
+        count = len(dev_id)
+        if count == 0:
+            return np.zeros(0, dtype=np.float64)
+
+        order = np.argsort(dev_id, kind="stable")
+        sorted_dev_id = dev_id[order]
+        counter = record["counter"][order].astype(np.int64)
+        cur_time = record["cur_time"][order].astype(np.int64)
+        cur_power = record["cur_power"][order].astype(np.int64)
+        pre_time = record["pre_time"][order].astype(np.int64)
+        pre_power = record["pre_power"][order].astype(np.int64)
+
+        is_first = np.ones(count, dtype=bool)
+        is_first[1:] = sorted_dev_id[1:] != sorted_dev_id[:-1]
+        start_list = np.flatnonzero(is_first).tolist()
+
+        last = self._find_last_batch(sorted_dev_id, is_first, counter, cur_time, cur_power)
+        if last is None:
+            return np.asarray(
+                [
+                    self.update(*args)
+                    for args in zip(
+                        dev_id.tolist(),
+                        [addr_list[index] for index in addr_index.tolist()],
+                        record["counter"].tolist(),
+                        record["cur_time"].tolist(),
+                        record["cur_power"].tolist(),
+                        record["pre_time"].tolist(),
+                        record["pre_power"].tolist(),
+                        np.broadcast_to(scale, count).tolist(),
+                        strict=True,
+                    )
+                ],
+                dtype=np.float64,
+            )
+        is_late, has_last, last_time, last_power = last
+
+        dif_power = (cur_power - pre_power) & _POWER_MASK
+        time_gap = (cur_time - last_time) & _TIME_MASK
+        power_gap = (cur_power - last_power) & _POWER_MASK
+        continuous = (pre_time == last_time) & (pre_power == last_power)
+        use_gap = (
+            has_last
+            & ~continuous
+            & (time_gap > 0)
+            & (time_gap < _TIME_GAP_MAX)
+            & (power_gap <= time_gap * WATT_MAX)
+        )
+
+        delta = np.empty(count, dtype=np.float64)
+        delta[order] = np.where(is_late, 0, np.where(use_gap, power_gap, dif_power))
+        delta *= scale
+
+        # NOTE: 遅れたパケットを除いた、グループ内の最後のパケットの位置
+        last_index = np.maximum.accumulate(np.where(is_late, -1, np.arange(count)))
+        for start, end in zip(start_list, [*start_list[1:], count], strict=True):
+            index = last_index[end - 1]
+            if index >= start:
+                self.counter_map[int(sorted_dev_id[start])] = (
+                    int(cur_time[index]),
+                    int(cur_power[index]),
+                    int(counter[index]),
+                )
+
+        return self._accumulate_batch(addr_index, addr_list, delta)
+
+    def _find_last_batch(self, sorted_dev_id, is_first, counter, cur_time, cur_power):
+        """
+        dev_id 順に並べた計測値の、遅れて届いたかどうかと直前のカウンタを求める。is_first は dev_id 毎の先頭。
+
+        (遅れたか, 直前のカウンタが有るか, 直前の時刻, 直前の積算電力) の配列を返す。
+        遅れたパケットの判定が収まらなければ None。
+        """
+        import numpy as np
+
+        count = len(sorted_dev_id)
+        position = np.arange(count)
+        group_start = np.maximum.accumulate(np.where(is_first, position, 0))
+        start_list = np.flatnonzero(is_first).tolist()
+
+        # NOTE: グループの先頭より前の直前のカウンタは、記録済みの値
+        init_time = np.zeros(count, dtype=np.int64)
+        init_power = np.zeros(count, dtype=np.int64)
+        init_counter = np.zeros(count, dtype=np.int64)
+        has_init = np.zeros(count, dtype=bool)
+        has_init_counter = np.zeros(count, dtype=bool)
+        for start, end in zip(start_list, [*start_list[1:], count], strict=True):
+            last = self.counter_map.get(int(sorted_dev_id[start]))
+            if last is None:
+                continue
+            init_time[start:end], init_power[start:end] = last[:2]
+            has_init[start:end] = True
+            if last[2] is not None:
+                init_counter[start:end] = last[2]
+                has_init_counter[start:end] = True
+
+        # NOTE: 遅れて届いた古いパケットは直前のカウンタにしないので、それを除いて
+        # 直前のパケットを選び直し、遅れたパケットが変わらなくなるまで繰り返す
+        is_late = np.zeros(count, dtype=bool)
+        for _ in range(_BATCH_ITERATION_MAX):
+            prev_index = np.full(count, -1, dtype=np.int64)
+            prev_index[1:] = np.maximum.accumulate(np.where(is_late, -1, position))[:-1]
+            has_prev = prev_index >= group_start
+            last_counter = np.where(has_prev, counter[prev_index], init_counter)
+
+            gap = (counter - last_counter) & _COUNTER_MASK
+            next_late = (has_prev | has_init_counter) & (gap >= _COUNTER_GAP_MAX)
+            if np.array_equal(next_late, is_late):
+                return (
+                    is_late,
+                    has_prev | has_init,
+                    np.where(has_prev, cur_time[prev_index], init_time),
+                    np.where(has_prev, cur_power[prev_index], init_power),
+                )
+            is_late = next_late
+
+        return None
+
+    def _accumulate_batch(self, addr_index, addr_list, delta):
+        """電力量の配列を IEEE アドレス毎に受信順で積算し、各計測値の時点の積算電力量 (kWh) を返す。"""
+        import numpy as np
+
+        count = len(delta)
+        addr_order = np.argsort(addr_index, kind="stable")
+        sorted_addr_index = addr_index[addr_order]
+        is_addr_first = np.ones(count, dtype=bool)
+        is_addr_first[1:] = sorted_addr_index[1:] != sorted_addr_index[:-1]
+        cumsum = np.cumsum(delta[addr_order])
+        base = np.zeros(count, dtype=np.float64)
+        addr_start_list = np.flatnonzero(is_addr_first).tolist()
+        for start, end in zip(addr_start_list, [*addr_start_list[1:], count], strict=True):
+            addr = addr_list[int(sorted_addr_index[start])]
+            offset = self.total_map.get(addr, 0.0) - (cumsum[start - 1] if start != 0 else 0.0)
+            base[start:end] = offset
+            self.total_map[addr] = float(cumsum[end - 1] + offset)
+        self._dirty = True
+
+        total = np.empty(count, dtype=np.float64)
+        total[addr_order] = cumsum + base
+        return np.round(total / WS_PER_KWH, 4)
+
+    def load(self):
+        if not self.state_file.exists():
+            return
+
+        try:
+            state = json.loads(self.state_file.read_text())
+            # NOTE: 古い状態ファイルにはフレームカウンタが無い
+            self.counter_map = {
+                int(dev_id): (counter[0], counter[1], counter[2] if len(counter) > 2 else None)
+                for dev_id, counter in state["counter"].items()
+            }
+            self.total_map = {addr: float(total) for addr, total in state["total"].items()}
+        except Exception:
+            logging.exception("Failed to load energy state, starting fresh")
+            self.counter_map = {}
+            self.total_map = {}
+            return
+
+        logging.info("Load energy state (%d device(s))", len(self.total_map))
+
+    def maybe_store(self, now=None):
+        """前回の書き出しから snapshot_sec 経っていれば、状態を書き出す。"""
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_snapshot < self.snapshot_sec:
+            return
+        self.last_snapshot = now
+        self.store()
+
+    def store(self):
+        """前回の書き出し以降に変化があれば、状態をファイルに書き出す。"""
+        if (self.state_file is None) or not self._dirty:
+            return
+
+        # NOTE: 再起動後に取りこぼし分を数え直せるよう、カウンタと積算値は同じ時点のものを一緒に書く
+        state = {
+            "counter": {str(dev_id): list(counter) for dev_id, counter in self.counter_map.items()},
+            "total": self.total_map,
+        }
+        try:
+            # NOTE: プロセス異常終了によるファイル破損を避けるためアトミックに書き込む
+            tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+            tmp_file.write_text(json.dumps(state))
+            tmp_file.replace(self.state_file)
+            self._dirty = False
+        except Exception:
+            logging.exception("Failed to store energy state: %s", self.state_file)
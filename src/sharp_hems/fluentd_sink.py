@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+計測値を Fluentd に送る非同期の送信先。
+
+キューと送信スレッド・再送・スプールは batch_sink.BatchSink に任せ、ここでは
+件数 (batch_size) か時間 (flush_sec) で区切った計測値を、タグ毎に Forward プロトコルの
+PackedForward モードのメッセージにまとめ、持続的な TCP 接続で送る。
+"""
+
+import base64
+import contextlib
+import os
+import socket
+import struct
+
+import msgpack
+
+import sharp_hems.batch_sink
+
+PORT_DEFAULT = 24224
+
+# Forward プロトコルの EventTime (msgpack の拡張型 0)
+_EVENT_TIME_EXT_TYPE = 0
+_ACK_READ_SIZE = 4096
+
+
+def event_time(timestamp):
+    """UNIX 時刻 (秒) を、ナノ秒精度の EventTime に変換する。"""
+    sec = int(timestamp)
+    return msgpack.ExtType(_EVENT_TIME_EXT_TYPE, struct.pack(">II", sec, int((timestamp - sec) * 1e9)))
+
+
+class FluentdSink(sharp_hems.batch_sink.BatchSink):
+    """計測値をまとめて、バックグラウンドで Fluentd に送る。"""
+
+    NAME = "Fluentd"
+
+    def __init__(self, tag, host, port=PORT_DEFAULT, *, require_ack=False, **kwargs):
+        """送信先を初期化し、送信スレッドを開始します。kwargs は BatchSink に渡します。"""
+        self.tag = tag
+        self.host = host
+        self.port = port
+        self.require_ack = require_ack
+        self._socket = None
+
+        super().__init__(**kwargs)
+
+    @classmethod
+    def from_config(cls, config, liveness=None):
+        """config.yaml の fluentd セクションから作る。liveness は送り終えたら更新する。"""
+        fluentd_config = config["fluentd"]
+        spool, replay_rate = cls.spool_from_config(fluentd_config)
+
+        return cls(
+            fluentd_config["data"]["tag"],
+            fluentd_config["host"],
+            fluentd_config.get("port", PORT_DEFAULT),
+            batch_size=fluentd_config.get("batch_size", sharp_hems.batch_sink.BATCH_SIZE_DEFAULT),
+            flush_sec=fluentd_config.get("flush_sec", sharp_hems.batch_sink.FLUSH_SEC_DEFAULT),
+            queue_size=fluentd_config.get("queue_size", sharp_hems.batch_sink.QUEUE_SIZE_DEFAULT),
+            retry_max=fluentd_config.get("retry_max", sharp_hems.batch_sink.RETRY_MAX_DEFAULT),
+            require_ack=fluentd_config.get("require_ack", False),
+            spool=spool,
+            replay_rate=replay_rate,
+            liveness=liveness,
+        )
+
+    @property
+    def target(self):
+        return f"{self.host}:{self.port}"
+
+    def _write_batch(self, batch):
+        for message, chunk in self._encode(batch):
+            self._write(message, chunk)
+
+    def _encode(self, batch):
+        """計測値の列を、タグ毎の PackedForward メッセージの列 [(メッセージ, チャンク ID)] にする。"""
+        packer = msgpack.Packer()
+        entries_map = {}
+        for label, timestamp, record in batch:
+            entries_map.setdefault(label, []).append(packer.pack([event_time(timestamp), record]))
+
+        message_list = []
+        for label, entry_list in entries_map.items():
+            option = {"size": len(entry_list)}
+            chunk = None
+            if self.require_ack:
+                chunk = base64.b64encode(os.urandom(16)).decode()
+                option["chunk"] = chunk
+            message_list.append((packer.pack([f"{self.tag}.{label}", b"".join(entry_list), option]), chunk))
+
+        return message_list
+
+    def _write(self, message, chunk):
+        if self._socket is None:
+            self._socket = socket.create_connection((self.host, self.port), timeout=self.timeout_sec)
+
+        self._socket.sendall(message)
+        if chunk is None:
+            return
+
+        unpacker = msgpack.Unpacker()
+        while True:
+            data = self._socket.recv(_ACK_READ_SIZE)
+            if not data:
+                msg = "connection closed before ack"
+                raise ConnectionError(msg)
+            unpacker.feed(data)
+            for response in unpacker:
+                if isinstance(response, dict) and response.get("ack") == chunk:
+                    return
+                msg = f"unexpected ack: {response}"
+                raise ValueError(msg)
+
+    def _close_connection(self):
+        if self._socket is None:
+            return
+        with contextlib.suppress(OSError):
+            self._socket.close()
+        self._socket = None
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+計測パケット (0x2C) のカウンタから、センサーの無線区間のロスを数えます。
+
+計測パケットのカウンタ (1 バイト) は新しい計測値を送る毎に 1 ずつ増えるので、dev_id 毎に直前の
+カウンタとの差を見れば、届かなかった送信の数が分かる。タイムスロット毎に受信数と合わせて
+メトリクス DB に記録し、ハートビートの有無から推定する通信エラーより安く正確なロスの指標にする。
+"""
+
+import logging
+
+_COUNTER_MASK = 0xFF
+# NOTE: カウンタの差がこれ以上なら、欠番ではなく順序の入れ替わりやリセットとみなす
+_COUNTER_GAP_MAX = 0x80
+# update_batch で、遅れて届いたパケットの判定を繰り返す回数の上限。収束しなければ 1 件ずつ処理する
+_BATCH_ITERATION_MAX = 8
+
+
+class DeviceFrameStats:
+    """dev_id 1 台分の受信数・ロス数と、直前に受け取った (カウンタ, 現在時刻)。"""
+
+    __slots__ = ("counter", "cur_time", "lost", "received", "reported")
+
+    def __init__(self):
+        """集計を初期化します。"""
+        self.counter = None
+        self.cur_time = None
+        self.received = 0
+        self.lost = 0
+        self.reported = (0, 0)
+
+
+class FrameLossStats:
+    """dev_id 毎に、計測パケットのカウンタの欠番を数える。"""
+
+    def __init__(self):
+        """集計を初期化します。"""
+        self.device_map = {}
+
+    def get(self, dev_id):
+        device = self.device_map.get(dev_id)
+        if device is None:
+            device = DeviceFrameStats()
+            self.device_map[dev_id] = device
+        return device
+
+    def update(self, dev_id, counter, cur_time, pre_time):
+        """重複を除いた計測パケット 1 件を反映し、今回検出した欠番の数を返す。"""
+        device = self.get(dev_id)
+        device.received += 1
+
+        lost = 0
+        if device.counter is not None:
+            gap = (counter - device.counter) & _COUNTER_MASK
+            # NOTE: 前回時刻が直前のパケットの現在時刻と一致すれば、間に送信は無い (カウンタのリセット)
+            if (pre_time != device.cur_time) and (0 < gap < _COUNTER_GAP_MAX):
+                lost = gap - 1
+            elif gap >= _COUNTER_GAP_MAX:
+                # NOTE: 遅れて届いた古いパケット。直前のカウンタは進めない
+                return 0
+
+        if lost != 0:
+            logging.debug("Lost %d frame(s) over the air (dev_id: 0x%04X)", lost, dev_id)
+            device.lost += lost
+        device.counter = counter
+        device.cur_time = cur_time
+
+        return lost
+
+    def update_batch(self, dev_id, counter, cur_time, pre_time):
+        """update() を NumPy の配列に対してまとめて行う。"""
+        import numpy as np
+
+        count = len(dev_id)
+        if count == 0:
+            return
+
+        order = np.argsort(dev_id, kind="stable")
+        sorted_dev_id = dev_id[order]
+        sorted_counter = counter[order].astype(np.int64)
+        sorted_cur_time = cur_time[order].astype(np.int64)
+        sorted_pre_time = pre_time[order].astype(np.int64)
+
+        position = np.arange(count)
+        is_first = np.ones(count, dtype=bool)
+        is_first[1:] = sorted_dev_id[1:] != sorted_dev_id[:-1]
+        group_start = np.maximum.accumulate(np.where(is_first, position, 0))
+        start_list = np.flatnonzero(is_first).tolist()
+
+        # NOTE: グループの先頭より前の直前のカウンタは、記録済みの値
+        init_counter = np.zeros(count, dtype=np.int64)
+        init_time = np.zeros(count, dtype=np.int64)
+        has_init = np.zeros(count, dtype=bool)
+        for start, end in zip(start_list, [*start_list[1:], count], strict=True):
+            device = self.device_map.get(int(sorted_dev_id[start]))
+            if (device is not None) and (device.counter is not None):
+                init_counter[start:end] = device.counter
+                init_time[start:end] = device.cur_time
+                has_init[start:end] = True
+
+        # NOTE: 遅れて届いた古いパケットは直前のカウンタにしないので、それを除いて
+        # 直前のパケットを選び直し、遅れたパケットが変わらなくなるまで繰り返す
+        is_late = np.zeros(count, dtype=bool)
+        for _ in range(_BATCH_ITERATION_MAX):
+            prev_index = np.full(count, -1, dtype=np.int64)
+            prev_index[1:] = np.maximum.accumulate(np.where(is_late, -1, position))[:-1]
+            has_prev = prev_index >= group_start
+            last_counter = np.where(has_prev, sorted_counter[prev_index], init_counter)
+            last_time = np.where(has_prev, sorted_cur_time[prev_index], init_time)
+            has_last = has_prev | has_init
+
+            gap = (sorted_counter - last_counter) & _COUNTER_MASK
+            next_late = has_last & (gap >= _COUNTER_GAP_MAX)
+            if np.array_equal(next_late, is_late):
+                break
+            is_late = next_late
+        else:
+            for args in zip(
+                dev_id.tolist(), counter.tolist(), cur_time.tolist(), pre_time.tolist(), strict=True
+            ):
+                self.update(*args)
+            return
+
+        lost = np.where(has_last & ~is_late & (sorted_pre_time != last_time) & (gap > 0), gap - 1, 0)
+        # NOTE: 遅れたパケットを除いた、グループ内の最後のパケットの位置
+        last_index = np.maximum.accumulate(np.where(is_late, -1, position))
+
+        for start, end in zip(start_list, [*start_list[1:], count], strict=True):
+            device = self.get(int(sorted_dev_id[start]))
+            device.received += end - start
+            device.lost += int(lost[start:end].sum())
+            if last_index[end - 1] >= start:
+                device.counter = int(sorted_counter[last_index[end - 1]])
+                device.cur_time = int(sorted_cur_time[last_index[end - 1]])
+
+    @property
+    def received(self):
+        return sum(device.received for device in self.device_map.values())
+
+    @property
+    def lost(self):
+        return sum(device.lost for device in self.device_map.values())
+
+    def take_delta(self):
+        """前回呼び出し時からの {dev_id: (受信数, ロス数)} を返す。変化の無い dev_id は含めない。"""
+        delta_map = {}
+        for dev_id, device in self.device_map.items():
+            current = (device.received, device.lost)
+            if current == device.reported:
+                continue
+            delta_map[dev_id] = (current[0] - device.reported[0], current[1] - device.reported[1])
+            device.reported = current
+        return delta_map
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+計測値を InfluxDB に直接書き込む非同期の送信先。
+
+Fluentd を経由せず、config.yaml の influxdb の url に line protocol で書き込む。
+キューと送信スレッド・再送・スプールは batch_sink.BatchSink に任せ、ここでは
+区切った計測値を 1 回の書き込み (/api/v2/write) にまとめ、gzip で圧縮した本文を
+持続的な HTTP 接続で送る。時刻はパケットの受信時刻 (ナノ秒) を使う。
+
+measurement は Fluentd 経由と同じ "{tag}.{label}" で、tag_keys の項目はタグ、それ以外はフィールドにする。
+"""
+
+import gzip
+import http.client
+import urllib.parse
+
+import sharp_hems.batch_sink
+
+BATCH_SIZE_DEFAULT = 1000
+TAG_KEYS_DEFAULT = ("hostname",)
+
+_NS_PER_SEC = 1000000000
+_MEASUREMENT_ESCAPE = str.maketrans({",": r"\,", " ": r"\ "})
+_KEY_ESCAPE = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ "})
+_STRING_ESCAPE = str.maketrans({'"': r"\"", "\\": r"\\"})
+# NOTE: 計測値そのものを受け付けない応答。再送しても結果が変わらない
+# (認証エラーや 429・5xx は、設定や InfluxDB の復旧を待って再送・スプールする)
+_HTTP_STATUS_REJECTED = frozenset({400, 413, 422})
+
+
+def format_value(value):
+    """フィールドの値を line protocol の表記にする。"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).translate(_STRING_ESCAPE) + '"'
+
+
+def format_time(timestamp):
+    """UNIX 時刻 (秒) を、ナノ秒の整数にする。"""
+    sec = int(timestamp)
+    return sec * _NS_PER_SEC + round((timestamp - sec) * _NS_PER_SEC)
+
+
+def format_line(measurement, record, timestamp, tag_keys=TAG_KEYS_DEFAULT):
+    """計測値 1 件を line protocol の 1 行にする。フィールドが無ければ None。"""
+    tag_list = []
+    field_list = []
+    for key, value in record.items():
+        if value is None:
+            continue
+        if key in tag_keys:
+            tag_list.append(f"{key.translate(_KEY_ESCAPE)}={str(value).translate(_KEY_ESCAPE)}")
+        else:
+            field_list.append(f"{key.translate(_KEY_ESCAPE)}={format_value(value)}")
+
+    if not field_list:
+        return None
+
+    # NOTE: InfluxDB の推奨に従い、タグはキーの順に並べる
+    series = ",".join([measurement.translate(_MEASUREMENT_ESCAPE), *sorted(tag_list)])
+    return f"{series} {','.join(field_list)} {format_time(timestamp)}"
+
+
+class InfluxDBSink(sharp_hems.batch_sink.BatchSink):
+    """計測値をまとめて、バックグラウンドで InfluxDB に書き込む。"""
+
+    NAME = "InfluxDB"
+
+    def __init__(  # noqa: PLR0913
+        self,
+        url,
+        token,
+        org,
+        bucket,
+        tag,
+        *,
+        tag_keys=TAG_KEYS_DEFAULT,
+        batch_size=BATCH_SIZE_DEFAULT,
+        **kwargs,
+    ):
+        """書き込み先を初期化し、送信スレッドを開始します。kwargs は BatchSink に渡します。"""
+        self.url = url
+        self.tag = tag
+        self.tag_keys = frozenset(tag_keys)
+
+        parsed = urllib.parse.urlsplit(url)
+        self._https = parsed.scheme == "https"
+        self._netloc = parsed.netloc
+        self._path = (
+            parsed.path.rstrip("/")
+            + "/api/v2/write?"
+            + urllib.parse.urlencode({"org": org, "bucket": bucket, "precision": "ns"})
+        )
+        self._header = {
+            "Authorization": f"Token {token}",
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Encoding": "gzip",
+        }
+        self._conn = None
+
+        super().__init__(batch_size=batch_size, **kwargs)
+
+    @classmethod
+    def from_config(cls, config, liveness=None):
+        """
+        config.yaml の influxdb セクション (書き込みの設定は influxdb.write) から作る。
+
+        liveness は書き込み終えたら更新する。
+        """
+        influxdb_config = config["influxdb"]
+        write_config = influxdb_config.get("write") or {}
+        spool, replay_rate = cls.spool_from_config(write_config)
+
+        return cls(
+            influxdb_config["url"],
+            influxdb_config["token"],
+            influxdb_config["org"],
+            influxdb_config["bucket"],
+            config["fluentd"]["data"]["tag"],
+            tag_keys=write_config.get("tag_keys", TAG_KEYS_DEFAULT),
+            batch_size=write_config.get("batch_size", BATCH_SIZE_DEFAULT),
+            flush_sec=write_config.get("flush_sec", sharp_hems.batch_sink.FLUSH_SEC_DEFAULT),
+            queue_size=write_config.get("queue_size", sharp_hems.batch_sink.QUEUE_SIZE_DEFAULT),
+            retry_max=write_config.get("retry_max", sharp_hems.batch_sink.RETRY_MAX_DEFAULT),
+            spool=spool,
+            replay_rate=replay_rate,
+            liveness=liveness,
+        )
+
+    @property
+    def target(self):
+        return self.url
+
+    def _encode(self, batch):
+        """計測値の列を、gzip で圧縮した line protocol の本文にする。"""
+        line_list = []
+        for label, timestamp, record in batch:
+            line = format_line(f"{self.tag}.{label}", record, timestamp, self.tag_keys)
+            if line is not None:
+                line_list.append(line)
+        return gzip.compress("\n".join(line_list).encode(), compresslevel=5)
+
+    def _write_batch(self, batch):
+        body = self._encode(batch)
+        if self._conn is None:
+            connection_class = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            self._conn = connection_class(self._netloc, timeout=self.timeout_sec)
+
+        try:
+            self._conn.request("POST", self._path, body=body, headers=self._header)
+            response = self._conn.getresponse()
+            # NOTE: 接続を使い回すため、応答の本文は必ず読み切る
+            detail = response.read().decode(errors="replace").strip()
+        except http.client.HTTPException as e:
+            raise ConnectionError(repr(e)) from e
+        if response.will_close:
+            self._close_connection()
+
+        if 200 <= response.status < 300:
+            return
+        msg = f"HTTP {response.status} {response.reason} {detail}".strip()
+        if response.status in _HTTP_STATUS_REJECTED:
+            raise sharp_hems.batch_sink.RejectedError(msg)
+        raise ConnectionError(msg)
+
+    def _close_connection(self):
+        if self._conn is None:
+            return
+        self._conn.close()
+        self._conn = None
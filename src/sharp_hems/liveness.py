@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+liveness ファイル (footprint) を間引いて更新します。
+
+パケット処理では touch() で最終活動時刻をメモリに記録するだけにして、
+バックグラウンドのスレッドが flush_sec 毎に footprint へ書き出す。
+healthz.py の判定間隔 (6 分) に比べて十分短い周期で書き出すので、判定結果は変わらない。
+"""
+
+import logging
+import threading
+import time
+
+import my_lib.footprint
+
+# footprint へ書き出す間隔 (秒)
+FLUSH_SEC_DEFAULT = 10
+
+
+class LivenessWriter:
+    """最終活動時刻をメモリに保持し、一定間隔で footprint に書き出す。"""
+
+    def __init__(self, path, flush_sec=FLUSH_SEC_DEFAULT):
+        """書き出し先と書き出し間隔を初期化します。"""
+        self.path = path
+        self.flush_sec = flush_sec
+        self.last_active = None
+        self.last_flush = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def touch(self, now=None):
+        """活動があったことを記録する (ファイル I/O は行わない)。"""
+        self.last_active = time.time() if now is None else now
+
+    def flush(self):
+        """前回の書き出し以降に活動があれば footprint を更新する。"""
+        last_active = self.last_active
+        if (last_active is None) or (last_active == self.last_flush):
+            return False
+
+        # NOTE: 活動が無い間は更新しないことで、healthz が停止を検出できるようにする
+        my_lib.footprint.update(self.path)
+        self.last_flush = last_active
+        return True
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """スレッドを止めて、未書き出しの活動を書き出す。"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._flush_safe()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_sec):
+            self._flush_safe()
+
+    def _flush_safe(self):
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("Failed to update liveness file: %s", self.path)
@@ -84,6 +84,68 @@ class MetricsCollector:
                 ON communication_errors(timestamp)
             """)
 
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS transport_stats (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp INTEGER NOT NULL,
+                    received INTEGER NOT NULL,
+                    lost INTEGER NOT NULL
+                )
+            """)
+
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_transport_stats_timestamp
+                ON transport_stats(timestamp)
+            """)
+
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS frame_stats (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sensor_name TEXT NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    received INTEGER NOT NULL,
+                    lost INTEGER NOT NULL
+                )
+            """)
+
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_frame_stats_timestamp
+                ON frame_stats(timestamp)
+            """)
+
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS spool_stats (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp INTEGER NOT NULL,
+                    depth INTEGER NOT NULL,
+                    age_sec INTEGER NOT NULL
+                )
+            """)
+
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_spool_stats_timestamp
+                ON spool_stats(timestamp)
+            """)
+
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sink_stats (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sink_name TEXT NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    sent INTEGER NOT NULL,
+                    failed INTEGER NOT NULL,
+                    dropped INTEGER NOT NULL,
+                    backlog INTEGER NOT NULL,
+                    latency_avg REAL NOT NULL,
+                    latency_max REAL NOT NULL
+                )
+            """)
+
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_sink_stats_timestamp
+                ON sink_stats(timestamp)
+            """)
+
             conn.commit()
 
     @contextmanager
@@ -337,7 +399,7 @@ class MetricsCollector:
           (sensor_availability) に集約してから削除する
         - データが 1 件も無い日も、そのセンサーのデータ開始後であれば received=0 の
           サマリーを残す (累計受信率が水増しされないようにするため)
-        - 通信エラーはサマリー対象外なので retention_days の 3 倍で削除する
+        - 通信エラー・配信ロス・無線区間のロスはサマリー対象外なので retention_days の 3 倍で削除する
         """
         if retention_days is None:
             retention_days = self.retention_days
@@ -408,6 +470,22 @@ class MetricsCollector:
                 "DELETE FROM communication_errors WHERE timestamp < ?",
                 (now - retention_days * 3 * 86400,),
             ).rowcount
+            conn.execute(
+                "DELETE FROM transport_stats WHERE timestamp < ?",
+                (now - retention_days * 3 * 86400,),
+            )
+            conn.execute(
+                "DELETE FROM frame_stats WHERE timestamp < ?",
+                (now - retention_days * 3 * 86400,),
+            )
+            conn.execute(
+                "DELETE FROM spool_stats WHERE timestamp < ?",
+                (now - retention_days * 3 * 86400,),
+            )
+            conn.execute(
+                "DELETE FROM sink_stats WHERE timestamp < ?",
+                (now - retention_days * 3 * 86400,),
+            )
             conn.commit()
 
             logging.info(
@@ -607,3 +685,242 @@ class MetricsCollector:
                 )
 
             return errors
+
+    def record_transport_stats(self, received: int, lost: int, timestamp: int | None = None):
+        """
+        サーバー → ロガー間 (ZeroMQ) の受信数と配信ロス数を記録します。
+
+        センサーの無線区間のロス (communication_errors) とは別に集計するためのもので、
+        ロガーが一定間隔で前回からの差分を記録する。
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        try:
+            with self._get_connection() as conn:
+                conn.execute(
+                    "INSERT INTO transport_stats (timestamp, received, lost) VALUES (?, ?, ?)",
+                    (timestamp, received, lost),
+                )
+                conn.commit()
+        except sqlite3.Error:
+            logging.exception("Failed to record transport stats")
+
+    def get_transport_stats(self, hours: int = 24) -> dict:
+        """
+        指定された時間内の配信ロスの集計を取得します。
+
+        Returns:
+            {"received": 受信数, "lost": ロス数, "loss_percent": ロス率 (%)}
+
+        """
+        start_timestamp = int(time.time()) - hours * 3600
+
+        with self._get_connection() as conn:
+            cursor = conn.execute(
+                """
+                SELECT COALESCE(SUM(received), 0), COALESCE(SUM(lost), 0)
+                FROM transport_stats
+                WHERE timestamp >= ?
+                """,
+                (start_timestamp,),
+            )
+            received, lost = cursor.fetchone()
+
+        total = received + lost
+        return {
+            "received": received,
+            "lost": lost,
+            "loss_percent": round(lost / total * 100, 2) if total > 0 else 0.0,
+        }
+
+    def record_frame_stats(self, stats: dict, timestamp: int | None = None):
+        """
+        センサー毎の計測パケットの受信数と、カウンタの欠番から数えた無線区間のロス数を記録します。
+
+        ロガーが一定間隔で前回からの差分を {センサー名: (受信数, ロス数)} で渡す。
+        """
+        if not stats:
+            return
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        try:
+            with self._get_connection() as conn:
+                conn.executemany(
+                    "INSERT INTO frame_stats (sensor_name, timestamp, received, lost) VALUES (?, ?, ?, ?)",
+                    [
+                        (sensor_name, timestamp, received, lost)
+                        for sensor_name, (received, lost) in stats.items()
+                    ],
+                )
+                conn.commit()
+        except sqlite3.Error:
+            logging.exception("Failed to record frame stats")
+
+    def get_frame_stats(self, hours: int = 24) -> dict:
+        """
+        指定された時間内の無線区間のロスの集計を取得します。
+
+        Returns:
+            {"received": 受信数, "lost": ロス数, "loss_percent": ロス率 (%),
+             "sensors": [{"name": センサー名, "received": ..., "lost": ..., "loss_percent": ...}]}
+
+        """
+        start_timestamp = int(time.time()) - hours * 3600
+
+        with self._get_connection() as conn:
+            cursor = conn.execute(
+                """
+                SELECT sensor_name, SUM(received), SUM(lost)
+                FROM frame_stats
+                WHERE timestamp >= ?
+                GROUP BY sensor_name
+                ORDER BY sensor_name
+                """,
+                (start_timestamp,),
+            )
+            rows = cursor.fetchall()
+
+        def _loss(received, lost):
+            total = received + lost
+            return {
+                "received": received,
+                "lost": lost,
+                "loss_percent": round(lost / total * 100, 2) if total > 0 else 0.0,
+            }
+
+        return {
+            **_loss(sum(row[1] for row in rows), sum(row[2] for row in rows)),
+            "sensors": [{"name": name, **_loss(received, lost)} for name, received, lost in rows],
+        }
+
+    def record_spool_stats(self, depth: int, age_sec: int, timestamp: int | None = None):
+        """
+        送信先の障害中にディスクのスプールへ溜めた計測値の件数と、最も古いものの経過秒数を記録します。
+
+        ロガーが一定間隔で、その時点の値を記録する。
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        try:
+            with self._get_connection() as conn:
+                conn.execute(
+                    "INSERT INTO spool_stats (timestamp, depth, age_sec) VALUES (?, ?, ?)",
+                    (timestamp, depth, age_sec),
+                )
+                conn.commit()
+        except sqlite3.Error:
+            logging.exception("Failed to record spool stats")
+
+    def record_sink_stats(self, stats_list: list, timestamp: int | None = None):
+        """
+        送信先毎の送信数・失敗数・破棄数と、キューの深さ・遅延 (受信から送信までの秒数) を記録します。
+
+        ロガーが一定間隔で、前回からの差分を batch_sink.SinkStats のリストで渡す。
+        """
+        if not stats_list:
+            return
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        try:
+            with self._get_connection() as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO sink_stats
+                    (sink_name, timestamp, sent, failed, dropped, backlog, latency_avg, latency_max)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [(stats[0], timestamp, *stats[1:]) for stats in stats_list],
+                )
+                conn.commit()
+        except sqlite3.Error:
+            logging.exception("Failed to record sink stats")
+
+    def get_sink_stats(self, hours: int = 24) -> list:
+        """
+        指定された時間内の送信先毎の集計を取得します。
+
+        Returns:
+            [{"name": 送信先, "sent": 送信数, "failed": 失敗数, "dropped": 破棄数,
+              "backlog": 最新のキューの深さ, "latency_avg": 平均遅延 (秒), "latency_max": 最大遅延 (秒)}]
+
+        """
+        start_timestamp = int(time.time()) - hours * 3600
+
+        with self._get_connection() as conn:
+            cursor = conn.execute(
+                """
+                SELECT
+                    sink_name,
+                    SUM(sent),
+                    SUM(failed),
+                    SUM(dropped),
+                    (SELECT backlog FROM sink_stats AS latest
+                     WHERE latest.sink_name = sink_stats.sink_name AND latest.timestamp >= ?
+                     ORDER BY latest.timestamp DESC, latest.id DESC LIMIT 1),
+                    SUM(latency_avg * sent),
+                    MAX(latency_max)
+                FROM sink_stats
+                WHERE timestamp >= ?
+                GROUP BY sink_name
+                ORDER BY sink_name
+                """,
+                (start_timestamp, start_timestamp),
+            )
+            rows = cursor.fetchall()
+
+        return [
+            {
+                "name": name,
+                "sent": sent,
+                "failed": failed,
+                "dropped": dropped,
+                "backlog": backlog,
+                # NOTE: 平均遅延は、スロット毎の平均を送信数で重み付けして求める
+                "latency_avg": round(latency_total / sent, 3) if sent > 0 else 0.0,
+                "latency_max": round(latency_max, 3),
+            }
+            for name, sent, failed, dropped, backlog, latency_total, latency_max in rows
+        ]
+
+    def get_spool_stats(self, hours: int = 24) -> dict:
+        """
+        指定された時間内のスプールの状態を取得します。
+
+        Returns:
+            {"depth": 最新の件数, "age_sec": 最新の経過秒数,
+             "depth_max": 期間内の最大件数, "age_sec_max": 期間内の最大経過秒数}
+
+        """
+        start_timestamp = int(time.time()) - hours * 3600
+
+        with self._get_connection() as conn:
+            cursor = conn.execute(
+                """
+                SELECT depth, age_sec FROM spool_stats
+                WHERE timestamp >= ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT 1
+                """,
+                (start_timestamp,),
+            )
+            latest = cursor.fetchone() or (0, 0)
+            cursor = conn.execute(
+                """
+                SELECT COALESCE(MAX(depth), 0), COALESCE(MAX(age_sec), 0)
+                FROM spool_stats
+                WHERE timestamp >= ?
+                """,
+                (start_timestamp,),
+            )
+            depth_max, age_sec_max = cursor.fetchone()
+
+        return {
+            "depth": latest[0],
+            "age_sec": latest[1],
+            "depth_max": depth_max,
+            "age_sec_max": age_sec_max,
+        }
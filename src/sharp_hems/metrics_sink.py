@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+計測値からセンサーのハートビートをメトリクス DB (SQLite) に記録する送信先。
+
+受信したセンサーを MetricsCollector に記録し、その後で無応答監視 (DeviceWatchdog) を行う。
+SQLite の更新や Slack への通知に時間が掛かっても、パケットの処理や他の送信先を待たせないよう、
+batch_sink.BatchSink の送信スレッドでまとめて行う。
+"""
+
+import sqlite3
+
+import sharp_hems.batch_sink
+
+
+class MetricsSink(sharp_hems.batch_sink.BatchSink):
+    """計測値のハートビートを、バックグラウンドでメトリクス DB に記録する。"""
+
+    NAME = "Metrics"
+    # NOTE: 他のプロセス (WebUI) が書き込み中でロックが取れない場合など
+    RETRY_ERRORS = (sqlite3.Error,)
+
+    def __init__(self, collector, watchdog=None, **kwargs):
+        """記録先と無応答監視を初期化し、送信スレッドを開始します。kwargs は BatchSink に渡します。"""
+        self.collector = collector
+        self.watchdog = watchdog
+
+        super().__init__(**kwargs)
+
+    @property
+    def target(self):
+        return str(self.collector.db_path)
+
+    def _write_batch(self, batch):
+        for _label, timestamp, record in batch:
+            self.collector.record_heartbeat(record["hostname"], int(timestamp))
+
+        # NOTE: 古いハートビートの日次サマリーへの畳み込み (1日1回)
+        self.collector.maybe_cleanup()
+        if self.watchdog is not None:
+            self.watchdog.check()
+
+    def _close_connection(self):
+        # NOTE: MetricsCollector は呼び出し毎に接続する
+        pass
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+packet.dump の再生 (ロガーの --replay)。
+
+記録時の経過時間 (elapsed) に合わせて、実時間 (realtime)・N 倍速・最速 (max) でパケットを
+LoggerPipeline に渡し、終了後にスループット・段毎の処理時間・遅延・重複率をレポートする。
+実際の受信間隔での負荷試験と、解析処理のベンチマークの両方に使う。
+"""
+
+import logging
+import time
+import typing
+
+SPEED_REALTIME = "realtime"
+SPEED_MAX = "max"
+
+
+def parse_speed(text):
+    """--replay-speed の値 (realtime / N / Nx / max) を倍率に変換する。max は None。"""
+    text = text.strip().lower()
+    if text == SPEED_MAX:
+        return None
+    if text == SPEED_REALTIME:
+        return 1.0
+
+    try:
+        speed = float(text.removesuffix("x").removesuffix("×"))
+    except ValueError:
+        speed = 0
+    if not speed > 0:
+        msg = f"Invalid replay speed: {text} (realtime, N, Nx or max)"
+        raise ValueError(msg)
+    return speed
+
+
+class ReplayReport(typing.NamedTuple):
+    """再生の結果。時間はすべて秒。"""
+
+    packet_count: int
+    measure_count: int
+    duplicate_count: int
+    # NOTE: 再生に掛かった時間と、ダンプに記録された時間の幅
+    total_sec: float
+    dump_sec: float
+    # NOTE: 段毎の処理時間の合計。decode は解析 (段に渡す前まで) の分
+    stage_time: dict
+    # NOTE: パケット 1 件の処理時間
+    latency_avg: float
+    latency_p99: float
+    latency_max: float
+    # NOTE: 記録時の間隔どおりに処理し終えるはずの時刻からの遅れの最大 (max では None)
+    lag_max: float | None
+
+    @property
+    def packets_per_sec(self):
+        return self.packet_count / self.total_sec if self.total_sec > 0 else 0.0
+
+    @property
+    def duplicate_ratio(self):
+        return self.duplicate_count / self.measure_count if self.measure_count != 0 else 0.0
+
+
+def replay(pipeline, packet_list, speed=None, sleep=time.sleep):
+    """
+    [(elapsed, header, payload)] を pipeline に渡し、ReplayReport を返す。
+
+    speed は記録時に対する倍率で、None なら待たずに最速で渡す。
+    """
+    stage_time = pipeline.enable_profile()
+    sniffer = pipeline.sniffer
+    measure_count = sniffer.measure_count
+    duplicate_count = sniffer.duplicate_count
+
+    latency_list = []
+    lag_max = None
+    base_elapsed = packet_list[0][0] if packet_list else 0.0
+    start = time.perf_counter()
+    for elapsed, header, payload in packet_list:
+        if speed is not None:
+            target = start + (elapsed - base_elapsed) / speed
+            wait = target - time.perf_counter()
+            if wait > 0:
+                sleep(wait)
+
+        begin = time.perf_counter()
+        pipeline.process(header, payload)
+        end = time.perf_counter()
+        latency_list.append(end - begin)
+        if speed is not None:
+            lag_max = max(end - target, lag_max or 0.0)
+
+        if pipeline.is_done():
+            break
+    total_sec = time.perf_counter() - start
+
+    latency_list.sort()
+    process_sec = sum(latency_list)
+    return ReplayReport(
+        packet_count=len(latency_list),
+        measure_count=sniffer.measure_count - measure_count,
+        duplicate_count=sniffer.duplicate_count - duplicate_count,
+        total_sec=total_sec,
+        dump_sec=(packet_list[len(latency_list) - 1][0] - base_elapsed) if latency_list else 0.0,
+        stage_time={"decode": process_sec - sum(stage_time.values()), **stage_time},
+        latency_avg=process_sec / len(latency_list) if latency_list else 0.0,
+        latency_p99=latency_list[int((len(latency_list) - 1) * 0.99)] if latency_list else 0.0,
+        latency_max=latency_list[-1] if latency_list else 0.0,
+        lag_max=lag_max,
+    )
+
+
+def log_report(report):
+    """ReplayReport をログに出す。"""
+    logging.info(
+        "Replay: %d packet(s) in %.3f sec (%.0f packets/sec, recorded %.1f sec)",
+        report.packet_count,
+        report.total_sec,
+        report.packets_per_sec,
+        report.dump_sec,
+    )
+    for name, sec in report.stage_time.items():
+        logging.info(
+            "  %-10s: %.3f sec (%.1f usec/packet)",
+            name,
+            sec,
+            sec / report.packet_count * 1e6 if report.packet_count != 0 else 0.0,
+        )
+    logging.info(
+        "  latency   : avg %.1f usec, p99 %.1f usec, max %.1f usec",
+        report.latency_avg * 1e6,
+        report.latency_p99 * 1e6,
+        report.latency_max * 1e6,
+    )
+    if report.lag_max is not None:
+        logging.info("  lag max   : %.3f sec behind the recorded timing", report.lag_max)
+    logging.info(
+        "  dedupe    : %d / %d measure packet(s) (%.2f%%)",
+        report.duplicate_count,
+        report.measure_count,
+        report.duplicate_ratio * 100,
+    )
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+ロガーのパケット処理 (解析 → 名前解決 → 送信先への振り分け)。
+
+起動時に設定から LoggerPipeline を 1 つ組み立て、受信したパケット毎に process() を呼ぶ。
+各段は組み立て時に束縛したメソッドの列として持つので、パケット毎にクロージャを作ったり、
+入れ子の dict を引いたりしない。CLI (受信・packet.dump の再生) とテストで同じものを使う。
+
+計測値は送信先 (Fluentd / InfluxDB / メトリクス DB と無応答監視) 毎のキューに積むだけで、
+送信は送信先毎のスレッドが行う (batch_sink.BatchSink)。遅い送信先があっても、
+パケットの処理や他の送信先は待たされない。
+"""
+
+import logging
+import pathlib
+import time
+
+import my_lib.pretty
+
+import sharp_hems.device
+import sharp_hems.notify
+import sharp_hems.serial_pubsub
+import sharp_hems.sniffer
+from sharp_hems.metrics.collector import TIME_SLOT_SEC
+
+# 積算電力量 (kWh) を送るフィールド名のデフォルト
+ENERGY_FIELD_DEFAULT = "energy"
+
+
+class LoggerPipeline:
+    """受信したパケットを解析し、計測値を各段に渡す。"""
+
+    __slots__ = (
+        "_capture",
+        "_sniff",
+        "_stage_list",
+        "config",
+        "dummy_mode",
+        "energy_field",
+        "field",
+        "label",
+        "last_record",
+        "metrics_collector",
+        "packet_count",
+        "packet_max",
+        "packet_queue",
+        "position",
+        "receive_time",
+        "sink_list",
+        "sniffer",
+        "stats",
+    )
+
+    def __init__(
+        self,
+        config,
+        *,
+        sink_list=(),
+        metrics_collector=None,
+        dummy_mode=False,
+        packet_max=0,
+    ):
+        """設定から各段を組み立てます。"""
+        self.config = config
+        self.dummy_mode = dummy_mode
+        self.sink_list = tuple(sink_list)
+        self.label = config["fluentd"]["data"]["label"]
+        self.field = config["fluentd"]["data"]["field"]
+        self.energy_field = config["fluentd"]["data"].get("energy_field", ENERGY_FIELD_DEFAULT)
+        # NOTE: 配信ロス等の集計の記録先 (ハートビートは送信先の MetricsSink が記録する)
+        self.metrics_collector = metrics_collector
+        self.packet_count = 0
+        self.packet_max = packet_max
+        self.receive_time = None
+
+        self.sniffer = sharp_hems.sniffer.PacketSniffer(
+            pathlib.Path(config["device"]["cache"]),
+            watt_scale=config.get("sensor", {}).get("watt_scale", sharp_hems.sniffer.WATT_SCALE_DEFAULT),
+            # NOTE: デバイス名と倍率は dev_id 毎に解決して、スニッファ側でキャッシュする
+            registry=sharp_hems.device.get_registry(),
+        )
+
+        self.stats = sharp_hems.serial_pubsub.StreamStats()
+        self.packet_queue = sharp_hems.serial_pubsub.PacketQueue()
+        self.last_record = time.time()
+        self.position = None
+        replay_config = config.get("replay")
+        if (replay_config is not None) and (replay_config.get("state") is not None) and not dummy_mode:
+            # NOTE: 前回の受信位置から再送してもらう
+            self.position = pathlib.Path(replay_config["state"])
+            self.stats.load_position(self.position)
+
+        self._stage_list = (self._log_dummy,) if dummy_mode else (self._send,)
+
+        # NOTE: パケット毎に束縛メソッドを作らないよう、先に取り出しておく
+        self._capture = self.capture
+        self._sniff = self.sniffer.process
+
+    # ---------- パケット処理 ----------
+
+    def process(self, header, payload):
+        """受信したパケット 1 件を処理する。"""
+        meta = self.packet_queue.current_meta
+        # NOTE: サーバーでの受信時刻を計測値の時刻にする。無ければ (packet.dump の再生など) 処理した時刻
+        self.receive_time = meta.recv_time if (meta is not None) and meta.recv_time else time.time()
+        self.update_transport()
+        self._sniff(header, payload, self._capture)
+
+    def capture(self, data):
+        """復元した計測値を各段に順に渡す。"""
+        for stage in self._stage_list:
+            stage(data)
+
+    def enable_profile(self):
+        """
+        各段の処理時間 (秒) を段の名前毎に積算するようにし、その dict を返す。
+
+        packet.dump の再生でのレポート用。パケット毎の計時が増えるので、通常の受信では使わない。
+        """
+        stage_time = {}
+
+        def timed(stage):
+            name = stage.__name__.lstrip("_")
+            stage_time[name] = 0.0
+
+            def wrapper(data):
+                start = time.perf_counter()
+                stage(data)
+                stage_time[name] += time.perf_counter() - start
+
+            return wrapper
+
+        self._stage_list = tuple(timed(stage) for stage in self._stage_list)
+        return stage_time
+
+    def is_done(self):
+        """-n で指定した件数を処理し終えたら True を返す。"""
+        return (self.packet_max != 0) and (self.packet_count >= self.packet_max)
+
+    def _log_dummy(self, data):
+        logging.info(my_lib.pretty.format(data.to_dict()))
+        self.packet_count += 1
+        if self.is_done():
+            sharp_hems.serial_pubsub.stop_client()
+
+    def _send(self, data):
+        try:
+            if data.name is None:
+                logging.warning("Unknown device: dev_id = %s", data.dev_id_str)
+                return
+
+            send_data = {
+                "hostname": data.name,
+                self.field: round(data.watt),
+            }
+            if data.energy_kwh is not None:
+                # NOTE: 期間の電力量は、このフィールドの差分で求められる
+                send_data[self.energy_field] = data.energy_kwh
+
+            # NOTE: liveness は、送信先が実際に送り終えた時点で送信スレッドが更新する
+            if self._emit(send_data):
+                logging.info("Send: %s", send_data)
+        except Exception:
+            sharp_hems.notify.error(self.config)
+
+    def _emit(self, send_data):
+        """計測値を各送信先のキューに積む。1 つ以上が受け付ければ True を返す。"""
+        accepted = False
+        for sink in self.sink_list:
+            # NOTE: 1 つの送信先の失敗が、他の送信先への振り分けを止めないようにする
+            try:
+                if sink.emit_with_time(self.label, self.receive_time, send_data):
+                    accepted = True
+                else:
+                    logging.error(sink.last_error)
+            except Exception:
+                logging.exception("Failed to emit to %s sink", sink.NAME)
+        return accepted
+
+    # ---------- 配信の状態 ----------
+
+    def update_transport(self, now=None):
+        """タイムスロット毎に配信ロス・無線区間のロス・送信先の状態をメトリクスへ記録し、受信位置を保存する"""
+        if now is None:
+            now = time.time()
+
+        if now - self.last_record < TIME_SLOT_SEC:
+            return
+        self.last_record = now
+
+        if self.metrics_collector is not None:
+            received, lost = self.stats.take_delta()
+            self.metrics_collector.record_transport_stats(received, lost, int(now))
+
+        self.record_frame_loss(now)
+        self.record_sink(now)
+        self.record_spool(now)
+
+        dropped = self.packet_queue.take_dropped()
+        if dropped != 0:
+            logging.warning(
+                "Dropped %d packet(s) in receive queue (depth: %d, depth max: %d)",
+                dropped,
+                self.packet_queue.depth,
+                self.packet_queue.depth_max,
+            )
+
+        self.save_position()
+
+    def record_frame_loss(self, now):
+        """前回からのセンサー毎の受信数と無線区間のロス数を、ログとメトリクスに出す。"""
+        frame_stats = {}
+        for dev_id, delta in self.sniffer.frame_loss.take_delta().items():
+            device = self.sniffer.resolve_device(dev_id)
+            if (device is None) or (device.name is None):
+                # NOTE: 名前の無いデバイスはメトリクスの集計対象外
+                continue
+            # NOTE: 同じデバイスの dev_id が変わった場合は合算する
+            received, lost = frame_stats.get(device.name, (0, 0))
+            frame_stats[device.name] = (received + delta[0], lost + delta[1])
+
+        lost_list = [f"{name} ({lost})" for name, (_received, lost) in frame_stats.items() if lost != 0]
+        if lost_list:
+            logging.info("Lost frame(s) over the air: %s", ", ".join(lost_list))
+
+        if self.metrics_collector is not None:
+            self.metrics_collector.record_frame_stats(frame_stats, int(now))
+
+    def record_sink(self, now):
+        """前回からの送信先毎の送信数・キューの深さ・遅延を、ログとメトリクスに出す。"""
+        stats_list = [sink.take_stats() for sink in self.sink_list]
+        for stats in stats_list:
+            logging.info(
+                "%s sink: sent %d, failed %d, dropped %d, backlog %d, latency %.3f sec (max %.3f sec)",
+                *stats,
+            )
+
+        if self.metrics_collector is not None:
+            self.metrics_collector.record_sink_stats(stats_list, int(now))
+
+    def record_spool(self, now):
+        """送信先のスプールに溜まっている計測値の件数と経過時間を、ログとメトリクスに出す。"""
+        spool_list = [sink.spool for sink in self.sink_list if sink.spool is not None]
+        if not spool_list:
+            return
+
+        # NOTE: 複数の送信先がスプールを持つ場合は、件数は合計、経過時間は最も古いもの
+        depth = sum(spool.depth for spool in spool_list)
+        age_sec = int(max(spool.age(now) for spool in spool_list))
+        if depth != 0:
+            logging.warning("Spooled %d record(s), oldest %d sec ago", depth, age_sec)
+
+        if self.metrics_collector is not None:
+            self.metrics_collector.record_spool_stats(depth, age_sec, int(now))
+
+    def save_position(self):
+        if self.position is None:
+            return
+        try:
+            # NOTE: キューに残っている分は未処理なので、処理し終えた位置を保存する
+            self.stats.save_position(self.position, self.packet_queue.last_meta)
+        except Exception:
+            logging.exception("Failed to save stream position")
+
+    def close(self):
+        """終了時に、受信位置とスニッファの状態を保存する。"""
+        # 次回起動時に再送してもらえるよう、受信位置を保存
+        self.save_position()
+        # 再起動後も重複をはじけるよう、スニッファの状態を保存
+        self.sniffer.flush_state()
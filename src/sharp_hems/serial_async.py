@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+asyncio 版のシリアルサーバー。
+
+serial_pubsub.start_server と同じ形式で配信するが、シリアルはノンブロッキングで
+イベントループに登録し、ZeroMQ も zmq.asyncio で扱う。配信・再送・liveness の書き出し・
+統計の出力を 1 スレッド上のタスクとして動かすので、停止要求には即座に応じる。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+import serial
+import zmq
+import zmq.asyncio
+
+import sharp_hems.liveness
+import sharp_hems.serial_pubsub
+
+# 受信統計をログに出力する間隔 (秒)
+STATS_INTERVAL_SEC = 600
+
+_server = None
+# NOTE: start_server() がサーバーを作る前に stop_server() が呼ばれた場合の停止要求。
+#       シグナルハンドラから呼ばれても止まらないよう、再入可能なロックにする
+_stop_pending = False
+_server_lock = threading.RLock()
+
+
+class AsyncSerialServer:
+    """シリアルから読み出したパケットを、asyncio のタスクで配信するサーバー。"""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        serial_port,
+        server_port,
+        liveness_file,
+        protocol=sharp_hems.serial_pubsub.PROTOCOL_BINARY,
+        replay_config=None,
+        *,
+        liveness_flush_sec=sharp_hems.liveness.FLUSH_SEC_DEFAULT,
+    ):
+        """配信の設定を初期化します。"""
+        sharp_hems.serial_pubsub.check_protocol(protocol, sharp_hems.serial_pubsub.PROTOCOL_LIST)
+
+        self.serial_port_list = sharp_hems.serial_pubsub.serial_port_list(serial_port)
+        self.server_port = server_port
+        self.protocol = protocol
+        self.replay_config = replay_config
+        self.liveness = sharp_hems.liveness.LivenessWriter(liveness_file, liveness_flush_sec)
+
+        # NOTE: 購読側がサーバーの再起動を通し番号の巻き戻りと区別できるよう、起動時刻を添える
+        self.epoch = int(time.time()) & 0xFFFFFFFF
+        self.seq = 0
+        self.framer_list = []
+        self.replay_buffer = None
+        if replay_config is not None:
+            self.replay_buffer = sharp_hems.serial_pubsub.ReplayBuffer(
+                replay_config.get("count", sharp_hems.serial_pubsub.REPLAY_COUNT_DEFAULT),
+                replay_config.get("age_sec", sharp_hems.serial_pubsub.REPLAY_AGE_SEC_DEFAULT),
+            )
+
+        self._loop = None
+        self._stop = asyncio.Event()
+
+    def stop(self):
+        """サーバーを停止する。別スレッドやシグナルハンドラからも呼べる。"""
+        if self._loop is None:
+            self._stop.set()
+        else:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def run(self):
+        logging.info("Start serial server (engine: asyncio, protocol: %s)...", self.protocol)
+
+        self._loop = asyncio.get_running_loop()
+
+        context = zmq.asyncio.Context()
+        socket = context.socket(zmq.PUB)
+        socket.bind(f"tcp://*:{self.server_port}")
+
+        # NOTE: timeout=0 でノンブロッキングにして、読めるようになったらイベントループから通知を受ける
+        ser_list = [
+            serial.Serial(port, sharp_hems.serial_pubsub.SER_BAUD, timeout=0)
+            for port in self.serial_port_list
+        ]
+        self.framer_list = [sharp_hems.serial_pubsub.SerialFramer(ser) for ser in ser_list]
+
+        logging.info("Server initialize done.")
+
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                task_list = [
+                    task_group.create_task(self._read_serial(framer, source, socket))
+                    for source, framer in enumerate(self.framer_list)
+                ]
+                task_list.append(task_group.create_task(self._flush_liveness()))
+                task_list.append(task_group.create_task(self._report_stats()))
+                if self.replay_buffer is not None:
+                    task_list.append(task_group.create_task(self._serve_replay(context)))
+
+                await self._stop.wait()
+                for task in task_list:
+                    task.cancel()
+        finally:
+            for ser in ser_list:
+                ser.close()
+            socket.close(linger=0)
+            context.term()
+            self._flush_liveness_once()
+
+        logging.warning("Stop serial server")
+
+    async def _read_serial(self, framer, source, socket):
+        ser = framer.ser
+        readable = asyncio.Event()
+        self._loop.add_reader(ser.fileno(), readable.set)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(readable.wait(), sharp_hems.serial_pubsub.SER_TIMEOUT)
+                except TimeoutError:
+                    # NOTE: スレッド版の短読と同様、続きが届かないパケットは途中までのデータを捨てる
+                    framer.discard()
+                    continue
+                readable.clear()
+
+                data = ser.read(min(max(ser.in_waiting, 1), framer.read_size_max))
+                framer.read_count += 1
+                framer.feed(data)
+
+                while (packet := framer.pop_packet()) is not None:
+                    await self._publish(socket, source, *packet)
+        finally:
+            self._loop.remove_reader(ser.fileno())
+
+    async def _publish(self, socket, source, header, payload):
+        recv_time = time.time()
+        self.seq += 1
+
+        logging.debug("send #%d (source: %d) %s %s", self.seq, source, header.hex(), payload.hex())
+
+        frames = sharp_hems.serial_pubsub.encode_binary(
+            header, payload, self.epoch, self.seq, recv_time, source=source
+        )
+        if self.protocol != sharp_hems.serial_pubsub.PROTOCOL_TEXT:
+            await socket.send_multipart(frames)
+        if self.protocol != sharp_hems.serial_pubsub.PROTOCOL_BINARY:
+            await socket.send_string(sharp_hems.serial_pubsub.encode_text(header, payload))
+        if self.replay_buffer is not None:
+            self.replay_buffer.append(self.seq, recv_time, frames)
+
+        self.liveness.touch(recv_time)
+
+    async def _serve_replay(self, context):
+        replay_port = self.replay_config["port"]
+
+        socket = context.socket(zmq.ROUTER)
+        socket.bind(f"tcp://*:{replay_port}")
+
+        logging.info("Start replay server (port: %d)", replay_port)
+        try:
+            while True:
+                reply = sharp_hems.serial_pubsub.replay_reply(
+                    await socket.recv_multipart(), self.replay_buffer, self.epoch
+                )
+                if reply is not None:
+                    await socket.send_multipart(reply)
+        finally:
+            socket.close(linger=0)
+            logging.info("Stop replay server")
+
+    async def _flush_liveness(self):
+        while True:
+            await asyncio.sleep(self.liveness.flush_sec)
+            self._flush_liveness_once()
+
+    def _flush_liveness_once(self):
+        try:
+            self.liveness.flush()
+        except Exception:
+            logging.exception("Failed to update liveness file: %s", self.liveness.path)
+
+    async def _report_stats(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL_SEC)
+            for source, framer in enumerate(self.framer_list):
+                logging.info(
+                    "Serial stats (source: %d, reads: %d, skipped: %d byte(s), short: %d)",
+                    source,
+                    framer.read_count,
+                    framer.skip_bytes,
+                    framer.short_count,
+                )
+            logging.info("Serial stats (packets: %d)", self.seq)
+
+
+def start_server(  # noqa: PLR0913
+    serial_port,
+    server_port,
+    liveness_file,
+    protocol=sharp_hems.serial_pubsub.PROTOCOL_BINARY,
+    replay_config=None,
+    *,
+    liveness_flush_sec=sharp_hems.liveness.FLUSH_SEC_DEFAULT,
+):
+    """serial_pubsub.start_server の asyncio 版。stop_server() が呼ばれるまで戻らない。"""
+    global _server, _stop_pending  # noqa: PLW0603
+
+    server = AsyncSerialServer(
+        serial_port,
+        server_port,
+        liveness_file,
+        protocol,
+        replay_config,
+        liveness_flush_sec=liveness_flush_sec,
+    )
+    with _server_lock:
+        _server = server
+        if _stop_pending:
+            _stop_pending = False
+            server.stop()
+    try:
+        asyncio.run(server.run())
+    finally:
+        with _server_lock:
+            _server = None
+
+
+def stop_server():
+    """サーバーを停止する。start_server() の前に呼ばれた場合は、次に起動したサーバーをすぐに止める。"""
+    global _stop_pending  # noqa: PLW0603
+
+    with _server_lock:
+        if _server is None:
+            _stop_pending = True
+        else:
+            _server.stop()
@@ -3,70 +3,616 @@
 センサーからのパケットを Pub-Sub パターンで配信します。
 
 Usage:
-  serial_pubsub.py -S [-t SERIAL_PORT] [-p SERVER_PORT] [-D]
-  serial_pubsub.py [-s SERVER_HOST] [-p SERVER_PORT] [-c CONFIG] [-D]
+  serial_pubsub.py -S [-t SERIAL_PORT] [-p SERVER_PORT] [-P PROTOCOL] [-D]
+  serial_pubsub.py [-s SERVER_HOST] [-p SERVER_PORT] [-P PROTOCOL] [-c CONFIG] [-D]
 
 Options:
   -S                : サーバーモードで動作します。
   -s SERVER_HOST    : サーバーのホスト名を指定します。 [default: localhost]
-  -t SERIAL_PORT    : HEMS 中継器を接続するシリアルポートを指定します。 [default: /dev/ttyUSB0]
+  -t SERIAL_PORT    : HEMS 中継器を接続するシリアルポートを指定します (複数の場合はカンマ区切り)。
+                      [default: /dev/ttyUSB0]
   -p SERVER_PORT    : ZeroMQ の Pub サーバーを動作させるポートを指定します。 [default: 4444]
+  -P PROTOCOL       : 配信形式 (binary / text / compat) を指定します。省略時はサーバーが compat、
+                      クライアントが binary です。
   -c CONFIG         : 設定ファイルを指定します。 [default: config.yaml]
   -D                : デバッグモードで動作します。
 """
 
+import collections
+import functools
+import json
 import logging
+import pathlib
+import queue
+import struct
 import threading
+import time
+import typing
+import weakref
 
-import my_lib.footprint
 import serial
 import zmq
 
+import sharp_hems.liveness
+
+# 旧形式 (テキスト) のチャンネル。"serial {header_hex} {payload_hex}" を送る。
 CH = "serial"
+# バイナリ形式のチャンネル。パケット種別毎に "bin.serial.2c" のようなトピックで配信するので、
+# 購読者は種別を指定すれば不要なパケットを libzmq 側で捨てられる。
+# NOTE: 旧購読者は "serial" で前方一致購読しているため、"serial" で始まらない名前にする
+CH_BINARY = "bin.serial"
+
+# 配信形式。compat はローリングアップデート中に旧購読者を動かし続けるため、
+# バイナリとテキストの両方を配信する (サーバーのみ)。
+# NOTE: 旧購読者が残っていても止まらないよう、サーバーのコマンド (-P) の既定は compat にする
+PROTOCOL_BINARY = "binary"
+PROTOCOL_TEXT = "text"
+PROTOCOL_COMPAT = "compat"
+PROTOCOL_LIST = [PROTOCOL_BINARY, PROTOCOL_TEXT, PROTOCOL_COMPAT]
+
+# バイナリ形式は [トピック, ヘッダ, ペイロード, メタデータ] のマルチパートで送る。
+# メタデータは固定長で、先頭 1 バイトがバージョン。
+# - v1: [バージョン]
+# - v2: [バージョン, サーバー起動時刻 (epoch), 通し番号 (seq), サーバーでの受信時刻]
+# - v3: v2 の予約領域の先頭 1 バイトに送信元 (コントローラー番号) を追加
+# NOTE: v3 はレイアウトを変えていないので、v2 の購読者もそのまま読める
+BINARY_VERSION = 3
+BINARY_META = struct.Struct("<BB2xIQd")
+_BINARY_META_V2 = struct.Struct("<B3xIQd")
+_BINARY_META_HEAD = struct.Struct("<B")
+
+# 再送要求は [サーバーの epoch, 最後に受信した seq] で、応答は保持しているフレームを
+# 4 つずつ (バイナリ形式と同じ並び) 連結したマルチパート。
+REPLAY_REQUEST = struct.Struct("<IQ")
+REPLAY_COUNT_DEFAULT = 1000
+REPLAY_AGE_SEC_DEFAULT = 3600
+REPLAY_TIMEOUT_MS = 5000
+
+# 受信スレッドと処理スレッドの間のキューに溜められるパケット数
+QUEUE_SIZE_DEFAULT = 10000
+
+# 送信元 (コントローラー番号) の最大値。メタデータでは 1 バイトで表す。
+SOURCE_MAX = 0xFF
+
 SER_BAUD = 115200
 SER_TIMEOUT = 5
 
 # パケット先頭の同期バイト。ヘッダは [0xFE, 種別] の 2 バイトで、
 # ペイロード長は 種別 + 3 バイト。
 SER_SYNC_BYTE = 0xFE
+SER_HEADER_LEN = 2
+# 1 回の read() で読み出す最大バイト数
+SER_READ_SIZE_MAX = 4096
 
 should_terminate_server = threading.Event()
 should_terminate_client = threading.Event()
 
 
+class SerialFramer:
+    """
+    シリアルのバイト列からパケットを切り出すフレーマー。
+
+    UART バッファに溜まっている分 (in_waiting) をまとめて読み出して内部バッファに
+    追記し、同期バイトを bytes.find で探してフレームを切り出す。1 パケット毎に
+    複数回 read() を呼ぶことが無いので、ノイズの多い回線でもシステムコールが増えない。
+    """
+
+    def __init__(self, ser, read_size_max=SER_READ_SIZE_MAX):
+        """フレーマーを初期化します。"""
+        self.ser = ser
+        self.read_size_max = read_size_max
+
+        self._buf = bytearray()
+        # NOTE: _buf のうち処理済みの位置。読み出しの直前にまとめて詰める
+        self._pos = 0
+
+        self.read_count = 0
+        self.skip_bytes = 0
+        self.short_count = 0
+
+    def read_packet(self):
+        """
+        1 パケットを (header, payload) で返す。
+
+        同期バイトより前のゴミは読み捨てて再同期する。タイムアウト (短読) までに
+        パケットが揃わなかった場合は、途中までのデータを破棄して None を返す。
+        """
+        while True:
+            packet = self._extract()
+            if packet is not None:
+                return packet
+
+            if not self._fill():
+                packet = self._extract()
+                if packet is None:
+                    self.discard()
+                return packet
+
+    def feed(self, data):
+        """
+        読み出し済みのバイト列を内部バッファに追記する。
+
+        シリアルを自前で読む場合 (asyncio 版のサーバー等) に、pop_packet() と組み合わせて使う。
+        """
+        if self._pos != 0:
+            del self._buf[: self._pos]
+            self._pos = 0
+
+        self._buf += data
+
+    def pop_packet(self):
+        """内部バッファから 1 パケットを (header, payload) で取り出す。揃っていなければ None。"""
+        return self._extract()
+
+    def _need(self):
+        """次のパケットを完成させるのに不足しているバイト数。"""
+        remain = len(self._buf) - self._pos
+        if remain < SER_HEADER_LEN:
+            return SER_HEADER_LEN - remain
+        return SER_HEADER_LEN + self._buf[self._pos + 1] + 3 - remain
+
+    def _fill(self):
+        """シリアルから読み出して内部バッファに追記する。要求分を読めなければ False。"""
+        # NOTE: in_waiting が取れないポート (テスト用のモック等) では不足分だけ読む
+        size = max(self._need(), min(getattr(self.ser, "in_waiting", 0), self.read_size_max))
+        data = self.ser.read(size)
+        self.read_count += 1
+        self.feed(data)
+
+        return len(data) == size
+
+    def _extract(self):
+        buf = self._buf
+
+        start = buf.find(SER_SYNC_BYTE, self._pos)
+        if start < 0:
+            self._skip(len(buf))
+            return None
+        if start != self._pos:
+            self._skip(start)
+
+        if len(buf) - start < SER_HEADER_LEN:
+            return None
+
+        end = start + SER_HEADER_LEN + buf[start + 1] + 3
+        if len(buf) < end:
+            return None
+
+        with memoryview(buf) as view:
+            header = bytes(view[start : start + SER_HEADER_LEN])
+            payload = bytes(view[start + SER_HEADER_LEN : end])
+        self._pos = end
+
+        return (header, payload)
+
+    def _skip(self, end):
+        logging.debug("Skip %d unexpected byte(s) (resync)", end - self._pos)
+        self.skip_bytes += end - self._pos
+        self._pos = end
+
+    def discard(self):
+        """揃わなかったパケットの途中までのデータを破棄する。"""
+        remain = len(self._buf) - self._pos
+        if remain == 0:
+            return
+
+        # NOTE: 同期バイトの直後で途切れたものは、ノイズの可能性が高いので debug に留める
+        if remain < SER_HEADER_LEN:
+            logging.debug("Short packet (no type byte)")
+        else:
+            expected = self._buf[self._pos + 1] + 3
+            logging.warning(
+                "Short packet (expected %d bytes, got %d), discard", expected, remain - SER_HEADER_LEN
+            )
+        self.short_count += 1
+        self._pos = len(self._buf)
+
+
+_framer_map = weakref.WeakKeyDictionary()
+
+
 def read_packet(ser):
     """
     シリアルから 1 パケット読み出す。
 
-    同期バイトが現れるまで 1 バイトずつ読み捨てることで、ノイズや途中起動で
-    ストリーム位置がずれても次のパケット境界で再同期できる。
-    タイムアウトや短読の場合は None を返す。
+    ポート毎の SerialFramer を使い回すので、先読みしたデータは次の呼び出しに
+    引き継がれる。タイムアウトや短読の場合は None を返す。
     """
-    sync = ser.read(1)
-    if len(sync) == 0:
-        return None
-    if sync[0] != SER_SYNC_BYTE:
-        logging.debug("Skip unexpected byte: 0x%02X (resync)", sync[0])
-        return None
+    framer = _framer_map.get(ser)
+    if framer is None:
+        framer = SerialFramer(ser)
+        _framer_map[ser] = framer
 
-    packet_type = ser.read(1)
-    if len(packet_type) == 0:
-        logging.debug("Short packet (no type byte)")
-        return None
+    return framer.read_packet()
+
+
+def binary_topic(packet_type, source=None):
+    """
+    パケット種別に対応するバイナリ形式のトピック。
+
+    配信するトピックは "bin.serial.{種別}.{送信元}" で、source を省略すると
+    全送信元を前方一致で購読するためのプレフィックスになる。
+    """
+    if source is None:
+        return f"{CH_BINARY}.{packet_type:02x}"
+    return f"{CH_BINARY}.{packet_type:02x}.{source:02x}"
+
+
+def text_topic(packet_type):
+    """
+    パケット種別に対応する旧形式 (テキスト) の購読プレフィックス。
+
+    旧形式はヘッダの 16 進表記がチャンネル名の直後に来るので、それを前方一致に使う。
+    """
+    return f"{CH} {SER_SYNC_BYTE:02x}{packet_type:02x}"
+
+
+@functools.cache
+def _binary_topic_list(source):
+    # NOTE: パケット毎にトピック文字列を組み立てないよう、送信元毎に全種別分を作っておく
+    return [binary_topic(packet_type, source).encode() for packet_type in range(0x100)]
+
+
+class PacketMeta(typing.NamedTuple):
+    """
+    バイナリ形式のメタデータ。
+
+    v1 のサーバーから受信した場合は epoch 以降が、v2 の場合は source が None。
+    """
+
+    version: int
+    epoch: int | None = None
+    seq: int | None = None
+    recv_time: float | None = None
+    source: int | None = None
+
+
+def encode_binary(header, payload, epoch=0, seq=0, recv_time=0.0, *, source=0):  # noqa: PLR0913
+    """バイナリ形式のマルチパートフレームを作る。"""
+    return [
+        _binary_topic_list(source)[header[1]],
+        header,
+        payload,
+        BINARY_META.pack(BINARY_VERSION, source, epoch, seq, recv_time),
+    ]
+
+
+def decode_meta(meta):
+    """メタデータフレームを PacketMeta に戻す。"""
+    # NOTE: 新しいバージョンでは末尾にフィールドを追加するので、知っている部分だけ読む
+    (version,) = _BINARY_META_HEAD.unpack_from(meta)
+    if version < 1:
+        msg = f"Unsupported protocol version: {version}"
+        raise ValueError(msg)
+    if version == 1:
+        return PacketMeta(version)
+    if version == 2:
+        return PacketMeta(*_BINARY_META_V2.unpack_from(meta))
+
+    version, source, epoch, seq, recv_time = BINARY_META.unpack_from(meta)
+    return PacketMeta(version, epoch, seq, recv_time, source)
+
+
+def decode_binary(frames):
+    """バイナリ形式のマルチパートフレームを (header, payload) に戻す。"""
+    _topic, header, payload, meta = frames
+    decode_meta(meta)
+
+    return header, payload
+
+
+# NOTE: 旧形式 (テキスト) はメタデータを持たないので、受信数の集計だけに使う
+_TEXT_META = PacketMeta(0)
+
+
+class StreamStats:
+    """
+    購読側での配信ロスの集計。
+
+    サーバーが付ける通し番号の欠番を数えることで、ZeroMQ の HWM 超過や再接続で
+    捨てられたメッセージ (配信ロス) を、センサーの無線区間のロスと区別できるようにする。
+    """
+
+    def __init__(self):
+        """集計を初期化します。"""
+        self.received = 0
+        self.lost = 0
+        self.restart = 0
+        self.epoch = None
+        self.last_seq = None
+        self.last_meta = None
+        # NOTE: 通し番号はサーバー全体で振るので、トピックを絞って購読すると欠番をロスとは判断できない
+        self.count_gap = True
+
+        self._reported = (0, 0)
+
+    def update(self, meta):
+        """受信したメッセージのメタデータを反映し、今回検出した欠番の数を返す。"""
+        self.received += 1
+        self.last_meta = meta
+
+        if meta.seq is None:
+            # NOTE: v1 のサーバーは通し番号を付けないので、受信数だけ数える
+            return 0
+
+        lost = 0
+        if meta.epoch != self.epoch:
+            if self.epoch is not None:
+                logging.info("Server restarted (epoch: %d → %d)", self.epoch, meta.epoch)
+                self.restart += 1
+            self.epoch = meta.epoch
+        elif meta.seq > self.last_seq and self.count_gap:
+            lost = meta.seq - self.last_seq - 1
+            if lost != 0:
+                logging.warning(
+                    "Lost %d message(s) in transport (seq: %d → %d)", lost, self.last_seq, meta.seq
+                )
+                self.lost += lost
+
+        self.last_seq = meta.seq
+
+        return lost
+
+    def is_duplicate(self, meta):
+        """再送で受け取り済みのメッセージかどうか。"""
+        return (
+            meta.seq is not None
+            and self.last_seq is not None
+            and meta.epoch == self.epoch
+            and meta.seq <= self.last_seq
+        )
+
+    def take_delta(self):
+        """前回呼び出し時からの (受信数, 欠番数) を返す。"""
+        # NOTE: 受信スレッドが並行して更新するので、1 度だけ読む
+        current = (self.received, self.lost)
+        delta = (current[0] - self._reported[0], current[1] - self._reported[1])
+        self._reported = current
+        return delta
+
+    def load_position(self, position_file):
+        """保存しておいた受信位置 (epoch, seq) を読み込む。"""
+        position_file = pathlib.Path(position_file)
+        if not position_file.exists():
+            return
+
+        try:
+            position = json.loads(position_file.read_text())
+            self.epoch = position["epoch"]
+            self.last_seq = position["seq"]
+        except Exception:
+            logging.exception("Failed to load stream position, starting fresh")
+            return
+
+        logging.info("Load stream position (epoch: %d, seq: %d)", self.epoch, self.last_seq)
+
+    def save_position(self, position_file, meta=None):
+        """
+        受信位置 (epoch, seq) を保存する。
+
+        meta を指定すると、最後に受信したものではなく、その位置を保存する。
+        """
+        epoch, seq = (self.epoch, self.last_seq) if meta is None else (meta.epoch, meta.seq)
+        if seq is None:
+            return
+
+        position_file = pathlib.Path(position_file)
+        tmp_file = position_file.with_name(position_file.name + ".tmp")
+        tmp_file.write_text(json.dumps({"epoch": epoch, "seq": seq}))
+        tmp_file.replace(position_file)
+
+
+class ReplayBuffer:
+    """
+    後から接続した購読者向けに、直近に配信したフレームを保持するリングバッファ。
+
+    件数 (count) と経過時間 (age_sec) の両方で上限を設ける。配信スレッドと再送スレッドから
+    アクセスされるのでロックで保護する。
+    """
+
+    def __init__(self, count=REPLAY_COUNT_DEFAULT, age_sec=REPLAY_AGE_SEC_DEFAULT):
+        """バッファを初期化します。"""
+        self.age_sec = age_sec
+        self._entry_list = collections.deque(maxlen=count)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """保持しているフレーム数を返します。"""
+        return len(self._entry_list)
+
+    def append(self, seq, recv_time, frames):
+        with self._lock:
+            self._entry_list.append((seq, recv_time, frames))
+            while self._entry_list[0][1] < recv_time - self.age_sec:
+                self._entry_list.popleft()
+
+    def since(self, seq, now=None):
+        """通し番号が seq より大きく、保持期間内のフレームを古い順に返す。"""
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            entry_list = list(self._entry_list)
+
+        return [
+            frames
+            for entry_seq, recv_time, frames in entry_list
+            if entry_seq > seq and recv_time >= now - self.age_sec
+        ]
+
+
+class PacketQueue:
+    """
+    購読側の受信スレッドと処理スレッドの間のキュー。
 
-    header = sync + packet_type
-    payload_len = header[1] + 3
-    payload = ser.read(payload_len)
-    if len(payload) != payload_len:
-        logging.warning("Short packet (expected %d bytes, got %d), discard", payload_len, len(payload))
+    処理 (Fluentd への送信や SQLite の更新) が詰まってもソケットからの受信を止めないよう、
+    満杯の時は待たずに捨てて数える。深さと破棄数を公開して、詰まりを見えるようにする。
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE_DEFAULT):
+        """キューと集計を初期化します。"""
+        self.maxsize = maxsize
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.depth_max = 0
+        # NOTE: 処理し終えたパケットのメタデータ。再送用の受信位置はこれを保存する
+        self.last_meta = None
+        # NOTE: 処理中のパケットのメタデータ。サーバーでの受信時刻 (recv_time) を計測値の時刻にする
+        self.current_meta = None
+
+        self._queue = queue.Queue(maxsize)
+        self._reported_dropped = 0
+
+    @property
+    def depth(self):
+        """キューに溜まっているパケット数。"""
+        return self._queue.qsize()
+
+    def put(self, packet):
+        """パケットを積む。満杯なら捨てて False を返す。"""
+        try:
+            self._queue.put_nowait(packet)
+        except queue.Full:
+            if self.dropped == self._reported_dropped:
+                logging.warning("Receive queue is full (size: %d), drop packets", self.maxsize)
+            self.dropped += 1
+            return False
+
+        self.received += 1
+        self.depth_max = max(self.depth_max, self._queue.qsize())
+        return True
+
+    def get(self, timeout):
+        """パケットを 1 つ取り出す。timeout 秒待っても無ければ queue.Empty。"""
+        packet = self._queue.get(timeout=timeout)
+        self.processed += 1
+        return packet
+
+    def take_dropped(self):
+        """前回呼び出し時からの破棄数を返す。"""
+        delta = self.dropped - self._reported_dropped
+        self._reported_dropped = self.dropped
+        return delta
+
+
+def _start_replay(context, replay_config, epoch):
+    """再送用のバッファとスレッドを用意する。replay_config が無ければ (None, None)。"""
+    if replay_config is None:
+        return None, None
+
+    replay_buffer = ReplayBuffer(
+        replay_config.get("count", REPLAY_COUNT_DEFAULT),
+        replay_config.get("age_sec", REPLAY_AGE_SEC_DEFAULT),
+    )
+    replay_thread = threading.Thread(
+        target=_serve_replay, args=(context, replay_config["port"], replay_buffer, epoch), daemon=True
+    )
+    replay_thread.start()
+
+    return replay_buffer, replay_thread
+
+
+def _serve_replay(context, replay_port, replay_buffer, epoch):
+    """再送要求を ROUTER ソケットで受け付ける (サーバーの別スレッドで動作)。"""
+    socket = context.socket(zmq.ROUTER)
+    socket.setsockopt(zmq.RCVTIMEO, 1000)
+    socket.bind(f"tcp://*:{replay_port}")
+
+    logging.info("Start replay server (port: %d)", replay_port)
+
+    while not should_terminate_server.is_set():
+        try:
+            reply = replay_reply(socket.recv_multipart(), replay_buffer, epoch)
+        except zmq.error.Again:
+            continue
+
+        if reply is not None:
+            socket.send_multipart(reply)
+
+    socket.close(linger=0)
+    logging.info("Stop replay server")
+
+
+def replay_reply(message, replay_buffer, epoch):
+    """ROUTER ソケットで受けた再送要求に対する応答を作る。要求が不正なら None。"""
+    try:
+        identity, _empty, request = message
+    except ValueError:
+        logging.warning("Invalid replay request, ignore")
         return None
 
-    return (header, payload)
+    try:
+        req_epoch, req_seq = REPLAY_REQUEST.unpack(request)
+    except struct.error:
+        logging.warning("Invalid replay request: %s", request.hex())
+        req_epoch, req_seq = epoch, 0xFFFFFFFFFFFFFFFF
+
+    # NOTE: 前回起動時の位置が指定された場合は、今回起動後の全フレームが未受信
+    frame_list = replay_buffer.since(req_seq if req_epoch == epoch else 0)
+    logging.info("Replay %d frame(s) after seq %d (epoch: %d)", len(frame_list), req_seq, req_epoch)
+
+    return [identity, b"", *(frame for frames in frame_list for frame in frames)]
+
+
+def request_replay(context, server_host, replay_port, epoch, seq):
+    """サーバーに再送を要求し、(epoch, seq) より後のフレームのリストを返す。"""
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.RCVTIMEO, REPLAY_TIMEOUT_MS)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(f"tcp://{server_host}:{replay_port}")
+
+    try:
+        socket.send(REPLAY_REQUEST.pack(epoch or 0, seq or 0))
+        frames = socket.recv_multipart()
+    except zmq.error.Again:
+        logging.warning("No response from replay server (%s:%d)", server_host, replay_port)
+        return []
+    finally:
+        socket.close()
+
+    return [frames[i : i + 4] for i in range(0, len(frames), 4)]
 
 
-def start_server(serial_port, server_port, liveness_file):
+def encode_text(header, payload):
+    """旧形式 (テキスト) のメッセージを作る。"""
+    return f"{CH} {header.hex()} {payload.hex()}"
+
+
+def decode_text(message):
+    """旧形式 (テキスト) のメッセージを (header, payload) に戻す。"""
+    _ch, header_hex, payload_hex = message.split(" ", 2)
+    return bytes.fromhex(header_hex), bytes.fromhex(payload_hex)
+
+
+def check_protocol(protocol, protocol_list):
+    if protocol not in protocol_list:
+        msg = f"Unknown protocol: {protocol} (expected {'/'.join(protocol_list)})"
+        raise ValueError(msg)
+
+
+def start_server(  # noqa: PLR0913
+    serial_port,
+    server_port,
+    liveness_file,
+    protocol=PROTOCOL_BINARY,
+    replay_config=None,
+    *,
+    liveness_flush_sec=sharp_hems.liveness.FLUSH_SEC_DEFAULT,
+):
+    """
+    シリアルから読み出したパケットを配信する。
+
+    serial_port にリストかカンマ区切りで複数のポートを指定すると、それぞれを
+    送信元 0, 1, ... として 1 つの PUB ソケットから配信する。
+    replay_config (config.yaml の replay) を指定すると、直近のフレームを保持して
+    後から接続した購読者からの再送要求に応える。
+    liveness_file は liveness_flush_sec 毎にまとめて更新する。
+    """
+    check_protocol(protocol, PROTOCOL_LIST)
+
     global should_terminate_server
-    logging.info("Start serial server...")
+    logging.info("Start serial server (protocol: %s)...", protocol)
 
     should_terminate_server.clear()
     context = zmq.Context()
@@ -74,61 +620,272 @@ def start_server(serial_port, server_port, liveness_file):
     socket = context.socket(zmq.PUB)
     socket.bind(f"tcp://*:{server_port}")
 
-    ser = serial.Serial(serial_port, SER_BAUD, timeout=SER_TIMEOUT)
+    # NOTE: ポート毎に読み出しスレッドを立て、配信は ZeroMQ のソケットを持つこのスレッドで行う
+    packet_queue = queue.Queue()
+    ser_list = [serial.Serial(port, SER_BAUD, timeout=SER_TIMEOUT) for port in serial_port_list(serial_port)]
+    reader_list = [
+        threading.Thread(target=_read_serial, args=(ser, source, packet_queue), daemon=True)
+        for source, ser in enumerate(ser_list)
+    ]
 
-    logging.info("Server initialize done.")
+    liveness = sharp_hems.liveness.LivenessWriter(liveness_file, liveness_flush_sec)
+    liveness.start()
 
-    while True:
-        if should_terminate_server.is_set():
-            break
+    # NOTE: 購読側がサーバーの再起動を通し番号の巻き戻りと区別できるよう、起動時刻を添える
+    epoch = int(time.time()) & 0xFFFFFFFF
+    seq = 0
 
-        packet = read_packet(ser)
-        if packet is None:
-            continue
+    replay_buffer, replay_thread = _start_replay(context, replay_config, epoch)
 
-        header, payload = packet
-        header_hex = header.hex()
-        payload_hex = payload.hex()
+    for reader in reader_list:
+        reader.start()
 
-        logging.debug("send %s %s", header_hex, payload_hex)
-        socket.send_string(f"{CH} {header_hex} {payload_hex}")
+    logging.info("Server initialize done.")
 
-        my_lib.footprint.update(liveness_file)
+    try:
+        while not should_terminate_server.is_set():
+            try:
+                item = packet_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if isinstance(item, Exception):
+                raise item
+
+            source, recv_time, header, payload = item
+            seq += 1
+
+            logging.debug("send #%d (source: %d) %s %s", seq, source, header.hex(), payload.hex())
+
+            frames = encode_binary(header, payload, epoch, seq, recv_time, source=source)
+            if protocol != PROTOCOL_TEXT:
+                socket.send_multipart(frames)
+            if protocol != PROTOCOL_BINARY:
+                socket.send_string(encode_text(header, payload))
+            if replay_buffer is not None:
+                replay_buffer.append(seq, recv_time, frames)
+
+            liveness.touch(recv_time)
+    finally:
+        should_terminate_server.set()
+        liveness.stop()
+        _stop_reader(ser_list, reader_list)
+        if replay_thread is not None:
+            replay_thread.join()
 
     logging.warning("Stop serial server")
 
 
+def serial_port_list(serial_port):
+    """
+    シリアルポートの指定をリストにする。
+
+    複数のコントローラーを接続する場合は、リストかカンマ区切りで指定する。
+    リスト内の位置が送信元 (コントローラー番号) になる。
+    """
+    if isinstance(serial_port, str):
+        serial_port = serial_port.split(",")
+    port_list = [str(port).strip() for port in serial_port]
+
+    if not 0 < len(port_list) <= SOURCE_MAX + 1:
+        msg = f"Number of serial ports must be 1 to {SOURCE_MAX + 1} (got {len(port_list)})"
+        raise ValueError(msg)
+
+    return port_list
+
+
+def _stop_reader(ser_list, reader_list):
+    for ser in ser_list:
+        # NOTE: 読み出し中のスレッドがタイムアウトを待たずに終われるようにする
+        if hasattr(ser, "cancel_read"):
+            ser.cancel_read()
+    for reader in reader_list:
+        reader.join()
+
+
+def _read_serial(ser, source, packet_queue):
+    """シリアルからパケットを読み出してキューに積む (ポート毎のスレッドで動作)。"""
+    framer = SerialFramer(ser)
+    try:
+        while not should_terminate_server.is_set():
+            packet = framer.read_packet()
+            if packet is not None:
+                packet_queue.put((source, time.time(), *packet))
+    except Exception as e:
+        logging.exception("Failed to read serial port (source: %d)", source)
+        # NOTE: 配信側のスレッドで例外を投げ直して、サーバー全体を止める
+        packet_queue.put(e)
+
+
 def stop_server():
     global should_terminate_server
 
     should_terminate_server.set()
 
 
-def start_client(server_host, server_port, handle, func):
+def start_client(  # noqa: PLR0913
+    server_host,
+    server_port,
+    handle,
+    func,
+    protocol=PROTOCOL_BINARY,
+    *,
+    packet_type_list=None,
+    source_list=None,
+    stats=None,
+    replay_port=None,
+    packet_queue=None,
+):
+    """
+    サーバーに接続して、受信したパケット毎に func(handle, header, payload) を呼ぶ。
+
+    packet_type_list を指定すると、その種別のパケットだけを購読する。
+    source_list を指定すると、その送信元 (コントローラー番号) のパケットだけを購読する。
+    stats に StreamStats を渡すと、配信ロスの集計をそこに記録する。
+    replay_port を指定すると、購読開始前に stats の受信位置より後のフレームを再送してもらう。
+    packet_queue に PacketQueue を渡すと、受信を別スレッドに分けて、func はキュー経由で呼ぶ。
+    """
     global should_terminate_client
-    logging.info("Start serial client...")
+    check_protocol(protocol, [PROTOCOL_BINARY, PROTOCOL_TEXT])
+    logging.info("Start serial client (protocol: %s)...", protocol)
 
     should_terminate_client.clear()
-    socket = zmq.Context().socket(zmq.SUB)
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
     socket.connect(f"tcp://{server_host}:{server_port}")
-    socket.setsockopt_string(zmq.SUBSCRIBE, CH)
+    topic_list = _topic_list(protocol, packet_type_list, source_list)
+    for topic in topic_list:
+        socket.setsockopt_string(zmq.SUBSCRIBE, topic)
     socket.setsockopt(zmq.RCVTIMEO, 1000)  # 1秒のタイムアウト
 
+    if stats is None:
+        stats = StreamStats()
+    stats.count_gap = (packet_type_list is None) and (source_list is None)
+
     logging.info("Client initialize done.")
 
+    if replay_port is not None:
+        if protocol == PROTOCOL_BINARY:
+            for header, payload in _replay(context, server_host, replay_port, topic_list, stats):
+                if packet_queue is not None:
+                    packet_queue.current_meta = stats.last_meta
+                func(handle, header, payload)
+        else:
+            logging.warning("Replay is only supported with the binary protocol, skip")
+
+    if packet_queue is None:
+        _receive_loop(socket, protocol, stats, functools.partial(func, handle))
+    else:
+        _process_queue(socket, protocol, stats, functools.partial(func, handle), packet_queue)
+
+    logging.warning("Stop serial client (received: %d, lost: %d)", stats.received, stats.lost)
+
+
+def _receive_loop(socket, protocol, stats, callback):
+    """stop_client() が呼ばれるまで受信し、パケット毎に callback(header, payload) を呼ぶ。"""
     while True:
         if should_terminate_client.is_set():
             logging.info("Terminate serial client")
             break
 
         try:
-            _ch, header_hex, payload_hex = socket.recv_string().split(" ", 2)
-            logging.debug("recv %s %s", header_hex, payload_hex)
-            func(handle, bytes.fromhex(header_hex), bytes.fromhex(payload_hex))
+            packet = _recv(socket, protocol, stats)
         except zmq.error.Again:
             continue
 
-    logging.warning("Stop serial client")
+        if packet is not None:
+            callback(*packet)
+
+
+def _process_queue(socket, protocol, stats, callback, packet_queue):
+    """受信スレッドでキューに積んだパケットを、このスレッドで処理する。"""
+    receiver = threading.Thread(
+        target=_receive_loop,
+        args=(
+            socket,
+            protocol,
+            stats,
+            lambda header, payload: packet_queue.put((header, payload, stats.last_meta)),
+        ),
+        daemon=True,
+    )
+    receiver.start()
+
+    try:
+        while not should_terminate_client.is_set():
+            try:
+                header, payload, meta = packet_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            packet_queue.current_meta = meta
+            callback(header, payload)
+            packet_queue.last_meta = meta
+    finally:
+        should_terminate_client.set()
+        receiver.join()
+
+    logging.info(
+        "Stop packet queue (processed: %d, dropped: %d, depth: %d, depth max: %d)",
+        packet_queue.processed,
+        packet_queue.dropped,
+        packet_queue.depth,
+        packet_queue.depth_max,
+    )
+
+
+def _recv(socket, protocol, stats):
+    """1 メッセージ受信して (header, payload) を返す。再送で処理済みのものは None。"""
+    if protocol == PROTOCOL_BINARY:
+        _topic, header, payload, meta_frame = socket.recv_multipart()
+        meta = decode_meta(meta_frame)
+        if stats.is_duplicate(meta):
+            return None
+        stats.update(meta)
+    else:
+        header, payload = decode_text(socket.recv_string())
+        stats.update(_TEXT_META)
+
+    logging.debug("recv %s %s", header.hex(), payload.hex())
+
+    return header, payload
+
+
+def _topic_list(protocol, packet_type_list, source_list=None):
+    if source_list is not None:
+        if protocol != PROTOCOL_BINARY:
+            msg = "Filtering by source is only supported with the binary protocol"
+            raise ValueError(msg)
+        if packet_type_list is None:
+            packet_type_list = range(0x100)
+        return [
+            binary_topic(packet_type, source) for source in source_list for packet_type in packet_type_list
+        ]
+
+    if packet_type_list is None:
+        return [CH_BINARY if protocol == PROTOCOL_BINARY else CH]
+
+    to_topic = binary_topic if protocol == PROTOCOL_BINARY else text_topic
+    return [to_topic(packet_type) for packet_type in packet_type_list]
+
+
+def _replay(context, server_host, replay_port, topic_list, stats):
+    """再送されたフレームを、購読中のトピックに絞って (header, payload) で順に返す。"""
+    topic_prefix = tuple(topic.encode() for topic in topic_list)
+
+    count = 0
+    for topic, header, payload, meta_frame in request_replay(
+        context, server_host, replay_port, stats.epoch, stats.last_seq
+    ):
+        if not topic.startswith(topic_prefix):
+            continue
+        meta = decode_meta(meta_frame)
+        if stats.is_duplicate(meta):
+            continue
+        stats.update(meta)
+        count += 1
+        yield header, payload
+
+    logging.info("Replayed %d packet(s)", count)
 
 
 def stop_client():
@@ -153,6 +910,7 @@ if __name__ == "__main__":
     server_host = args["-s"]
     server_port = int(args["-p"])
     serial_port = args["-t"]
+    protocol = args["-P"] or (PROTOCOL_COMPAT if is_server_mode else PROTOCOL_BINARY)
     debug_mode = args["-D"]
 
     my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
@@ -170,7 +928,9 @@ if __name__ == "__main__":
 
     if is_server_mode:
         logging.info("Start server")
-        start_server(serial_port, server_port, liveness_file)
+        start_server(serial_port, server_port, liveness_file, protocol)
     else:
         logging.info("Start client")
-        start_client(server_host, server_port, {"device": {"cache": dev_cache_file}}, process_packet)
+        start_client(
+            server_host, server_port, {"device": {"cache": dev_cache_file}}, process_packet, protocol
+        )
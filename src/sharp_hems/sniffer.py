@@ -6,6 +6,12 @@ import logging
 import pathlib
 import pickle
 import struct
+import typing
+
+import sharp_hems.dedupe
+import sharp_hems.energy
+import sharp_hems.frame_loss
+import sharp_hems.unknown_device
 
 # 電力に掛けるデフォルトの倍率
 # NOTE:
@@ -18,22 +24,118 @@ PACKET_TYPE_IEEE_ADDR = 0x08
 PACKET_TYPE_DEV_ID = 0x12
 PACKET_TYPE_MEASURE = 0x2C
 
+# 計測パケット (0x2C) のペイロードから読み出すフィールド。
+# dev_id (+3), カウンタ (+12), 現在時刻 (+17), 現在の積算電力 (+24), 前回時刻 (+33), 前回の積算電力 (+40)
+# NOTE: ヘッダと連結したりスライスしたりせず、1 回の unpack_from で全フィールドを取り出す
+MEASURE_STRUCT = struct.Struct("<3xH7xB4xH5xI5xH5xI")
+MEASURE_PAYLOAD_LEN = PACKET_TYPE_MEASURE + 3
+# process_batch で計測パケットの列をまとめて読み出す NumPy の構造化 dtype の定義 (名前, 型, オフセット)
+MEASURE_FIELD_LIST = [
+    ("dev_id", "<u2", 3),
+    ("counter", "u1", 12),
+    ("cur_time", "<u2", 17),
+    ("cur_power", "<u4", 24),
+    ("pre_time", "<u2", 33),
+    ("pre_power", "<u4", 40),
+]
+
+ADDR_UNKNOWN = "UNKNOWN"
+
+# dev_id キャッシュのジャーナルがこの件数に達したら、スナップショットに畳み込む
+JOURNAL_COMPACT_COUNT = 100
+
+
+class Measurement(typing.NamedTuple):
+    """計測パケットから復元した計測値。"""
+
+    addr: str
+    dev_id: int
+    cur_time: int
+    cur_power: int
+    pre_time: int
+    pre_power: int
+    watt: float
+    # NOTE: device.yaml で定義されたデバイス名 (レジストリが無い・未定義なら None)
+    name: str | None = None
+    # NOTE: 積算電力カウンタから求めた、デバイスの積算電力量 (kWh, IEEE アドレスが未学習なら None)
+    energy_kwh: float | None = None
+
+    @property
+    def dev_id_str(self):
+        return f"0x{self.dev_id:04X}"
+
+    def to_dict(self):
+        """ログ出力などに使う dict 形式に変換する。"""
+        return {**self._asdict(), "dev_id_str": self.dev_id_str}
+
+
+class DeviceEntry(typing.NamedTuple):
+    """dev_id から解決したデバイスの情報 (IEEE アドレス・デバイス名・電力倍率)。"""
+
+    addr: str
+    name: str | None
+    scale: float
+
+
+class MeasureBatch(typing.NamedTuple):
+    """
+    process_batch で復元した計測値の列 (列指向)。
+
+    addr_index は addr_list の添字で、各配列は重複を除いた計測パケットの受信順に並ぶ。
+    """
+
+    addr_list: list
+    addr_index: typing.Any
+    dev_id: typing.Any
+    cur_time: typing.Any
+    cur_power: typing.Any
+    pre_time: typing.Any
+    pre_power: typing.Any
+    watt: typing.Any
+    # NOTE: 各計測値の時点の積算電力量 (kWh, IEEE アドレスが未学習なら NaN)
+    energy_kwh: typing.Any
+
+    def __len__(self):
+        """計測値の数を返す。"""
+        return len(self.watt)
+
+    def addr(self):
+        """各計測値の IEEE アドレスの列を返す。"""
+        return [self.addr_list[index] for index in self.addr_index.tolist()]
+
 
 def dump_packet(data):
-    return ",".join(f"{x:02X}" for x in list(data))
+    # NOTE: 計測パケット毎に DEBUG ログの引数として評価されるので、C 実装の hex() で整形する
+    return bytes(data).hex(",").upper()
 
 
 def parse_packet_ieee_addr(packet):
-    return ":".join(f"{x:02X}" for x in reversed(list(packet[4:12])))
+    return bytes(packet[11:3:-1]).hex(":").upper()
+
+
+def journal_path(dev_cache_file):
+    """dev_id キャッシュ (スナップショット) に対応するジャーナルのパスを返す。"""
+    dev_cache_file = pathlib.Path(dev_cache_file)
+    return dev_cache_file.with_name(dev_cache_file.name + ".journal")
 
 
 def read_dev_id_map(dev_cache_file):
     """
     dev_id キャッシュを読み込み、(dev_id_map, is_legacy_format) を返す。
 
-    JSON 形式を優先し、旧フォーマット (pickle) にもフォールバックする。
+    スナップショットは JSON 形式を優先し、旧フォーマット (pickle) にもフォールバックする。
+    その上にジャーナル (追記された変更) を順に適用する。
     """
     dev_cache_file = pathlib.Path(dev_cache_file)
+    dev_id_map, is_legacy = _read_snapshot(dev_cache_file)
+
+    for dev_id, addr in read_journal(journal_path(dev_cache_file)):
+        dev_id_map[dev_id] = addr
+
+    return dev_id_map, is_legacy
+
+
+def _read_snapshot(dev_cache_file):
     if not dev_cache_file.exists():
         return {}, False
 
@@ -47,6 +149,24 @@ def read_dev_id_map(dev_cache_file):
     return pickle.loads(raw), True  # noqa: S301
 
 
+def read_journal(journal_file):
+    """ジャーナルを読み込み、(dev_id, addr) の列を返す。"""
+    journal_file = pathlib.Path(journal_file)
+    if not journal_file.exists():
+        return []
+
+    record_list = []
+    for line in journal_file.read_text().splitlines():
+        try:
+            record = json.loads(line)
+            record_list.append((int(record["dev_id"]), record["addr"]))
+        except (ValueError, KeyError, TypeError):
+            # NOTE: 追記中のプロセス異常終了で途切れた行は読み飛ばす
+            logging.warning("Skip broken dev_id journal record: %s", line)
+
+    return record_list
+
+
 def parse_packet_dev_id(packet):
     dev_id = struct.unpack("<H", packet[4:6])[0]
     index = packet[6]
@@ -65,17 +185,38 @@ class PacketSniffer:
     送信するため、その順序対応からマッピングを構築する。
     """
 
-    def __init__(self, dev_cache_file, watt_scale=WATT_SCALE_DEFAULT, scale_resolver=None):
+    def __init__(self, dev_cache_file, watt_scale=WATT_SCALE_DEFAULT, scale_resolver=None, *, registry=None):
         """スニッファを初期化します。"""
         self.dev_cache_file = pathlib.Path(dev_cache_file)
         self.watt_scale = watt_scale
+        # NOTE: デバイス名と倍率を引く device.DeviceRegistry (無ければ None)
+        self.registry = registry
         # NOTE: IEEE アドレスからデバイス固有の倍率を返す callable (無ければ None)
+        if (scale_resolver is None) and (registry is not None):
+            scale_resolver = registry.get_scale
         self.scale_resolver = scale_resolver
 
+        self.journal_file = journal_path(self.dev_cache_file)
+        self.journal_count = 0
         self.dev_id_map = self._load_dev_id_map()
-        self.counter_hist = {}
+        self.unknown_tracker = sharp_hems.unknown_device.UnknownDeviceTracker(
+            sharp_hems.unknown_device.state_path(self.dev_cache_file)
+        )
+        self.unknown_tracker.prune(self.dev_id_map)
+        # NOTE: dev_id → DeviceEntry の解決結果 (registry がある場合のみ)。
+        #       dev_id_map の更新やレジストリの再読み込みで作り直す
+        self.device_index = {}
+        self._index_generation = None
+        # NOTE: 再起動直後に届いた重複もはじけるよう、状態はファイルに書き出しておく
+        self.dedupe = sharp_hems.dedupe.DedupeState(sharp_hems.dedupe.state_path(self.dev_cache_file))
+        self.energy = sharp_hems.energy.EnergyMeter(sharp_hems.energy.state_path(self.dev_cache_file))
+        # NOTE: カウンタの欠番から数える無線区間のロス (メモリ上のみ)
+        self.frame_loss = sharp_hems.frame_loss.FrameLossStats()
         self.ieee_addr_list = []
         self.last_packet_type = None
+        # NOTE: 計測パケットの数と、そのうち重複として捨てた数 (再生時のレポート用)
+        self.measure_count = 0
+        self.duplicate_count = 0
 
     # ---------- dev_id キャッシュ ----------
 
@@ -90,6 +231,9 @@ class PacketSniffer:
             # NOTE: 旧フォーマット (pickle) からの移行
             logging.info("Migrate dev_id_map from pickle to JSON")
             self._store_dev_id_map(dev_id_map)
+        elif self.journal_file.exists():
+            # NOTE: 前回の実行で残ったジャーナルは、起動時にスナップショットへ畳み込む
+            self._store_dev_id_map(dev_id_map)
 
         return dev_id_map
 
@@ -104,6 +248,25 @@ class PacketSniffer:
         tmp_file.write_text(json.dumps({str(dev_id): addr for dev_id, addr in dev_id_map.items()}, indent=2))
         tmp_file.replace(self.dev_cache_file)
 
+        # NOTE: スナップショットに反映済みなので捨てる。削除前に異常終了しても、
+        # 同じ内容を再適用するだけなので問題ない
+        self.journal_file.unlink(missing_ok=True)
+        self.journal_count = 0
+
+    def _append_dev_id(self, dev_id, addr):
+        """対応の変更 1 件をジャーナルに追記し、溜まったらスナップショットに畳み込む。"""
+        if not self.dev_cache_file.exists():
+            self._store_dev_id_map()
+            return
+
+        with self.journal_file.open("a") as f:
+            f.write(json.dumps({"dev_id": dev_id, "addr": addr}) + "\n")
+        self.journal_count += 1
+
+        if self.journal_count >= JOURNAL_COMPACT_COUNT:
+            logging.info("Compact dev_id journal (%d records)", self.journal_count)
+            self._store_dev_id_map()
+
     # ---------- パケット処理 ----------
 
     def process(self, header, payload, on_capture):
@@ -153,11 +316,14 @@ class PacketSniffer:
         if data["dev_id"] not in self.dev_id_map:
             logging.info("Find IEEE addr for dev_id=0x%04X", data["dev_id"])
             self.dev_id_map[data["dev_id"]] = addr
-            self._store_dev_id_map()
+            self.device_index.pop(data["dev_id"], None)
+            self.unknown_tracker.resolve(data["dev_id"])
+            self._append_dev_id(data["dev_id"], addr)
         elif self.dev_id_map[data["dev_id"]] != addr:
             logging.info("Update IEEE addr for dev_id=0x%04X", data["dev_id"])
             self.dev_id_map[data["dev_id"]] = addr
-            self._store_dev_id_map()
+            self.device_index.pop(data["dev_id"], None)
+            self._append_dev_id(data["dev_id"], addr)
 
         if data["index"] == (len(self.ieee_addr_list) - 1):
             # NOTE: 次の周期に備えてリストをクリアする
@@ -167,64 +333,207 @@ class PacketSniffer:
     def _process_measure(self, header, payload, on_capture):
         try:
             logging.debug("Measure payload: %s", dump_packet(payload))
-            data = self.parse_packet_measure(header + payload)
+            data = self.decode_measure(payload)
             if data is not None:
                 on_capture(data)
         except Exception:
             logging.warning("Invalid packet: %s", dump_packet(header + payload))
 
     def parse_packet_measure(self, packet):
-        dev_id = struct.unpack("<H", packet[5:7])[0]
-        counter = packet[14]
-        cur_time = struct.unpack("<H", packet[19:21])[0]
-        cur_power = struct.unpack("<I", packet[26:30])[0]
-        pre_time = struct.unpack("<H", packet[35:37])[0]
-        pre_power = struct.unpack("<I", packet[42:46])[0]
-
-        if dev_id in self.dev_id_map:
-            addr = self.dev_id_map[dev_id]
-        else:
-            addr = "UNKNOWN"
-            logging.warning("dev_id = 0x%04X is unknown", dev_id)
-            logging.warning("dev_id_map = %s", json.dumps(self.dev_id_map, indent=4))
+        """ヘッダ付きの計測パケットを Measurement に復元する。"""
+        with memoryview(packet) as view:
+            return self.decode_measure(view[2:])
+
+    def decode_measure(self, payload):
+        """計測パケットのペイロードを Measurement に復元する。重複の場合は None。"""
+        dev_id, counter, cur_time, cur_power, pre_time, pre_power = MEASURE_STRUCT.unpack_from(payload)
+        self.measure_count += 1
+
+        device = self.resolve_device(dev_id)
+        is_known = device is not None
+        if not is_known:
+            device = DeviceEntry(ADDR_UNKNOWN, None, self._resolve_scale(ADDR_UNKNOWN))
 
         # NOTE: 同じデータが2回送られることがあるので、新しいデータ毎にインクリメント
-        # しているフィールドを使ってはじく
-        if self.counter_hist.get(dev_id) == counter:
+        # しているフィールドと時刻を使ってはじく。順序が入れ替わった再送も直近の窓で検出する
+        if self.dedupe.check(dev_id, counter, cur_time):
             logging.info("Packet duplication detected")
+            self.duplicate_count += 1
             return None
-        self.counter_hist[dev_id] = counter
+        self.dedupe.maybe_store()
 
         dif_time = cur_time - pre_time
         if dif_time < 0:
             dif_time += 0x10000
         if dif_time == 0:
             logging.info("Packet duplication detected")
+            self.duplicate_count += 1
             return None
 
+        if not is_known:
+            # NOTE: 警告は dev_id 毎に初回だけ出し、以降は件数の集計に留める (重複は数えない)
+            self.unknown_tracker.observe(dev_id)
+        self.frame_loss.update(dev_id, counter, cur_time, pre_time)
+
         dif_power = cur_power - pre_power
         if dif_power < 0:
             dif_power += 0x100000000
 
-        scale = self.scale_resolver(addr) if self.scale_resolver is not None else None
-        if scale is None:
-            scale = self.watt_scale
-
-        data = {
-            "addr": addr,
-            "dev_id": dev_id,
-            "dev_id_str": f"0x{dev_id:04X}",
-            "cur_time": cur_time,
-            "cur_power": cur_power,
-            "pre_time": pre_time,
-            "pre_power": pre_power,
-            "watt": round(float(dif_power) / dif_time * scale, 2),
-        }
+        energy_kwh = None
+        if is_known:
+            # NOTE: 未学習の間はカウンタも記録せず、学習後のパケットから数え始める
+            energy_kwh = self.energy.update(
+                dev_id, device.addr, counter, cur_time, cur_power, pre_time, pre_power, device.scale
+            )
+            self.energy.maybe_store()
+
+        data = Measurement(
+            device.addr,
+            dev_id,
+            cur_time,
+            cur_power,
+            pre_time,
+            pre_power,
+            round(float(dif_power) / dif_time * device.scale, 2),
+            device.name,
+            energy_kwh,
+        )
 
         logging.debug("Receive packet: %s", data)
 
         return data
 
+    def resolve_device(self, dev_id):
+        """dev_id に対応する DeviceEntry を返す。IEEE アドレスが未学習なら None。"""
+        registry = self.registry
+        if (registry is not None) and (registry.generation != self._index_generation):
+            # NOTE: device.yaml が読み込み直されたら、名前と倍率を引き直す
+            self.device_index.clear()
+            self._index_generation = registry.generation
+
+        device = self.device_index.get(dev_id)
+        if device is not None:
+            return device
+
+        addr = self.dev_id_map.get(dev_id)
+        if addr is None:
+            return None
+
+        device = DeviceEntry(
+            addr, registry.get_name(addr) if registry is not None else None, self._resolve_scale(addr)
+        )
+        # NOTE: レジストリが無い (scale_resolver だけの) 場合は世代で作り直せないので、毎回倍率を引き直す
+        if registry is not None:
+            self.device_index[dev_id] = device
+        return device
+
+    def flush_state(self):
+        """重複除去・積算電力量・未学習 dev_id の集計の状態を書き出す。終了時に呼ぶ。"""
+        self.dedupe.store()
+        self.energy.store()
+        self.unknown_tracker.flush()
+
+    def _resolve_scale(self, addr):
+        scale = self.scale_resolver(addr) if self.scale_resolver is not None else None
+        return self.watt_scale if scale is None else scale
+
+    def process_batch(self, frames):
+        """
+        (header, payload) の列をまとめて処理し、計測値を MeasureBatch (列指向) で返す。
+
+        オフラインの再処理やバックフィル向け。計測パケット (0x2C) はフィールドの取り出し・
+        時刻と積算電力の折り返し・カウンタによる重複除去・倍率の適用を NumPy でまとめて行い、
+        process() と同じ計測値を返す (watt の丸めは np.round による)。積算電力量も同じように数える。
+
+        NOTE: IEEE アドレス・dev_id 通知は出現順に process() で処理するが、計測値の
+        IEEE アドレスは、バッチ内の通知を全て反映した後の dev_id_map で引く。
+        """
+        import numpy as np
+
+        measure_list = []
+        for header, payload in frames:
+            if header[1] != PACKET_TYPE_MEASURE:
+                self.process(header, payload, None)
+            elif len(payload) == MEASURE_PAYLOAD_LEN:
+                measure_list.append(payload)
+                # NOTE: 通知の列の切れ目を process() と同じように判定できるよう、種別だけは記録する
+                self.last_packet_type = PACKET_TYPE_MEASURE
+            else:
+                logging.warning("Invalid packet: %s", dump_packet(header + payload))
+                self.last_packet_type = PACKET_TYPE_MEASURE
+
+        names, formats, offsets = zip(*MEASURE_FIELD_LIST, strict=True)
+        dtype = np.dtype(
+            {"names": names, "formats": formats, "offsets": offsets, "itemsize": MEASURE_PAYLOAD_LEN}
+        )
+        record = np.frombuffer(b"".join(measure_list), dtype=dtype)
+
+        dev_id = record["dev_id"]
+        duplicate = self.dedupe.check_batch(dev_id, record["counter"], record["cur_time"])
+        self.dedupe.maybe_store()
+
+        # NOTE: 16 ビットの時刻、32 ビットの積算電力は同じ幅の符号なし整数の引き算で折り返しを吸収する
+        dif_time = record["cur_time"] - record["pre_time"]
+        dif_power = record["cur_power"] - record["pre_power"]
+
+        valid = ~duplicate & (dif_time != 0)
+        duplicate_count = len(record) - int(np.count_nonzero(valid))
+        self.measure_count += len(record)
+        self.duplicate_count += duplicate_count
+        if duplicate_count != 0:
+            logging.info("Packet duplication detected (%d packet(s))", duplicate_count)
+
+        record = record[valid]
+        dev_id = dev_id[valid]
+        self.frame_loss.update_batch(dev_id, record["counter"], record["cur_time"], record["pre_time"])
+
+        # NOTE: IEEE アドレスと倍率の解決は、パケット毎ではなく dev_id 毎に 1 回だけ行う
+        unique_dev_id, dev_index, dev_count = np.unique(dev_id, return_inverse=True, return_counts=True)
+        addr_list, dev_addr_index, scale_list = self._resolve_batch_addr(
+            unique_dev_id.tolist(), dev_count.tolist()
+        )
+
+        addr_index = np.asarray(dev_addr_index, dtype=np.int32)[dev_index]
+        scale = np.asarray(scale_list, dtype=np.float64)[addr_index]
+
+        energy_kwh = np.full(len(record), np.nan)
+        known = np.asarray([addr != ADDR_UNKNOWN for addr in addr_list], dtype=bool)[addr_index]
+        energy_kwh[known] = self.energy.update_batch(
+            dev_id[known], addr_index[known], addr_list, record[known], scale[known]
+        )
+        self.energy.maybe_store()
+
+        return MeasureBatch(
+            addr_list,
+            addr_index,
+            dev_id,
+            record["cur_time"],
+            record["cur_power"],
+            record["pre_time"],
+            record["pre_power"],
+            np.round(dif_power[valid] / dif_time[valid] * scale, 2),
+            energy_kwh,
+        )
+
+    def _resolve_batch_addr(self, dev_id_list, count_list):
+        """dev_id の列に対して、(IEEE アドレスの列, 各 dev_id のアドレスの添字, アドレス毎の倍率) を返す。"""
+        addr_list = []
+        addr_index_map = {}
+        dev_addr_index = []
+        scale_list = []
+        for dev_id, count in zip(dev_id_list, count_list, strict=True):
+            device = self.resolve_device(dev_id)
+            if device is None:
+                device = DeviceEntry(ADDR_UNKNOWN, None, self._resolve_scale(ADDR_UNKNOWN))
+                self.unknown_tracker.observe(dev_id, count=count)
+            if device.addr not in addr_index_map:
+                addr_index_map[device.addr] = len(addr_list)
+                addr_list.append(device.addr)
+                scale_list.append(device.scale)
+            dev_addr_index.append(addr_index_map[device.addr])
+
+        return addr_list, dev_addr_index, scale_list
+
 
 def process_packet(handle, header, payload, on_capture):
     """
@@ -239,6 +548,7 @@ def process_packet(handle, header, payload, on_capture):
             handle["device"]["cache"],
             watt_scale=sensor_config.get("watt_scale", WATT_SCALE_DEFAULT),
             scale_resolver=sensor_config.get("scale_resolver"),
+            registry=sensor_config.get("registry"),
         )
         handle["_sniffer"] = sniffer
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+送信できなかった計測値をディスクに溜めておくスプール。
+
+Fluentd が止まっている間に送れなかった計測値を SQLite のキューに受信時刻付きで追記し、
+復旧後に古い順に少しずつ送り直す。追記・削除はまとまり (送信のバッチ) 毎にコミットするので、
+ロガーが異常終了しても溜めた分は失われない。件数が max_records を超えたら、古いものから捨てる。
+件数はスプールが大きくなっても遅くならないよう、起動時に数えた後はメモリ上で増減させる。
+"""
+
+import json
+import logging
+import pathlib
+import sqlite3
+import time
+
+MAX_RECORDS_DEFAULT = 500000
+# 送り直す速さの上限 (件/秒)
+REPLAY_RATE_DEFAULT = 100
+
+
+class Spool:
+    """(ラベル, 受信時刻, 計測値) を追記順に保持する、SQLite のキュー。"""
+
+    def __init__(self, path, max_records=MAX_RECORDS_DEFAULT):
+        """スプールのファイルを開きます。前回の残りがあればそのまま引き継ぎます。"""
+        self.path = pathlib.Path(path)
+        self.max_records = max_records
+        self.dropped = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE: 開くのは起動時だが、以降は送信スレッドだけが使う (depth / oldest は属性として読む)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                label TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                record TEXT NOT NULL
+            )
+        """)
+        # NOTE: 最も古い受信時刻を、全件を走査せずに引けるようにする
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_spool_timestamp ON spool (timestamp)")
+        self._conn.commit()
+
+        self.depth = self._conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        self.oldest = None
+        self._refresh_oldest()
+        if self.depth != 0:
+            logging.info("Load spool: %d record(s) since %s", self.depth, time.ctime(self.oldest))
+
+    def _refresh_oldest(self):
+        if self.depth == 0:
+            self.oldest = None
+            return
+        self.oldest = self._conn.execute("SELECT MIN(timestamp) FROM spool").fetchone()[0]
+
+    def age(self, now=None):
+        """最も古い計測値の受信からの経過秒数。空なら 0。"""
+        if self.oldest is None:
+            return 0
+        if now is None:
+            now = time.time()
+        return max(now - self.oldest, 0)
+
+    def push(self, batch):
+        """(ラベル, 受信時刻, 計測値) の列を末尾に追加する。"""
+        overflow = self.depth + len(batch) - self.max_records
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO spool (label, timestamp, record) VALUES (?, ?, ?)",
+                [(label, timestamp, json.dumps(record)) for label, timestamp, record in batch],
+            )
+            if overflow > 0:
+                # NOTE: 上限を超えたら、古いものから捨てる
+                self._conn.execute(
+                    "DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)", (overflow,)
+                )
+                self.dropped += overflow
+                logging.warning("Spool is full, drop %d oldest record(s)", overflow)
+        self.depth += len(batch) - max(overflow, 0)
+
+        if overflow > 0:
+            self._refresh_oldest()
+        elif batch:
+            # NOTE: 古いものが残っていれば、追記で最も古い受信時刻が変わるのは追記分の方が古い場合だけ
+            batch_oldest = min(timestamp for _, timestamp, _ in batch)
+            self.oldest = batch_oldest if self.oldest is None else min(self.oldest, batch_oldest)
+
+    def peek(self, limit):
+        """先頭から limit 件を [(id, ラベル, 受信時刻, 計測値)] で返す。取り出しはしない。"""
+        cursor = self._conn.execute(
+            "SELECT id, label, timestamp, record FROM spool ORDER BY id LIMIT ?", (limit,)
+        )
+        return [(row_id, label, timestamp, json.loads(record)) for row_id, label, timestamp, record in cursor]
+
+    def remove(self, last_id):
+        """送れたもの (peek で取り出した、id が last_id 以下のもの) を削除する。"""
+        with self._conn:
+            removed = self._conn.execute("DELETE FROM spool WHERE id <= ?", (last_id,)).rowcount
+        self.depth -= removed
+        self._refresh_oldest()
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+IEEE アドレスが未学習の dev_id を集計します。
+
+計測パケットの dev_id が dev_id_map に無い間は、パケット毎に警告を出す代わりに
+初回だけ警告し、以降は dev_id 毎の初回・最終受信時刻と受信数を数えて、一定間隔で
+まとめてログに出す。集計結果は WebUI から参照できるよう、JSON ファイルにも書き出す。
+起動時には前回の集計結果を読み込み、停止中に学習済みになった dev_id は外して書き直す。
+"""
+
+import json
+import logging
+import pathlib
+import time
+
+# 集計結果をログとファイルに出力する間隔 (秒)
+SUMMARY_INTERVAL_SEC = 600
+
+
+class UnknownDevice:
+    """未学習の dev_id 1 台分の受信状況。"""
+
+    __slots__ = ("count", "dev_id", "first_seen", "last_seen")
+
+    def __init__(self, dev_id, now):
+        """初回受信として初期化します。"""
+        self.dev_id = dev_id
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 0
+
+    @classmethod
+    def from_dict(cls, data):
+        device = cls(int(data["dev_id"], 16), data["first_seen"])
+        device.last_seen = data["last_seen"]
+        device.count = data["count"]
+        return device
+
+    def to_dict(self):
+        return {
+            "dev_id": f"0x{self.dev_id:04X}",
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "count": self.count,
+        }
+
+
+class UnknownDeviceTracker:
+    """未学習の dev_id 毎の受信状況を保持し、ログ出力を間引く。"""
+
+    def __init__(self, state_file=None, summary_sec=SUMMARY_INTERVAL_SEC):
+        """集計結果の書き出し先 (None なら書き出さない) と出力間隔を初期化します。"""
+        self.state_file = pathlib.Path(state_file) if state_file is not None else None
+        self.summary_sec = summary_sec
+        self.device_map = {}
+        self.last_summary = None
+        self._dirty = False
+
+        if self.state_file is not None:
+            self.load()
+
+    def load(self):
+        try:
+            device_list = [UnknownDevice.from_dict(data) for data in read_state(self.state_file)]
+        except Exception:
+            logging.exception("Failed to load unknown device list, starting fresh")
+            device_list = []
+            # NOTE: 読めないファイルは空の集計で上書きする
+            self._dirty = True
+
+        self.device_map = {device.dev_id: device for device in device_list}
+
+    def prune(self, dev_id_map):
+        """前回の集計結果のうち、dev_id_map で学習済みの dev_id を外して書き直す。"""
+        resolved_list = [dev_id for dev_id in self.device_map if dev_id in dev_id_map]
+        for dev_id in resolved_list:
+            del self.device_map[dev_id]
+        if resolved_list:
+            logging.info("Drop %d resolved dev_id(s) from unknown device list", len(resolved_list))
+            self._dirty = True
+        self.flush()
+
+    def observe(self, dev_id, now=None, count=1):
+        """未学習の dev_id の受信を count 件記録する。初めて見た dev_id なら True を返す。"""
+        if now is None:
+            now = time.time()
+
+        device = self.device_map.get(dev_id)
+        is_new = device is None
+        if is_new:
+            logging.warning("dev_id = 0x%04X is unknown (waiting for IEEE addr notification)", dev_id)
+            device = UnknownDevice(dev_id, now)
+            self.device_map[dev_id] = device
+
+        device.last_seen = now
+        device.count += count
+        self._dirty = True
+
+        if is_new:
+            self.flush()
+        self.maybe_summarize(now)
+
+        return is_new
+
+    def resolve(self, dev_id):
+        """dev_id の IEEE アドレスを学習したので、集計から外す。"""
+        device = self.device_map.pop(dev_id, None)
+        if device is None:
+            return
+
+        logging.info("dev_id = 0x%04X is resolved after %d packet(s)", dev_id, device.count)
+        self._dirty = True
+        self.flush()
+
+    def maybe_summarize(self, now=None):
+        """前回の出力から summary_sec 経っていれば、集計結果を出力する。"""
+        if now is None:
+            now = time.time()
+
+        if self.last_summary is None:
+            self.last_summary = now
+            return
+        if now - self.last_summary < self.summary_sec:
+            return
+        self.last_summary = now
+
+        if self.device_map:
+            logging.warning(
+                "Unknown dev_id(s): %s",
+                ", ".join(
+                    f"0x{dev_id:04X} ({device.count} packet(s))"
+                    for dev_id, device in sorted(self.device_map.items())
+                ),
+            )
+        self.flush()
+
+    def flush(self):
+        """前回の書き出し以降に変化があれば、集計結果をファイルに書き出す。"""
+        if (self.state_file is None) or not self._dirty:
+            return
+
+        try:
+            # NOTE: WebUI が読みかけのファイルを見ないよう、アトミックに書き込む
+            tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+            tmp_file.write_text(json.dumps(self.to_list(), indent=2))
+            tmp_file.replace(self.state_file)
+            self._dirty = False
+        except Exception:
+            logging.exception("Failed to store unknown device list: %s", self.state_file)
+
+    def to_list(self):
+        return [device.to_dict() for _dev_id, device in sorted(self.device_map.items())]
+
+
+def state_path(dev_cache_file):
+    """dev_id キャッシュに対応する、集計結果の書き出し先のパスを返す。"""
+    dev_cache_file = pathlib.Path(dev_cache_file)
+    return dev_cache_file.with_name(dev_cache_file.name + ".unknown")
+
+
+def read_state(state_file):
+    """UnknownDeviceTracker が書き出した集計結果を読み込む。無ければ空のリスト。"""
+    state_file = pathlib.Path(state_file)
+    if not state_file.exists():
+        return []
+
+    return json.loads(state_file.read_text())
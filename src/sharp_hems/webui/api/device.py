@@ -1,6 +1,7 @@
 """デバイス情報を返す Flask API。"""
 
 import logging
+import threading
 from pathlib import Path
 
 import flask
@@ -8,9 +9,33 @@ import my_lib.flask_util
 
 import sharp_hems.device
 import sharp_hems.sniffer
+import sharp_hems.unknown_device
 
 blueprint = flask.Blueprint("webapi-device", __name__)
 
+# NOTE: ファイルの mtime が変わるまでは、読み込み結果をメモリ上で使い回す
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _file_mtime(path):
+    path = Path(path)
+    return path.stat().st_mtime_ns if path.exists() else None
+
+
+def _load_cached(path_list, loader):
+    name = tuple(str(path) for path in path_list)
+    mtime = tuple(_file_mtime(path) for path in path_list)
+    with _cache_lock:
+        entry = _cache.get(name)
+        if (entry is not None) and (entry[0] == mtime):
+            return entry[1]
+
+    value = loader()
+    with _cache_lock:
+        _cache[name] = (mtime, value)
+    return value
+
 
 @blueprint.route("/api/devices/unknown", methods=["GET"])
 @my_lib.flask_util.support_jsonp
@@ -18,19 +43,29 @@ def devices_unknown():
     """
     観測されたが device.yaml に未登録のデバイスを返すAPI。
 
+    unmapped は、計測パケットは届いているが IEEE アドレスが未学習の dev_id
+    (wattmeter-logger の UnknownDeviceTracker の集計結果)。
+
     Returns:
         JSON: {
             "devices": [
                 {"dev_id": "0x1234", "addr": "00:12:4b:..."}
+            ],
+            "unmapped": [
+                {"dev_id": "0x5678", "first_seen": 1700000000.0, "last_seen": 1700000360.0, "count": 2}
             ]
         }
 
     """
     try:
         config = flask.current_app.config["CONFIG"]
+        dev_cache_file = Path(config["device"]["cache"])
 
-        dev_id_map, _ = sharp_hems.sniffer.read_dev_id_map(config["device"]["cache"])
-        sharp_hems.device.reload(Path(config["device"]["define"]))
+        sharp_hems.device.watch(Path(config["device"]["define"]))
+        dev_id_map = _load_cached(
+            [dev_cache_file, sharp_hems.sniffer.journal_path(dev_cache_file)],
+            lambda: sharp_hems.sniffer.read_dev_id_map(dev_cache_file)[0],
+        )
 
         unknown = [
             {"dev_id": f"0x{dev_id:04X}", "addr": addr.lower()}
@@ -38,7 +73,15 @@ def devices_unknown():
             if sharp_hems.device.get_name(addr) is None
         ]
 
-        return flask.jsonify({"devices": unknown})
+        state_file = sharp_hems.unknown_device.state_path(dev_cache_file)
+        # NOTE: ロガーが書き直す前でも、学習済みの dev_id は出さない
+        unmapped = [
+            device
+            for device in _load_cached([state_file], lambda: sharp_hems.unknown_device.read_state(state_file))
+            if int(device["dev_id"], 16) not in dev_id_map
+        ]
+
+        return flask.jsonify({"devices": unknown, "unmapped": unmapped})
 
     except Exception as e:
         logging.exception("Failed to get unknown devices")
@@ -48,9 +48,41 @@ def communication_errors():
                     "timestamp": 1234567890,
                     "error_type": "consecutive_failure"
                 }
+            ],
+            "transport": {
+                "received": 1234,
+                "lost": 2,
+                "loss_percent": 0.16
+            },
+            "frame": {
+                "received": 5678,
+                "lost": 12,
+                "loss_percent": 0.21,
+                "sensors": [{"name": "センサー名", "received": 240, "lost": 1, "loss_percent": 0.41}]
+            },
+            "spool": {
+                "depth": 120,
+                "age_sec": 360,
+                "depth_max": 4500,
+                "age_sec_max": 5400
+            },
+            "sinks": [
+                {
+                    "name": "Fluentd",
+                    "sent": 86400,
+                    "failed": 0,
+                    "dropped": 0,
+                    "backlog": 3,
+                    "latency_avg": 0.512,
+                    "latency_max": 2.1
+                }
             ]
         }
 
+        spool は送れずにディスクへ溜めた計測値の件数と最も古いものの経過秒数 (最新値と期間内の最大)、
+        sinks は送信先毎の送信数・失敗数・破棄数、最新のキューの深さ、受信から送信までの遅延 (秒)。
+        いずれも過去24時間の集計。
+
     """
     try:
         collector = _get_collector()
@@ -69,7 +101,26 @@ def communication_errors():
             jst_datetime = utc_datetime.astimezone(my_lib.time.get_zoneinfo())
             error["datetime"] = jst_datetime.strftime("%Y-%m-%d %H:%M:%S")
 
-        result = {"histogram": histogram, "latest_errors": latest_errors}
+        # サーバー → ロガー間の配信ロス (過去24時間)
+        transport = collector.get_transport_stats(hours=24)
+
+        # センサー → JH-AG01 間の無線区間のロス (過去24時間、カウンタの欠番から計数)
+        frame = collector.get_frame_stats(hours=24)
+
+        # Fluentd の障害中にディスクへ溜めた計測値 (過去24時間)
+        spool = collector.get_spool_stats(hours=24)
+
+        # 送信先毎の送信数・キューの深さ・遅延 (過去24時間)
+        sinks = collector.get_sink_stats(hours=24)
+
+        result = {
+            "histogram": histogram,
+            "latest_errors": latest_errors,
+            "transport": transport,
+            "frame": frame,
+            "spool": spool,
+            "sinks": sinks,
+        }
 
         return flask.jsonify(result)
 
@@ -104,7 +155,7 @@ def sensor_stat():
 
         # デバイス定義ファイルを読み込み
         device_define_file = Path(config["device"]["define"])
-        sharp_hems.device.reload(device_define_file)
+        sharp_hems.device.watch(device_define_file)
         sensor_names = sharp_hems.device.get_list()
 
         # メトリクス収集開始日を取得（日次サマリーと生データの古い方）
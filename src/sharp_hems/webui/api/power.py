@@ -54,7 +54,7 @@ def _get_context():
     )
     field = config["fluentd"]["data"]["field"]
 
-    sharp_hems.device.reload(Path(config["device"]["define"]))
+    sharp_hems.device.watch(Path(config["device"]["define"]))
     sensor_names = sharp_hems.device.get_list()
 
     return db_config, measure, field, sensor_names
@@ -3,12 +3,14 @@
 センサーのシリアル出力をダンプします。
 
 Usage:
-  sharp_hems_dump.py [-c CONFIG] [-s SERVER_HOST] [-p SERVER_PORT] [-o FILE] [-D]
+  sharp_hems_dump.py [-c CONFIG] [-s SERVER_HOST] [-p SERVER_PORT] [-P PROTOCOL] [-o FILE] [-D]
 
 Options:
   -c CONFIG         : 設定ファイルを指定します。 [default: config.yaml]
   -s SERVER_HOST    : サーバーのホスト名を指定します。 [default: localhost]
   -p SERVER_PORT    : ZeroMQ の Pub サーバーを動作させるポートを指定します。 [default: 4444]
+  -P PROTOCOL       : 受信形式 (binary / text) を指定します。旧形式のサーバーに接続する場合は text にします。
+                      [default: binary]
   -o FILE           : 出力ファイル名 [default: packet.dump]
   -D                : デバッグモードで動作します。
 """
@@ -42,9 +44,9 @@ def process_packet(handle, header, payload):
     logging.info("Receive %d packet(s)", packet_count)
 
 
-def start(handle, server_host, server_port, config):
+def start(handle, server_host, server_port, config, protocol=sharp_hems.serial_pubsub.PROTOCOL_BINARY):
     try:
-        sharp_hems.serial_pubsub.start_client(server_host, server_port, handle, process_packet)
+        sharp_hems.serial_pubsub.start_client(server_host, server_port, handle, process_packet, protocol)
     except Exception:
         sharp_hems.notify.error(config)
         raise
@@ -60,6 +62,7 @@ def main():
     config_file = args["-c"]
     server_host = os.environ.get("HEMS_SERVER_HOST", args["-s"])
     server_port = int(os.environ.get("HEMS_SERVER_PORT", args["-p"]))
+    protocol = os.environ.get("HEMS_PROTOCOL", args["-P"])
     dump_file = args["-o"]
     debug_mode = args["-D"]
 
@@ -69,7 +72,7 @@ def main():
 
     logging.info("Start HEMS dump (server: %s:%d, output: %s)", server_host, server_port, dump_file)
 
-    start({"dump_file": dump_file}, server_host, server_port, config)
+    start({"dump_file": dump_file}, server_host, server_port, config, protocol)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+JH-AG01 のシリアル出力を pty に流して、ハードウェア無しでサーバーを動かします。
+
+Usage:
+  sharp_hems_emulator.py [-n PLUGS] [-r SPEED] [-u DUP_RATE] [-e ERROR_RATE] [-T SEC] [-s SEED] [-D]
+  sharp_hems_emulator.py -B COUNT [-n PLUGS] [-u DUP_RATE] [-e ERROR_RATE] [-s SEED] [-D]
+
+Options:
+  -n PLUGS          : 仮想プラグの数を指定します。 [default: 10]
+  -r SPEED          : 実時間に対する速度の倍率を指定します。 [default: 1]
+  -u DUP_RATE       : 計測パケットを重複して送る確率を指定します。 [default: 0.05]
+  -e ERROR_RATE     : パケットにノイズ (ゴミ・途切れ・バイト化け) を混ぜる確率を指定します。 [default: 0.01]
+  -T SEC            : エミュレーション上の時間で SEC 秒分送ったら終了します。0 は制限なし。 [default: 0]
+  -s SEED           : 乱数のシードを指定します。
+  -B COUNT          : pty を使わず、COUNT イベント分のバイト列でフレーミングと解析の速度を計測します。
+  -D                : デバッグモードで動作します。
+"""
+
+import importlib.util
+import logging
+import os
+import pathlib
+import tempfile
+import time
+
+import sharp_hems.emulator
+import sharp_hems.serial_pubsub
+import sharp_hems.sniffer
+
+
+def _rate(count, sec):
+    # NOTE: 件数が少ないと計測時間が 0 になることがある
+    return count / sec if sec > 0 else 0.0
+
+
+def benchmark(emulator, count):
+    """フレーミング (SerialFramer) と解析 (PacketSniffer の逐次処理とバッチ処理) の速度を計測する。"""
+    data = emulator.generate(count)
+    logging.info("Generate %d byte(s) (packets: %d)", len(data), emulator.packet_count)
+
+    framer = sharp_hems.serial_pubsub.SerialFramer(sharp_hems.emulator.MemorySerial(data))
+    start = time.perf_counter()
+    packet_list = []
+    while (packet := framer.read_packet()) is not None:
+        packet_list.append(packet)
+    framer_sec = time.perf_counter() - start
+
+    logging.info(
+        "SerialFramer: %d packet(s) in %.3f sec (%.0f packets/sec, skipped: %d byte(s), short: %d)",
+        len(packet_list),
+        framer_sec,
+        _rate(len(packet_list), framer_sec),
+        framer.skip_bytes,
+        framer.short_count,
+    )
+
+    captured = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sniffer = sharp_hems.sniffer.PacketSniffer(pathlib.Path(tmp_dir) / "dev_id.json")
+        # NOTE: ノイズ由来の警告で計測がぶれないよう、解析中のログは抑える
+        logging.disable(logging.WARNING)
+        try:
+            start = time.perf_counter()
+            for header, payload in packet_list:
+                sniffer.process(header, payload, captured.append)
+            sniffer_sec = time.perf_counter() - start
+        finally:
+            logging.disable(logging.NOTSET)
+
+    logging.info(
+        "PacketSniffer: %d packet(s) in %.3f sec (%.0f packets/sec, captured: %d)",
+        len(packet_list),
+        sniffer_sec,
+        _rate(len(packet_list), sniffer_sec),
+        len(captured),
+    )
+
+    if importlib.util.find_spec("numpy") is None:
+        # NOTE: バッチ処理は NumPy (batch extra) が入っている場合だけ計測する
+        logging.info("PacketSniffer (batch): skipped (numpy is not installed, see the batch extra)")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sniffer = sharp_hems.sniffer.PacketSniffer(pathlib.Path(tmp_dir) / "dev_id.json")
+        logging.disable(logging.WARNING)
+        try:
+            start = time.perf_counter()
+            batch = sniffer.process_batch(packet_list)
+            batch_sec = time.perf_counter() - start
+        finally:
+            logging.disable(logging.NOTSET)
+
+    logging.info(
+        "PacketSniffer (batch): %d packet(s) in %.3f sec (%.0f packets/sec, captured: %d)",
+        len(packet_list),
+        batch_sec,
+        _rate(len(packet_list), batch_sec),
+        len(batch),
+    )
+
+
+def run(emulator, speed, duration_sec):
+    master_fd, slave_fd, slave_path = sharp_hems.emulator.open_pty()
+    logging.info("Serial port: %s (wattmeter-server -t %s)", slave_path, slave_path)
+
+    try:
+        emulator.run(master_fd, speed, duration_sec)
+    finally:
+        os.close(master_fd)
+        os.close(slave_fd)
+
+
+######################################################################
+def main():
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    plug_count = int(args["-n"])
+    speed = float(args["-r"])
+    duplicate_rate = float(args["-u"])
+    corrupt_rate = float(args["-e"])
+    duration_sec = int(args["-T"])
+    seed = None if args["-s"] is None else int(args["-s"])
+    bench_count = args["-B"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("hems.wattmeter-sharp", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    emulator = sharp_hems.emulator.Emulator(
+        plug_count, duplicate_rate=duplicate_rate, corrupt_rate=corrupt_rate, seed=seed
+    )
+
+    logging.info("Start JH-AG01 emulator (plugs: %d, speed: x%g)", plug_count, speed)
+
+    try:
+        if bench_count is not None:
+            benchmark(emulator, int(bench_count))
+        else:
+            run(emulator, speed, duration_sec if duration_sec != 0 else None)
+    except KeyboardInterrupt:
+        logging.info("Interrupted")
+
+
+if __name__ == "__main__":
+    main()
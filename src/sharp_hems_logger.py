@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
 """
-センサーから収集した消費電力データを Fluentd を使って送信します。
+センサーから収集した消費電力データを、設定した送信先 (Fluentd / InfluxDB / メトリクス DB) に送信します。
 
 Usage:
-  sharp_hems_logger.py [-c CONFIG] [-s SERVER_HOST] [-p SERVER_PORT] [-n COUNT] [-d] [-D]
-  sharp_hems_logger.py [-c CONFIG] --replay FILE [-n COUNT] [-D]
+  sharp_hems_logger.py [-c CONFIG] [-s SERVER_HOST] [-p SERVER_PORT] [-P PROTOCOL] [-i SOURCE]
+                       [-n COUNT] [-d] [-D]
+  sharp_hems_logger.py [-c CONFIG] --replay FILE [--replay-speed SPEED] [-n COUNT] [-D]
 
 Options:
   -c CONFIG         : 設定ファイルを指定します。 [default: config.yaml]
   -s SERVER_HOST    : サーバーのホスト名を指定します。 [default: localhost]
   -p SERVER_PORT    : ZeroMQ の Pub サーバーを動作させるポートを指定します。 [default: 4444]
+  -P PROTOCOL       : 受信形式 (binary / text) を指定します。旧形式のサーバーに接続する場合は text にします。
+                      [default: binary]
+  -i SOURCE         : 受信するコントローラーの番号 (サーバーの -t での順番、0 始まり) を指定します。
+                      省略時はすべてのコントローラーから受信します。
   -n COUNT          : n 回制御メッセージを受信したら終了します。0 は制限なし。 [default: 0]
   -d                : ダミーモードで動作します。
   --replay FILE     : packet.dump を再生して動作します (ハードウェア不要、ダミーモード固定)。
+  --replay-speed SPEED
+                    : 再生の速さ (realtime: 記録時の間隔、N / Nx: N 倍速、max: 待たない) を
+                      指定します。終了時に処理速度のレポートを出力します。 [default: max]
   -D                : デバッグモードで動作します。
 """
 
@@ -22,22 +30,28 @@ import pathlib
 import signal
 import sys
 
-import my_lib.fluentd_util
-import my_lib.footprint
-import my_lib.pretty
-
 import sharp_hems.config
 import sharp_hems.device
+import sharp_hems.fluentd_sink
+import sharp_hems.influxdb_sink
+import sharp_hems.liveness
+import sharp_hems.metrics_sink
 import sharp_hems.notify
 import sharp_hems.packet_dump
+import sharp_hems.packet_replay
+import sharp_hems.pipeline
 import sharp_hems.serial_pubsub
-import sharp_hems.sniffer
 import sharp_hems.watchdog
 from sharp_hems.metrics.collector import MetricsCollector
 
+# NOTE: 計測値を送る送信先 (liveness の更新に使う)
+MEASURE_SINK_LIST = ["fluentd", "influxdb"]
+
 # グローバル変数として保持（シグナルハンドラで使用）
 _metrics_collector = None
-_sender = None
+_sink_list = []
+_liveness = None
+_pipeline = None
 
 
 def env_flag(name):
@@ -48,76 +62,112 @@ def env_flag(name):
     return value.strip().lower() in ("1", "true", "yes", "on")
 
 
-def record_metrics(metrics_collector, data):
-    """メトリクス収集を記録する"""
-    try:
-        name = sharp_hems.device.get_name(data["addr"])
-        if name is not None:
-            metrics_collector.record_heartbeat(name)
-            logging.debug("Recorded metrics for %s", name)
+def init_metrics_collector(config):
+    if "metrics" not in config:
+        return None
 
-        # NOTE: 古いハートビートの日次サマリーへの畳み込み (1日1回)
-        metrics_collector.maybe_cleanup()
-    except Exception:
-        logging.exception("Failed to record metrics")
+    metrics_db_path = pathlib.Path(config["metrics"]["data"])
+    metrics_collector = MetricsCollector(
+        metrics_db_path, retention_days=config["metrics"].get("retention_days", 30)
+    )
+    logging.info("Initialize metrics collector (db: %s)", metrics_db_path)
 
+    return metrics_collector
 
-def fluent_send(handle, data):
-    try:
-        name = sharp_hems.device.get_name(data["addr"])
-
-        if name is None:
-            logging.warning("Unknown device: dev_id = %s", data["dev_id_str"])
-            return
-
-        send_data = {
-            "hostname": name,
-            handle["data"]["field"]: round(data["watt"]),
-        }
-
-        if my_lib.fluentd_util.send(handle["sender"], handle["data"]["label"], send_data):
-            logging.info("Send: %s", send_data)
-            my_lib.footprint.update(handle["liveness"])
-        else:
-            logging.error(handle["sender"].last_error)
-    except Exception:
-        sharp_hems.notify.error(handle["config"])
 
+def init_sink(name, config, metrics_collector, liveness):
+    if name == "fluentd":
+        logging.info(
+            "Initialize Fluentd sink (host: %s, tag: %s)",
+            config["fluentd"]["host"],
+            config["fluentd"]["data"]["tag"],
+        )
+        return sharp_hems.fluentd_sink.FluentdSink.from_config(config, liveness)
 
-def process_packet(handle, header, payload):
-    sharp_hems.device.reload(handle["device"]["define"])
+    if name == "influxdb":
+        logging.info(
+            "Initialize InfluxDB sink (url: %s, bucket: %s)",
+            config["influxdb"]["url"],
+            config["influxdb"]["bucket"],
+        )
+        return sharp_hems.influxdb_sink.InfluxDBSink.from_config(config, liveness)
+
+    if name == "metrics":
+        if metrics_collector is None:
+            logging.warning("Metrics sink requires metrics config, skip")
+            return None
+        # NOTE: ハートビートを記録した後で、同じスレッドで無応答を監視する
+        return sharp_hems.metrics_sink.MetricsSink(
+            metrics_collector, init_watchdog(config, metrics_collector), liveness=liveness
+        )
 
-    if handle["dummy_mode"]:
+    msg = f"Unknown sink: {name}"
+    raise ValueError(msg)
 
-        def on_data_received(data):
-            logging.info(my_lib.pretty.format(data))
-            handle["packet"]["count"] += 1
-            if (handle["packet"]["max"] != 0) and (handle["packet"]["count"] >= handle["packet"]["max"]):
-                sharp_hems.serial_pubsub.stop_client()
-    else:
 
-        def on_data_received(data):
-            # Fluentdに送信
-            fluent_send(handle, data)
-            # メトリクス収集も記録
-            if "metrics_collector" in handle:
-                record_metrics(handle["metrics_collector"], data)
-            # デバイスの無応答監視
-            if "watchdog" in handle:
-                handle["watchdog"].check()
+def init_sink_list(config, metrics_collector, liveness):
+    """
+    config.yaml の sink に書かれた送信先を作る。
+
+    省略時は Fluentd (influxdb.write があれば InfluxDB) とメトリクス DB。
+    送信先毎にキューと送信スレッドを持つので、受信スレッドや他の送信先を止めない。
+    liveness は計測値の送信先 (Fluentd / InfluxDB) が送り終えた時点で更新する。
+    計測値の送信先が無い場合 (sink: [metrics]) は、メトリクス DB に記録し終えた時点で更新する。
+    """
+    name_list = config.get("sink")
+    if name_list is None:
+        name_list = ["influxdb" if config["influxdb"].get("write") is not None else "fluentd", "metrics"]
+
+    # NOTE: 計測値の送信先があればメトリクス DB では更新しない (Fluentd 等が止まったのを隠さないように)
+    has_measure_sink = any(name in MEASURE_SINK_LIST for name in name_list)
+
+    sink_list = []
+    for name in name_list:
+        sink_liveness = None if (name == "metrics" and has_measure_sink) else liveness
+        sink = init_sink(name, config, metrics_collector, sink_liveness)
+        if sink is not None:
+            sink_list.append(sink)
+    return sink_list
+
+
+def init_watchdog(config, metrics_collector):
+    if metrics_collector is None:
+        return None
 
-    sharp_hems.sniffer.process_packet(handle, header, payload, on_data_received)
+    # デバイス無応答の監視 (Slack 通知)
+    alert_config = config.get("alert", {})
+    return sharp_hems.watchdog.DeviceWatchdog(
+        config,
+        metrics_collector,
+        timeout_min=alert_config.get("timeout_min", sharp_hems.watchdog.TIMEOUT_MIN_DEFAULT),
+    )
 
 
 def cleanup():
     """終了処理を実行します。"""
-    global _metrics_collector, _sender
+    global _metrics_collector, _sink_list  # noqa: PLW0603
 
     logging.info("Starting cleanup process...")
 
     sharp_hems.serial_pubsub.stop_client()
+    sharp_hems.device.stop_watch()
 
-    # メトリクスコレクターをクローズ
+    if _pipeline:
+        _pipeline.close()
+
+    if _liveness:
+        _liveness.stop()
+
+    # 送信先をクローズ (送信待ちの計測値は送り切ってから止める)
+    for sink in _sink_list:
+        try:
+            sink.close()
+            logging.info("Closed %s sink", sink.NAME)
+        except Exception:
+            logging.exception("Failed to close %s sink", sink.NAME)
+    _sink_list = []
+
+    # メトリクスコレクターをクローズ (MetricsSink が記録し終えてから)
     if _metrics_collector:
         try:
             _metrics_collector.close()
@@ -125,15 +175,6 @@ def cleanup():
         except Exception:
             logging.exception("Failed to close metrics collector")
 
-    # Fluentd senderをクローズ
-    if _sender:
-        try:
-            if hasattr(_sender, "close"):
-                _sender.close()
-                logging.info("Closed Fluentd sender")
-        except Exception:
-            logging.exception("Failed to close Fluentd sender")
-
     logging.info("Cleanup completed")
 
 
@@ -146,24 +187,33 @@ def sig_handler(num, frame):  # noqa: ARG001
         sys.exit(0)
 
 
-def replay(handle, replay_file):
-    """packet.dump を再生してパケット処理を実行する (F-8)。"""
+def replay(pipeline, replay_file, speed):
+    """packet.dump を再生してパケット処理を実行し、処理速度をレポートする (F-8)。"""
     packets = sharp_hems.packet_dump.load(replay_file)
-    logging.info("Replay %d packets from %s", len(packets), replay_file)
+    logging.info("Replay %d packets from %s (speed: %s)", len(packets), replay_file, speed or "max")
 
-    for _, header, payload in packets:
-        process_packet(handle, header, payload)
-        if (handle["packet"]["max"] != 0) and (handle["packet"]["count"] >= handle["packet"]["max"]):
-            break
+    report = sharp_hems.packet_replay.replay(pipeline, packets, speed)
 
-    logging.info("Replay finished (%d packets processed)", handle["packet"]["count"])
+    logging.info("Replay finished (%d packets processed)", pipeline.packet_count)
+    sharp_hems.packet_replay.log_report(report)
 
 
-def start(handle, server_host, server_port):
+def start(pipeline, server_host, server_port, protocol=sharp_hems.serial_pubsub.PROTOCOL_BINARY, source=None):
+    replay_config = pipeline.config.get("replay")
     try:
-        sharp_hems.serial_pubsub.start_client(server_host, server_port, handle, process_packet)
+        sharp_hems.serial_pubsub.start_client(
+            server_host,
+            server_port,
+            pipeline,
+            sharp_hems.pipeline.LoggerPipeline.process,
+            protocol,
+            source_list=[source] if source is not None else None,
+            stats=pipeline.stats,
+            packet_queue=pipeline.packet_queue,
+            replay_port=replay_config["port"] if replay_config is not None else None,
+        )
     except Exception:
-        sharp_hems.notify.error(handle["config"])
+        sharp_hems.notify.error(pipeline.config)
         raise
     finally:
         cleanup()
@@ -171,7 +221,7 @@ def start(handle, server_host, server_port):
 
 ######################################################################
 def main():
-    global _metrics_collector, _sender  # noqa: PLW0603
+    global _metrics_collector, _sink_list, _liveness, _pipeline  # noqa: PLW0603
 
     import docopt
     import my_lib.logger
@@ -181,8 +231,14 @@ def main():
     config_file = args["-c"]
     server_host = os.environ.get("HEMS_SERVER_HOST", args["-s"])
     server_port = int(os.environ.get("HEMS_SERVER_PORT", args["-p"]))
+    protocol = os.environ.get("HEMS_PROTOCOL", args["-P"])
+    source = os.environ.get("HEMS_SOURCE", args["-i"])
     count = int(args["-n"])
     replay_file = args["--replay"]
+    try:
+        replay_speed = sharp_hems.packet_replay.parse_speed(args["--replay-speed"])
+    except ValueError as e:
+        sys.exit(str(e))
     dummy_mode = env_flag("DUMMY_MODE")
     if dummy_mode is None:
         dummy_mode = args["-d"]
@@ -195,79 +251,46 @@ def main():
 
     config = sharp_hems.config.load(config_file)
 
-    dev_define_file = pathlib.Path(config["device"]["define"])
-    dev_cache_file = pathlib.Path(config["device"]["cache"])
-    liveness_file = pathlib.Path(config["liveness"]["file"]["measure"])
+    # NOTE: device.yaml の変更はバックグラウンドで反映し、パケット毎にはファイルを見ない
+    sharp_hems.device.watch(pathlib.Path(config["device"]["define"]))
+    liveness = sharp_hems.liveness.LivenessWriter(
+        pathlib.Path(config["liveness"]["file"]["measure"]),
+        config["liveness"].get("flush_sec", sharp_hems.liveness.FLUSH_SEC_DEFAULT),
+    )
 
     logging.info("Start HEMS logger (server: %s:%d)", server_host, server_port)
 
     if dummy_mode:
         logging.info("DUMMY MODE")
 
-    sender = None
-    if replay_file is None:
-        logging.info(
-            "Initialize Fluentd sender (host: %s, tag: %s)",
-            config["fluentd"]["host"],
-            config["fluentd"]["data"]["tag"],
-        )
-        sender = my_lib.fluentd_util.get_handle(
-            config["fluentd"]["data"]["tag"], host=config["fluentd"]["host"]
-        )
-        _sender = sender  # グローバル変数に保存（シグナルハンドラ用）
-
     # メトリクスコレクターを初期化
-    metrics_collector = None
-    if "metrics" in config:
-        metrics_db_path = pathlib.Path(config["metrics"]["data"])
-        metrics_collector = MetricsCollector(
-            metrics_db_path, retention_days=config["metrics"].get("retention_days", 30)
-        )
-        _metrics_collector = metrics_collector  # グローバル変数に保存（シグナルハンドラ用）
-        logging.info("Initialize metrics collector (db: %s)", metrics_db_path)
+    metrics_collector = init_metrics_collector(config)
+    _metrics_collector = metrics_collector  # グローバル変数に保存（シグナルハンドラ用）
+
+    # NOTE: ダミーモード (再生を含む) では送信しない
+    sink_list = [] if dummy_mode else init_sink_list(config, metrics_collector, liveness)
+    _sink_list = sink_list  # グローバル変数に保存（シグナルハンドラ用）
 
     # シグナルハンドラーを設定
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGINT, sig_handler)
 
-    handle = {
-        "config": config,
-        "sender": sender,
-        "device": {
-            "define": dev_define_file,
-            "cache": dev_cache_file,
-        },
-        "data": {
-            "label": config["fluentd"]["data"]["label"],
-            "field": config["fluentd"]["data"]["field"],
-        },
-        "sensor": {
-            "watt_scale": config.get("sensor", {}).get("watt_scale", sharp_hems.sniffer.WATT_SCALE_DEFAULT),
-            "scale_resolver": sharp_hems.device.get_scale,
-        },
-        "dummy_mode": dummy_mode,
-        "packet": {
-            "count": 0,
-            "max": count,
-        },
-        "liveness": liveness_file,
-    }
-
-    if metrics_collector:
-        handle["metrics_collector"] = metrics_collector
-
-        # デバイス無応答の監視 (Slack 通知)
-        alert_config = config.get("alert", {})
-        handle["watchdog"] = sharp_hems.watchdog.DeviceWatchdog(
-            config,
-            metrics_collector,
-            timeout_min=alert_config.get("timeout_min", sharp_hems.watchdog.TIMEOUT_MIN_DEFAULT),
-        )
+    pipeline = sharp_hems.pipeline.LoggerPipeline(
+        config,
+        sink_list=sink_list,
+        metrics_collector=metrics_collector,
+        dummy_mode=dummy_mode,
+        packet_max=count,
+    )
+    _pipeline = pipeline  # グローバル変数に保存（シグナルハンドラ用）
+
+    liveness.start()
+    _liveness = liveness  # グローバル変数に保存（シグナルハンドラ用）
 
     if replay_file is not None:
-        replay(handle, replay_file)
+        replay(pipeline, replay_file, replay_speed)
     else:
-        start(handle, server_host, server_port)
+        start(pipeline, server_host, server_port, protocol, None if source is None else int(source))
 
 
 if __name__ == "__main__":
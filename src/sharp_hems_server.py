@@ -3,12 +3,15 @@
 センサーからのパケットを Pub-Sub パターンで配信します。
 
 Usage:
-  sharp_hems_server.py [-c CONFIG] [-t SERIAL_PORT] [-p SERVER_PORT] [-D]
+  sharp_hems_server.py [-c CONFIG] [-t SERIAL_PORT] [-p SERVER_PORT] [-P PROTOCOL] [-E ENGINE] [-D]
 
 Options:
   -c CONFIG         : 設定ファイルを指定します。 [default: config.yaml]
-  -t SERIAL_PORT    : HEMS 中継器を接続するシリアルポートを指定します。 [default: /dev/ttyUSB0]
+  -t SERIAL_PORT    : HEMS 中継器を接続するシリアルポートを指定します (複数の場合はカンマ区切り)。
+                      [default: /dev/ttyUSB0]
   -p SERVER_PORT    : ZeroMQ の Pub サーバーを動作させるポートを指定します。 [default: 4444]
+  -P PROTOCOL       : 配信形式 (binary / text / compat) を指定します。 [default: compat]
+  -E ENGINE         : サーバーの実装 (thread / asyncio) を指定します。 [default: thread]
   -D                : デバッグモードで動作します。
 """
 
@@ -18,20 +21,49 @@ import pathlib
 import signal
 
 import sharp_hems.config
+import sharp_hems.liveness
 import sharp_hems.notify
+import sharp_hems.serial_async
 import sharp_hems.serial_pubsub
 
+ENGINE_THREAD = "thread"
+ENGINE_ASYNCIO = "asyncio"
+ENGINE_MAP = {
+    ENGINE_THREAD: sharp_hems.serial_pubsub,
+    ENGINE_ASYNCIO: sharp_hems.serial_async,
+}
+
 
 def sig_handler(num, frame):  # noqa: ARG001
     logging.warning("Receive signal %d", num)
 
     if num in (signal.SIGTERM, signal.SIGINT):
-        sharp_hems.serial_pubsub.stop_server()
-
+        for engine in ENGINE_MAP.values():
+            engine.stop_server()
+
+
+def start(  # noqa: PLR0913
+    serial_port,
+    server_port,
+    liveness_file,
+    config,
+    protocol=sharp_hems.serial_pubsub.PROTOCOL_COMPAT,
+    *,
+    engine=ENGINE_THREAD,
+):
+    if engine not in ENGINE_MAP:
+        msg = f"Unknown engine: {engine} (expected {'/'.join(ENGINE_MAP)})"
+        raise ValueError(msg)
 
-def start(serial_port, server_port, liveness_file, config):
     try:
-        sharp_hems.serial_pubsub.start_server(serial_port, server_port, liveness_file)
+        ENGINE_MAP[engine].start_server(
+            serial_port,
+            server_port,
+            liveness_file,
+            protocol,
+            replay_config=config.get("replay"),
+            liveness_flush_sec=config["liveness"].get("flush_sec", sharp_hems.liveness.FLUSH_SEC_DEFAULT),
+        )
     except Exception:
         sharp_hems.notify.error(config)
         raise
@@ -47,6 +79,8 @@ def main():
     config_file = args["-c"]
     serial_port = os.environ.get("HEMS_SERIAL_PORT", args["-t"])
     server_port = int(os.environ.get("HEMS_SERVER_PORT", args["-p"]))
+    protocol = os.environ.get("HEMS_PROTOCOL", args["-P"])
+    engine = os.environ.get("HEMS_SERVER_ENGINE", args["-E"])
     debug_mode = args["-D"]
 
     my_lib.logger.init("hems.wattmeter-sharp", level=logging.DEBUG if debug_mode else logging.INFO)
@@ -55,9 +89,15 @@ def main():
 
     liveness_file = pathlib.Path(config["liveness"]["file"]["measure"])
 
-    logging.info("Start server (serial: %s, port: %d)", serial_port, server_port)
+    logging.info(
+        "Start server (serial: %s, port: %d, protocol: %s, engine: %s)",
+        serial_port,
+        server_port,
+        protocol,
+        engine,
+    )
 
-    start(serial_port, server_port, liveness_file, config)
+    start(serial_port, server_port, liveness_file, config, protocol, engine=engine)
 
 
 if __name__ == "__main__":
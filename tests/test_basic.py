@@ -21,9 +21,9 @@ class MockZMQSocket:
         """Initialize with packet data."""
         self.packet_data = packet_data
         self.index = 0
+        self.seq = 0
 
-    def recv_string(self):
-        """packet.dumpからデータを読み出してZMQメッセージ形式で返す"""
+    def _next_packet(self):
         if self.index >= len(self.packet_data):
             # データが終わったら最初に戻る（無限ループテスト用）
             self.index = 0
@@ -31,11 +31,25 @@ class MockZMQSocket:
         timestamp, header, payload = self.packet_data[self.index]
         self.index += 1
 
+        return header, payload
+
+    def recv_string(self):
+        """packet.dumpからデータを読み出して旧形式 (テキスト) のZMQメッセージで返す"""
+        header, payload = self._next_packet()
+
         # ZMQメッセージ形式: "serial header_hex payload_hex"
         header_hex = header.hex()
         payload_hex = payload.hex()
         return f"serial {header_hex} {payload_hex}"
 
+    def recv_multipart(self):
+        """packet.dumpからデータを読み出してバイナリ形式のZMQメッセージで返す"""
+        import sharp_hems.serial_pubsub
+
+        # NOTE: 実際のサーバーと同様に通し番号を振る (同じ番号は処理済みとして捨てられる)
+        self.seq += 1
+        return sharp_hems.serial_pubsub.encode_binary(*self._next_packet(), seq=self.seq)
+
     def connect(self, address):
         """接続のモック（何もしない）"""
 
@@ -117,7 +131,7 @@ def mock_serial_server(dump_file_path="tests/data/packet.dump"):
                 def bind(self, address):
                     pass
 
-                def send_string(self, message):
+                def send_multipart(self, message):
                     received_messages.append(message)
                     logging.info("ZMQ sent: %s", message)
                     # すべてのパケットデータを処理したかチェック
@@ -342,6 +356,20 @@ def create_mock_serial_server(dump_file_path="tests/data/packet.dump", inject_du
     return MockSerial(packet_data, inject_dummy_data=inject_dummy_data)
 
 
+def assert_binary_message(message):
+    """バイナリ形式のZMQメッセージを検証して (header, payload) を返す"""
+    import sharp_hems.serial_pubsub
+
+    assert len(message) == 4, f"Invalid message format: {message}"
+    assert message[0].startswith(b"bin.serial"), f"Expected 'bin.serial' channel, got {message[0]}"
+
+    header, payload = sharp_hems.serial_pubsub.decode_binary(message)
+    assert header[0] == sharp_hems.serial_pubsub.SER_SYNC_BYTE
+    assert len(payload) == header[1] + 3
+
+    return header, payload
+
+
 @mock_serial_pubsub_client()
 def test_sniffer():
     """snifferモジュールのテスト"""
@@ -416,17 +444,9 @@ def test_serial_server(**kwargs):
     # 結果の確認
     assert len(received_messages) >= 3, f"Expected at least 3 messages, got {len(received_messages)}"
 
-    # メッセージの形式確認（"serial header_hex payload_hex"）
+    # メッセージの形式確認（[トピック, ヘッダ, ペイロード, メタデータ] のマルチパート）
     for message in received_messages:
-        parts = message.split(" ")
-        assert len(parts) == 3, f"Invalid message format: {message}"
-        assert parts[0] == "serial", f"Expected 'serial' channel, got {parts[0]}"
-        # ヘッダーとペイロードが16進文字列であることを確認
-        try:
-            bytes.fromhex(parts[1])  # header
-            bytes.fromhex(parts[2])  # payload
-        except ValueError:
-            pytest.fail(f"Invalid hex data in message: {message}")
+        assert_binary_message(message)
 
     logging.info("Successfully processed %d serial packets", len(received_messages))
 
@@ -452,7 +472,7 @@ def test_serial_server_with_dummy_data():
         def bind(self, address):
             pass
 
-        def send_string(self, message):
+        def send_multipart(self, message):
             received_messages.append(message)
             logging.info("ZMQ sent: %s", message)
             # 5つのメッセージを受信したらサーバーを停止
@@ -492,17 +512,9 @@ def test_serial_server_with_dummy_data():
     # 結果の確認
     assert len(received_messages) >= 3, f"Expected at least 3 messages, got {len(received_messages)}"
 
-    # メッセージの形式確認（"serial header_hex payload_hex"）
+    # メッセージの形式確認（[トピック, ヘッダ, ペイロード, メタデータ] のマルチパート）
     for message in received_messages:
-        parts = message.split(" ")
-        assert len(parts) == 3, f"Invalid message format: {message}"
-        assert parts[0] == "serial", f"Expected 'serial' channel, got {parts[0]}"
-        # ヘッダーとペイロードが16進文字列であることを確認
-        try:
-            bytes.fromhex(parts[1])  # header
-            bytes.fromhex(parts[2])  # payload
-        except ValueError:
-            pytest.fail(f"Invalid hex data in message: {message}")
+        assert_binary_message(message)
 
     logging.info("Successfully processed %d serial packets with dummy data injection", len(received_messages))
 
@@ -522,7 +534,7 @@ def config():
     return sharp_hems.config.load(CONFIG_FILE)
 
 
-def test_server_all_packets(server_port):  # noqa: C901
+def test_server_all_packets(server_port):
     """packet.dumpのすべてのデータを使ったサーバーテスト"""
     import sharp_hems.serial_pubsub
 
@@ -548,7 +560,7 @@ def test_server_all_packets(server_port):  # noqa: C901
         def bind(self, address):
             pass
 
-        def send_string(self, message):
+        def send_multipart(self, message):
             received_messages.append(message)
             logging.info("ZMQ sent: %s", message)
             # すべてのパケットデータを処理したかチェック
@@ -593,25 +605,449 @@ def test_server_all_packets(server_port):  # noqa: C901
 
     # すべてのメッセージの形式確認
     for i, message in enumerate(received_messages):
-        parts = message.split(" ")
-        assert len(parts) == 3, f"Invalid ZMQ message format at index {i}: {message}"
-        assert parts[0] == "serial", f"Expected 'serial' channel at index {i}, got {parts[0]}"
-        # ヘッダーとペイロードが16進文字列であることを確認
-        try:
-            header_bytes = bytes.fromhex(parts[1])  # header
-            payload_bytes = bytes.fromhex(parts[2])  # payload
+        header_bytes, payload_bytes = assert_binary_message(message)
+
+        # 元のpacket.dumpデータと比較
+        timestamp, original_header, original_payload = packet_data[i]
+        combined_original = original_header + original_payload
+        combined_received = header_bytes + payload_bytes
+
+        assert combined_received == combined_original, (
+            f"Message {i + 1} data mismatch: "
+            f"expected {combined_original.hex()}, got {combined_received.hex()}"
+        )
+
+    logging.info("Successfully tested all %d packets from dump file", len(received_messages))
+
+
+def test_serial_server_compat_protocol():
+    """互換モード (compat) ではバイナリと旧形式 (テキスト) の両方を配信すること"""
+    import sharp_hems.serial_pubsub
+
+    packet_data = load_packet_dump()
+    mock_serial = create_mock_serial_server()
+
+    binary_messages = []
+    text_messages = []
+
+    class MockZMQSocket:
+        def bind(self, address):
+            pass
+
+        def send_multipart(self, message):
+            binary_messages.append(message)
+
+        def send_string(self, message):
+            text_messages.append(message)
+            if len(text_messages) >= len(packet_data):
+                sharp_hems.serial_pubsub.stop_server()
+
+    class MockZMQContext:
+        def socket(self, socket_type):  # noqa: ARG002
+            return MockZMQSocket()
+
+    with (
+        mock.patch("sharp_hems.serial_pubsub.serial.Serial") as mock_serial_class,
+        mock.patch("sharp_hems.serial_pubsub.zmq.Context") as mock_zmq_context,
+    ):
+        mock_serial_class.return_value = mock_serial
+        mock_zmq_context.return_value = MockZMQContext()
+
+        sharp_hems.serial_pubsub.start_server(
+            "/dev/mock",
+            4444,
+            pathlib.Path("tests/evidence/test_liveness.txt"),
+            sharp_hems.serial_pubsub.PROTOCOL_COMPAT,
+        )
+
+    assert len(binary_messages) == len(text_messages) == len(packet_data)
+    for binary, text in zip(binary_messages, text_messages, strict=True):
+        assert text.startswith("serial ")
+        assert sharp_hems.serial_pubsub.decode_text(text) == assert_binary_message(binary)
+
+
+@mock_serial_pubsub_client()
+def test_client_text_protocol():
+    """旧形式 (テキスト) を配信するサーバーにも接続できること"""
+    import sharp_hems.serial_pubsub
+
+    packet_data = load_packet_dump()
+    processed_packets = []
+
+    def test_packet_handler(handle, header, payload):  # noqa: ARG001
+        processed_packets.append((header, payload))
+        if len(processed_packets) >= 3:
+            sharp_hems.serial_pubsub.stop_client()
+
+    sharp_hems.serial_pubsub.start_client(
+        "localhost", 4444, {}, test_packet_handler, sharp_hems.serial_pubsub.PROTOCOL_TEXT
+    )
+
+    assert processed_packets == [(header, payload) for _, header, payload in packet_data[:3]]
+
+
+def test_packet_queue():
+    from sharp_hems.serial_pubsub import PacketQueue
+
+    packet_queue = PacketQueue(maxsize=3)
+
+    assert [packet_queue.put(i) for i in range(5)] == [True, True, True, False, False]
+    assert (packet_queue.received, packet_queue.dropped) == (3, 2)
+    assert (packet_queue.depth, packet_queue.depth_max) == (3, 3)
+    assert packet_queue.take_dropped() == 2
+    assert packet_queue.take_dropped() == 0
+
+    assert packet_queue.get(timeout=0) == 0
+    assert (packet_queue.depth, packet_queue.processed) == (2, 1)
+
+
+@mock_serial_pubsub_client()
+def test_client_packet_queue():
+    """処理が遅くても受信は止めず、あふれた分はキューで捨てて数えること"""
+    import sharp_hems.serial_pubsub
+
+    packet_data = load_packet_dump()
+    packet_queue = sharp_hems.serial_pubsub.PacketQueue(maxsize=5)
+    processed_packets = []
+
+    def test_packet_handler(handle, header, payload):  # noqa: ARG001
+        time.sleep(0.01)  # NOTE: Fluentd への送信などで処理が詰まった状態
+        processed_packets.append((header, payload))
+        if len(processed_packets) >= 20:
+            sharp_hems.serial_pubsub.stop_client()
+
+    sharp_hems.serial_pubsub.start_client(
+        "localhost", 4444, {}, test_packet_handler, packet_queue=packet_queue
+    )
+
+    assert len(processed_packets) == packet_queue.processed == 20
+    assert packet_queue.dropped > 0
+    assert packet_queue.depth_max == 5
+    # 処理したパケットはキューに積んだ順で、処理済みの位置を覚えていること
+    assert processed_packets[:5] == [(header, payload) for _, header, payload in packet_data[:5]]
+    assert packet_queue.last_meta.seq is not None
+
+
+def test_client_packet_type_filter(server_port):
+    """パケット種別を指定すると、その種別のトピックだけを購読すること (実際の ZeroMQ を使用)"""
+    import zmq
+
+    import sharp_hems.serial_pubsub
+    import sharp_hems.sniffer
 
-            # 元のpacket.dumpデータと比較
-            timestamp, original_header, original_payload = packet_data[i]
-            combined_original = original_header + original_payload
-            combined_received = header_bytes + payload_bytes
+    packet_data = load_packet_dump()
+    received = []
 
-            assert combined_received == combined_original, (
-                f"Message {i + 1} data mismatch: "
-                f"expected {combined_original.hex()}, got {combined_received.hex()}"
+    def test_packet_handler(handle, header, payload):  # noqa: ARG001
+        received.append(header)
+        if len(received) >= 3:
+            sharp_hems.serial_pubsub.stop_client()
+
+    context = zmq.Context()
+    pub_socket = context.socket(zmq.PUB)
+    pub_socket.bind(f"tcp://127.0.0.1:{server_port}")
+
+    client_thread = threading.Thread(
+        target=sharp_hems.serial_pubsub.start_client,
+        args=("127.0.0.1", server_port, {}, test_packet_handler),
+        kwargs={"packet_type_list": [sharp_hems.sniffer.PACKET_TYPE_MEASURE]},
+        daemon=True,
+    )
+    client_thread.start()
+
+    # NOTE: SUB の接続完了を待たずに送ると捨てられるので、受信できるまで繰り返し送る
+    start_time = time.time()
+    seq = 0
+    while client_thread.is_alive() and time.time() - start_time < 10:
+        for _, header, payload in packet_data:
+            seq += 1
+            pub_socket.send_multipart(sharp_hems.serial_pubsub.encode_binary(header, payload, seq=seq))
+        time.sleep(0.05)
+
+    client_thread.join(timeout=5)
+    pub_socket.close(linger=0)
+    context.term()
+
+    assert len(received) >= 3
+    assert {header[1] for header in received} == {sharp_hems.sniffer.PACKET_TYPE_MEASURE}
+
+
+def test_replay_buffer_limits():
+    """再送バッファは件数と経過時間の両方で古いフレームを捨てること"""
+    from sharp_hems.serial_pubsub import ReplayBuffer
+
+    replay_buffer = ReplayBuffer(count=3, age_sec=60)
+    for seq in range(1, 6):
+        replay_buffer.append(seq, 1000.0 + seq, [f"frame{seq}".encode()])
+
+    # 件数の上限で古いものから捨てられる
+    assert replay_buffer.since(0, now=1010.0) == [[b"frame3"], [b"frame4"], [b"frame5"]]
+    assert replay_buffer.since(4, now=1010.0) == [[b"frame5"]]
+    # 保持期間を過ぎたものは返さない
+    assert replay_buffer.since(0, now=1064.5) == [[b"frame5"]]
+
+    # 追記時にも保持期間を過ぎたものは捨てられる
+    replay_buffer.append(6, 2000.0, [b"frame6"])
+    assert len(replay_buffer) == 1
+
+
+def test_client_replay(server_port):
+    """購読開始前に、受信位置より後のフレームを再送してもらえること (実際の ZeroMQ を使用)"""
+    import zmq
+
+    import sharp_hems.serial_pubsub
+
+    packet_data = load_packet_dump()
+    epoch = 1_800_000_000
+
+    replay_buffer = sharp_hems.serial_pubsub.ReplayBuffer()
+    now = time.time()
+    for seq, (_, header, payload) in enumerate(packet_data, start=1):
+        frames = sharp_hems.serial_pubsub.encode_binary(header, payload, epoch, seq, now)
+        replay_buffer.append(seq, now, frames)
+
+    sharp_hems.serial_pubsub.should_terminate_server.clear()
+    context = zmq.Context()
+    replay_thread = threading.Thread(
+        target=sharp_hems.serial_pubsub._serve_replay,  # noqa: SLF001
+        args=(context, server_port, replay_buffer, epoch),
+        daemon=True,
+    )
+    replay_thread.start()
+
+    try:
+        # 受信位置が同じ epoch の seq=4 なら、5 番目以降が再送される
+        frame_list = sharp_hems.serial_pubsub.request_replay(context, "127.0.0.1", server_port, epoch, 4)
+        assert [frames[1:3] for frames in frame_list] == [[h, p] for _, h, p in packet_data[4:]]
+
+        # 前回起動時の受信位置なら、保持している全フレームが再送される
+        frame_list = sharp_hems.serial_pubsub.request_replay(
+            context, "127.0.0.1", server_port, epoch - 100, 1000
+        )
+        assert len(frame_list) == len(packet_data)
+
+        # 再送されたフレームは受信位置に反映され、同じ通し番号の配信は重複として捨てられる
+        stats = sharp_hems.serial_pubsub.StreamStats()
+        stats.epoch = epoch
+        stats.last_seq = 10
+        replayed = list(
+            sharp_hems.serial_pubsub._replay(  # noqa: SLF001
+                context, "127.0.0.1", server_port, [sharp_hems.serial_pubsub.CH_BINARY], stats
             )
+        )
+        assert replayed == [(h, p) for _, h, p in packet_data[10:]]
+        assert stats.last_seq == len(packet_data)
+        assert stats.is_duplicate(sharp_hems.serial_pubsub.PacketMeta(2, epoch, len(packet_data)))
+    finally:
+        sharp_hems.serial_pubsub.stop_server()
+        replay_thread.join(timeout=5)
+        context.term()
 
-        except ValueError:
-            pytest.fail(f"Invalid hex data in message {i + 1}: {message}")
 
-    logging.info("Successfully tested all %d packets from dump file", len(received_messages))
+def test_stream_position_roundtrip(tmp_path):
+    from sharp_hems.serial_pubsub import PacketMeta, StreamStats
+
+    position_file = tmp_path / "stream.json"
+
+    stats = StreamStats()
+    stats.save_position(position_file)  # 未受信なら何も保存しない
+    assert not position_file.exists()
+
+    stats.update(PacketMeta(2, 123, 45))
+    stats.save_position(position_file)
+
+    restored = StreamStats()
+    restored.load_position(position_file)
+    assert (restored.epoch, restored.last_seq) == (123, 45)
+
+
+def test_liveness_writer(tmp_path):
+    """活動があった時だけ、まとめて liveness ファイルを更新すること"""
+    import sharp_hems.liveness
+
+    liveness_file = tmp_path / "healthz"
+    liveness = sharp_hems.liveness.LivenessWriter(liveness_file, flush_sec=0.05)
+
+    with mock.patch("sharp_hems.liveness.my_lib.footprint.update") as mock_update:
+        assert not liveness.flush()  # 活動が無ければ更新しない
+
+        for i in range(100):
+            liveness.touch(1000.0 + i)
+        assert mock_update.call_count == 0  # touch() ではファイルを書かない
+
+        assert liveness.flush()
+        assert not liveness.flush()
+        assert mock_update.call_count == 1
+
+        liveness.start()
+        liveness.touch()
+        time.sleep(0.2)
+        liveness.stop()
+        assert mock_update.call_count == 2
+        mock_update.assert_called_with(liveness_file)
+
+
+def test_device_registry_watch(tmp_path):
+    """device.yaml の変更をバックグラウンドで反映し、不正な内容なら直前の内容を使い続けること"""
+    import os
+
+    import sharp_hems.device
+
+    define_file = tmp_path / "device.yaml"
+    define_file.write_text('- addr: "00:12:4b:00:00:00:00:01"\n  name: plug-a\n')
+
+    registry = sharp_hems.device.DeviceRegistry()
+    try:
+        registry.watch(define_file, interval_sec=0.05)
+        assert registry.get_name("00:12:4B:00:00:00:00:01") == "plug-a"
+        generation = registry.generation
+
+        # NOTE: エディタと同様に rename で置き換える (mtime は明示的に変える)
+        tmp_file = tmp_path / "device.yaml.tmp"
+        tmp_file.write_text('- addr: "00:12:4b:00:00:00:00:01"\n  name: plug-b\n')
+        os.utime(tmp_file, (0, 1000))
+        tmp_file.replace(define_file)
+
+        deadline = time.time() + 5
+        while (registry.get_name("00:12:4b:00:00:00:00:01") != "plug-b") and (time.time() < deadline):
+            time.sleep(0.01)
+        assert registry.get_name("00:12:4b:00:00:00:00:01") == "plug-b"
+        assert registry.generation == generation + 1
+
+        define_file.write_text("- name: broken\n")
+        os.utime(define_file, (0, 2000))
+        time.sleep(0.2)
+        assert registry.get_name("00:12:4b:00:00:00:00:01") == "plug-b"
+    finally:
+        registry.stop_watch()
+
+
+def test_async_server(server_port, tmp_path):
+    """非同期版のサーバーが pty から読んだパケットを配信し、停止要求に即座に応じること"""
+    import os
+
+    import zmq
+
+    import sharp_hems.serial_async
+    import sharp_hems.serial_pubsub
+
+    packet_data = load_packet_dump()[:20]
+
+    master_fd, slave_fd = os.openpty()
+    slave_path = os.ttyname(slave_fd)
+
+    server_thread = threading.Thread(
+        target=sharp_hems.serial_async.start_server,
+        args=(slave_path, server_port, tmp_path / "healthz"),
+        daemon=True,
+    )
+
+    context = zmq.Context()
+    socket_sub = context.socket(zmq.SUB)
+    socket_sub.setsockopt(zmq.RCVTIMEO, 5000)
+    socket_sub.setsockopt_string(zmq.SUBSCRIBE, sharp_hems.serial_pubsub.CH_BINARY)
+    socket_sub.connect(f"tcp://127.0.0.1:{server_port}")
+
+    try:
+        server_thread.start()
+        time.sleep(0.5)  # NOTE: 購読の確立とシリアルの設定を待つ
+
+        # 先頭にゴミを混ぜても再同期できること
+        os.write(master_fd, b"\x00\x01" + b"".join(header + payload for _, header, payload in packet_data))
+
+        received = []
+        for seq in range(1, len(packet_data) + 1):
+            frames = socket_sub.recv_multipart()
+            assert sharp_hems.serial_pubsub.decode_meta(frames[3]).seq == seq
+            received.append(sharp_hems.serial_pubsub.decode_binary(frames))
+
+        assert received == [(header, payload) for _, header, payload in packet_data]
+    finally:
+        start = time.monotonic()
+        sharp_hems.serial_async.stop_server()
+        server_thread.join(timeout=5)
+        socket_sub.close(linger=0)
+        context.term()
+        os.close(master_fd)
+        os.close(slave_fd)
+
+    assert not server_thread.is_alive()
+    assert time.monotonic() - start < 1
+
+
+def test_async_server_stop_before_start(server_port, tmp_path):
+    """非同期版のサーバーを起動する前に停止要求が来ても、起動後すぐに止まること"""
+    import os
+
+    import sharp_hems.serial_async
+
+    master_fd, slave_fd = os.openpty()
+
+    sharp_hems.serial_async.stop_server()
+    server_thread = threading.Thread(
+        target=sharp_hems.serial_async.start_server,
+        args=(os.ttyname(slave_fd), server_port, tmp_path / "healthz"),
+        daemon=True,
+    )
+    try:
+        server_thread.start()
+        server_thread.join(timeout=5)
+    finally:
+        os.close(master_fd)
+        os.close(slave_fd)
+
+    assert not server_thread.is_alive()
+
+
+def test_server_multi_port(server_port, tmp_path):
+    """複数のシリアルポートを 1 つのサーバーで配信し、購読側で送信元を絞れること (実際の ZeroMQ を使用)"""
+    import os
+
+    import sharp_hems.serial_pubsub
+
+    packet_data = load_packet_dump()[:10]
+
+    pty_list = [os.openpty() for _ in range(2)]
+    server_thread = threading.Thread(
+        target=sharp_hems.serial_pubsub.start_server,
+        args=([os.ttyname(slave_fd) for _, slave_fd in pty_list], server_port, tmp_path / "healthz"),
+        daemon=True,
+    )
+
+    received = []
+
+    def test_packet_handler(handle, header, payload):  # noqa: ARG001
+        received.append((header, payload, stats.last_meta.source))
+        if len(received) >= len(packet_data):
+            sharp_hems.serial_pubsub.stop_client()
+
+    stats = sharp_hems.serial_pubsub.StreamStats()
+    client_thread = threading.Thread(
+        target=sharp_hems.serial_pubsub.start_client,
+        args=("127.0.0.1", server_port, {}, test_packet_handler),
+        kwargs={"source_list": [1], "stats": stats},
+        daemon=True,
+    )
+
+    try:
+        server_thread.start()
+        client_thread.start()
+        time.sleep(0.5)  # NOTE: 購読の確立とシリアルの設定を待つ
+
+        # 両方に流して、送信元 1 の分だけ受信すること
+        os.write(pty_list[0][0], b"".join(header + payload for _, header, payload in packet_data[:5]))
+        os.write(pty_list[1][0], b"".join(header + payload for _, header, payload in packet_data))
+
+        client_thread.join(timeout=5)
+        assert not client_thread.is_alive()
+    finally:
+        sharp_hems.serial_pubsub.stop_client()
+        sharp_hems.serial_pubsub.stop_server()
+        server_thread.join(timeout=10)
+        for master_fd, slave_fd in pty_list:
+            os.close(master_fd)
+            os.close(slave_fd)
+
+    assert received == [(header, payload, 1) for _, header, payload in packet_data]
+    # NOTE: 送信元を絞った購読では、通し番号の欠番をロスとして数えない
+    assert stats.lost == 0
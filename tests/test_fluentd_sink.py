@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# ruff: noqa: S101
+"""FluentdSink (PackedForward での非同期送信) の単体テスト"""
+
+import socket
+import threading
+import time
+from unittest import mock
+
+import msgpack
+import pytest
+
+from sharp_hems.fluentd_sink import FluentdSink
+from sharp_hems.spool import Spool
+
+
+class ForwardServer:
+    """受信した Forward メッセージを記録するだけの Fluentd の代わり"""
+
+    def __init__(self, port=0, *, ack=False):
+        """ポートを確保して受け付けを開始します。"""
+        self.ack = ack
+        self.message_list = []
+        self.server = socket.create_server(("127.0.0.1", port))
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        unpacker = msgpack.Unpacker(raw=False)
+        with conn:
+            while data := conn.recv(4096):
+                unpacker.feed(data)
+                for message in unpacker:
+                    self.message_list.append(message)
+                    if self.ack:
+                        conn.sendall(msgpack.packb({"ack": message[2]["chunk"]}))
+
+    def record_list(self):
+        record_list = []
+        for tag, entries, option in self.message_list:
+            unpacker = msgpack.Unpacker(raw=False)
+            unpacker.feed(entries)
+            entry_list = list(unpacker)
+            assert option["size"] == len(entry_list)
+            record_list.extend((tag, record) for _event_time, record in entry_list)
+        return record_list
+
+    def close(self):
+        self.server.close()
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def server():
+    server = ForwardServer()
+    yield server
+    server.close()
+
+
+def test_fluentd_sink_batch(server):
+    sink = FluentdSink("hems", "127.0.0.1", server.port, batch_size=10, flush_sec=0.2)
+
+    for i in range(25):
+        assert sink.emit("sharp", {"hostname": f"plug-{i}", "power": i})
+    assert wait_until(lambda: len(server.message_list) == 3)
+    sink.close()
+
+    # 件数で区切って PackedForward のメッセージにまとめ、順序を保って送ること
+    assert len(server.message_list) == 3
+    assert server.record_list() == [("hems.sharp", {"hostname": f"plug-{i}", "power": i}) for i in range(25)]
+
+
+def test_fluentd_sink_event_time(server):
+    sink = FluentdSink("hems", "127.0.0.1", server.port, flush_sec=0.1)
+    sink.emit("sharp", {"power": 1}, timestamp=1751900000.25)
+    sink.close()
+    assert wait_until(lambda: len(server.message_list) == 1)
+
+    _tag, entries, _option = server.message_list[0]
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(entries)
+    event_time, _record = next(unpacker)
+    # 受信時刻をナノ秒精度の EventTime で送ること
+    assert event_time == msgpack.ExtType(0, (1751900000).to_bytes(4, "big") + (250000000).to_bytes(4, "big"))
+
+
+def test_fluentd_sink_ack():
+    server = ForwardServer(ack=True)
+    sink = FluentdSink("hems", "127.0.0.1", server.port, flush_sec=0.1, require_ack=True)
+    sink.emit("sharp", {"power": 1})
+    sink.close()
+    server.close()
+
+    assert sink.sent == 1
+    assert sink.failed == 0
+
+
+def test_fluentd_sink_retry():
+    # まだ誰も待ち受けていないポート
+    with socket.create_server(("127.0.0.1", 0)) as probe:
+        port = probe.getsockname()[1]
+
+    sink = FluentdSink("hems", "127.0.0.1", port, flush_sec=0.1, retry_max=20, retry_sec=0.05)
+    sink.emit("sharp", {"power": 1})
+    assert wait_until(lambda: sink.last_error is not None)
+
+    # 再送の間に Fluentd が起動すれば、送り直せること
+    server = ForwardServer(port)
+
+    assert wait_until(lambda: sink.sent == 1)
+    assert sink.last_error is None
+    sink.close()
+    server.close()
+
+
+def test_fluentd_sink_liveness():
+    with socket.create_server(("127.0.0.1", 0)) as probe:
+        port = probe.getsockname()[1]
+
+    liveness = mock.Mock()
+    sink = FluentdSink(
+        "hems", "127.0.0.1", port, flush_sec=0.1, retry_max=20, retry_sec=0.05, liveness=liveness
+    )
+    sink.emit("sharp", {"power": 1})
+    assert wait_until(lambda: sink.last_error is not None)
+
+    # キューに積んだだけでは liveness を更新しない (Fluentd の停止で healthz が失敗する) こと
+    liveness.touch.assert_not_called()
+
+    # 送り終えたら更新すること
+    server = ForwardServer(port)
+    assert wait_until(lambda: sink.sent == 1)
+    liveness.touch.assert_called_once_with()
+    sink.close()
+    server.close()
+
+
+def test_fluentd_sink_unexpected_error(server):
+    sink = FluentdSink("hems", "127.0.0.1", server.port, flush_sec=0.05)
+    sink.emit("sharp", {"power": object()})
+    assert wait_until(lambda: sink.failed == 1)
+
+    # エンコードできない計測値は破棄するだけで、送信スレッドは止めないこと
+    sink.emit("sharp", {"power": 1})
+    assert wait_until(lambda: sink.sent == 1)
+    sink.close()
+
+
+def test_fluentd_sink_give_up():
+    with socket.create_server(("127.0.0.1", 0)) as probe:
+        port = probe.getsockname()[1]
+
+    sink = FluentdSink("hems", "127.0.0.1", port, flush_sec=0.1, retry_max=2, retry_sec=0.01)
+    sink.emit("sharp", {"power": 1})
+
+    # 再送回数の上限に達したら破棄すること
+    assert wait_until(lambda: sink.failed == 1)
+    sink.close()
+    assert sink.sent == 0
+
+
+def test_fluentd_sink_queue_full():
+    with socket.create_server(("127.0.0.1", 0)) as probe:
+        port = probe.getsockname()[1]
+
+    sink = FluentdSink("hems", "127.0.0.1", port, queue_size=1, flush_sec=0.1, retry_max=3, retry_sec=10)
+    # NOTE: 送信スレッドが 1 件目の再送を待っている間に、キューを埋める
+    assert sink.emit("sharp", {"power": 1})
+    assert wait_until(lambda: sink.last_error is not None)
+    assert sink.emit("sharp", {"power": 2})
+
+    # キューが一杯なら受信スレッドを待たせず、破棄して False を返すこと
+    assert not sink.emit("sharp", {"power": 3})
+    assert sink.dropped == 1
+    sink.close()
+
+
+def test_fluentd_sink_drain_on_close(server):
+    sink = FluentdSink("hems", "127.0.0.1", server.port, batch_size=1000, flush_sec=60)
+    for i in range(10):
+        sink.emit("sharp", {"power": i})
+
+    # flush_sec を待たずに、残っている計測値を送り切ってから止まること
+    start = time.monotonic()
+    sink.close()
+    assert time.monotonic() - start < 5
+    assert sink.sent == 10
+    assert not sink.emit("sharp", {"power": 10})
+
+
+def test_fluentd_sink_spool(tmp_path):
+    with socket.create_server(("127.0.0.1", 0)) as probe:
+        port = probe.getsockname()[1]
+
+    spool = Spool(tmp_path / "spool.db")
+    sink = FluentdSink(
+        "hems", "127.0.0.1", port, flush_sec=0.05, retry_max=1, retry_sec=0.01, spool=spool, replay_rate=4
+    )
+    for i in range(3):
+        sink.emit("sharp", {"power": i}, timestamp=1751900000.0 + i)
+    assert wait_until(lambda: sink.spooled == 3)
+
+    # 障害中に届いた分も、順序を保つためスプールに積むこと
+    sink.emit("sharp", {"power": 3}, timestamp=1751900003.0)
+    assert wait_until(lambda: sink.spooled == 4)
+    assert sink.failed == 0
+
+    # 復旧したら、古い順に受信時刻を保って送り直すこと
+    server = ForwardServer(port)
+    assert wait_until(lambda: sink.sent == 4, timeout=10)
+    sink.emit("sharp", {"power": 4}, timestamp=1751900004.0)
+    sink.close()
+    server.close()
+
+    assert [record["power"] for _tag, record in server.record_list()] == list(range(5))
+    event_time_list = []
+    for _tag, entries, _option in server.message_list:
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(entries)
+        event_time_list.extend(int.from_bytes(event_time.data[:4], "big") for event_time, _record in unpacker)
+    assert event_time_list == [1751900000 + i for i in range(5)]
+    assert spool.depth == 0
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# ruff: noqa: S101
+"""InfluxDBSink (line protocol での非同期書き込み) の単体テスト"""
+
+import gzip
+import http.server
+import threading
+import urllib.parse
+
+import pytest
+
+from sharp_hems.influxdb_sink import InfluxDBSink, format_line
+
+URL_TOKEN = "test-token"  # noqa: S105
+
+
+class WriteServer:
+    """受信した /api/v2/write の要求を記録するだけの InfluxDB の代わり"""
+
+    def __init__(self, status_list=()):
+        """ポートを確保して受け付けを開始します。status_list の順に応答し、尽きたら 204 を返します。"""
+        self.request_list = []
+        self.client_port_set = set()
+        self.status_list = list(status_list)
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # NOTE: 接続を使い回せるよう、HTTP/1.1 で応答する
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                server.client_port_set.add(self.client_address[1])
+                server.request_list.append(
+                    {
+                        "path": self.path,
+                        "header": dict(self.headers),
+                        "line_list": gzip.decompress(body).decode().split("\n"),
+                    }
+                )
+                status = server.status_list.pop(0) if server.status_list else 204
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *_args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def line_list(self):
+        return [line for request in self.request_list for line in request["line_list"]]
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = WriteServer()
+    yield server
+    server.close()
+
+
+def create_sink(url, **kwargs):
+    return InfluxDBSink(url, URL_TOKEN, "home", "sensor", "hems", **kwargs)
+
+
+def test_format_line():
+    line = format_line(
+        "hems.sharp", {"hostname": "冷蔵庫 1", "power": 50, "energy": 1.25, "memo": 'a"b'}, 1751900000.25
+    )
+    # タグ・フィールドの特殊文字をエスケープし、受信時刻をナノ秒で付けること
+    assert line == 'hems.sharp,hostname=冷蔵庫\\ 1 power=50i,energy=1.25,memo="a\\"b" 1751900000250000000'
+    # フィールドが無ければ書かない
+    assert format_line("hems.sharp", {"hostname": "冷蔵庫"}, 1751900000.0) is None
+
+
+def test_influxdb_sink_batch(server):
+    sink = create_sink(server.url, batch_size=10, flush_sec=0.2)
+    for i in range(25):
+        assert sink.emit_with_time("sharp", 1751900000 + i, {"hostname": f"plug-{i}", "power": i})
+    sink.close()
+
+    # 件数で区切って、1 つの接続で順に書き込むこと
+    assert len(server.request_list) == 3
+    assert len(server.client_port_set) == 1
+    assert server.line_list() == [
+        f"hems.sharp,hostname=plug-{i} power={i}i {(1751900000 + i) * 1000000000}" for i in range(25)
+    ]
+
+    request = server.request_list[0]
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(request["path"]).query)
+    assert urllib.parse.urlsplit(request["path"]).path == "/api/v2/write"
+    assert query == {"org": ["home"], "bucket": ["sensor"], "precision": ["ns"]}
+    assert request["header"]["Authorization"] == f"Token {URL_TOKEN}"
+    assert request["header"]["Content-Encoding"] == "gzip"
+    assert sink.sent == 25
+
+
+def test_influxdb_sink_retry():
+    server = WriteServer(status_list=[503, 503])
+    sink = create_sink(server.url, flush_sec=0.1, retry_max=5, retry_sec=0.01)
+    sink.emit("sharp", {"hostname": "plug-0", "power": 1})
+    sink.close()
+    server.close()
+
+    # 5xx は再送すること
+    assert len(server.request_list) == 3
+    assert sink.sent == 1
+    assert sink.failed == 0
+
+
+def test_influxdb_sink_rejected():
+    server = WriteServer(status_list=[400])
+    sink = create_sink(server.url, flush_sec=0.1, retry_max=5, retry_sec=0.01)
+    sink.emit("sharp", {"hostname": "plug-0", "power": 1})
+    sink.close()
+    server.close()
+
+    # 計測値が受け付けられない (400) なら、再送せずに破棄すること
+    assert len(server.request_list) == 1
+    assert sink.sent == 0
+    assert sink.failed == 1
+    assert "HTTP 400" in sink.last_error
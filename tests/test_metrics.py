@@ -3,10 +3,13 @@
 """MetricsCollector (スロット計算・受信率・retention) の単体テスト"""
 
 import datetime
+from unittest import mock
 
 import pytest
 
+from sharp_hems.batch_sink import SinkStats
 from sharp_hems.metrics.collector import SLOTS_PER_DAY, TIME_SLOT_SEC, MetricsCollector
+from sharp_hems.metrics_sink import MetricsSink
 
 SENSOR = "テストセンサー"
 
@@ -202,3 +205,149 @@ def test_histogram_counts_errors(collector):
 
     assert histogram["total_errors"] == 1
     assert sum(histogram["bins"]) == 1
+
+
+# ---------- 配信ロス ----------
+
+
+def test_transport_stats(collector):
+    import time as time_module
+
+    now = int(time_module.time())
+    collector.record_transport_stats(198, 2, timestamp=now - 600)
+    collector.record_transport_stats(100, 0, timestamp=now - 60)
+    # 集計期間外
+    collector.record_transport_stats(100, 50, timestamp=now - 2 * 86400)
+
+    stats = collector.get_transport_stats(hours=24)
+    assert stats == {"received": 298, "lost": 2, "loss_percent": pytest.approx(0.67)}
+
+
+def test_transport_stats_empty(collector):
+    assert collector.get_transport_stats() == {"received": 0, "lost": 0, "loss_percent": 0.0}
+
+
+# ---------- 無線区間のロス ----------
+
+
+def test_frame_stats(collector):
+    import time as time_module
+
+    now = int(time_module.time())
+    collector.record_frame_stats({"sensor_a": (9, 1), "sensor_b": (10, 0)}, timestamp=now - 600)
+    collector.record_frame_stats({"sensor_a": (10, 0)}, timestamp=now - 60)
+    # 集計期間外
+    collector.record_frame_stats({"sensor_b": (0, 10)}, timestamp=now - 2 * 86400)
+
+    stats = collector.get_frame_stats(hours=24)
+    assert (stats["received"], stats["lost"]) == (29, 1)
+    assert stats["sensors"] == [
+        {"name": "sensor_a", "received": 19, "lost": 1, "loss_percent": 5.0},
+        {"name": "sensor_b", "received": 10, "lost": 0, "loss_percent": 0.0},
+    ]
+
+
+# ---------- スプール ----------
+
+
+def test_spool_stats(collector):
+    import time as time_module
+
+    now = int(time_module.time())
+    collector.record_spool_stats(120, 600, timestamp=now - 600)
+    collector.record_spool_stats(0, 0, timestamp=now - 60)
+    # 集計期間外
+    collector.record_spool_stats(9999, 9999, timestamp=now - 2 * 86400)
+
+    stats = collector.get_spool_stats(hours=24)
+    assert stats == {"depth": 0, "age_sec": 0, "depth_max": 120, "age_sec_max": 600}
+
+
+def test_spool_stats_empty(collector):
+    assert collector.get_spool_stats() == {"depth": 0, "age_sec": 0, "depth_max": 0, "age_sec_max": 0}
+
+
+# ---------- 送信先 ----------
+
+
+def test_sink_stats(collector):
+    import time as time_module
+
+    now = int(time_module.time())
+    collector.record_sink_stats(
+        [SinkStats("Fluentd", 100, 0, 0, 5, 0.2, 1.0), SinkStats("Metrics", 100, 0, 0, 0, 1.0, 2.0)],
+        timestamp=now - 600,
+    )
+    collector.record_sink_stats([SinkStats("Fluentd", 300, 2, 1, 0, 0.6, 3.0)], timestamp=now - 60)
+    # 集計期間外
+    collector.record_sink_stats([SinkStats("Fluentd", 9999, 0, 0, 0, 9.0, 9.0)], timestamp=now - 2 * 86400)
+
+    assert collector.get_sink_stats(hours=24) == [
+        {
+            "name": "Fluentd",
+            "sent": 400,
+            "failed": 2,
+            "dropped": 1,
+            "backlog": 0,
+            "latency_avg": 0.5,
+            "latency_max": 3.0,
+        },
+        {
+            "name": "Metrics",
+            "sent": 100,
+            "failed": 0,
+            "dropped": 0,
+            "backlog": 0,
+            "latency_avg": 1.0,
+            "latency_max": 2.0,
+        },
+    ]
+
+
+def test_metrics_sink(collector):
+    import time as time_module
+
+    now = int(time_module.time())
+    watchdog = mock.Mock()
+    sink = MetricsSink(collector, watchdog, flush_sec=0.05)
+    sink.emit_with_time("sharp", now - 200, {"hostname": "sensor_a", "power": 10})
+    sink.emit_with_time("sharp", now - 100, {"hostname": "sensor_b", "power": 20})
+    sink.close()
+
+    # 受信時刻でハートビートを記録し、その後で無応答監視を行うこと
+    assert collector.get_latest_heartbeat("sensor_a") == now - 200
+    assert collector.get_latest_heartbeat("sensor_b") == now - 100
+    assert watchdog.check.call_count >= 1
+    assert sink.take_stats()[:5] == ("Metrics", 2, 0, 0, 0)
+
+
+def test_metrics_sink_unexpected_error(collector):
+    import time as time_module
+
+    now = int(time_module.time())
+    watchdog = mock.Mock()
+    watchdog.check.side_effect = [ValueError("broken"), None]
+    sink = MetricsSink(collector, watchdog, flush_sec=0.05, retry_sec=0.01)
+    sink.emit_with_time("sharp", now - 200, {"hostname": "sensor_a", "power": 10})
+    deadline = time_module.monotonic() + 5
+    while (sink.failed == 0) and (time_module.monotonic() < deadline):
+        time_module.sleep(0.01)
+
+    # 想定外の例外はその計測値を破棄するだけで、送信スレッドは止めないこと
+    assert sink.failed == 1
+    assert sink.emit_with_time("sharp", now - 100, {"hostname": "sensor_b", "power": 20})
+    sink.close()
+    assert sink.sent == 1
+    assert collector.get_latest_heartbeat("sensor_b") == now - 100
+
+
+def test_metrics_sink_liveness(collector):
+    import time as time_module
+
+    liveness = mock.Mock()
+    sink = MetricsSink(collector, flush_sec=0.05, liveness=liveness)
+    sink.emit_with_time("sharp", int(time_module.time()), {"hostname": "sensor_a", "power": 10})
+    sink.close()
+
+    # 記録し終えた時点で liveness を更新すること (sink: [metrics] の場合)
+    assert liveness.touch.call_count >= 1
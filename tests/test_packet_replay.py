@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# ruff: noqa: S101
+"""packet.dump の再生 (速さの指定と処理速度のレポート) の単体テスト"""
+
+from unittest import mock
+
+import pytest
+
+import sharp_hems.device
+import sharp_hems.packet_replay
+import sharp_hems.pipeline
+from sharp_hems.emulator import Emulator, MemorySerial
+from sharp_hems.serial_pubsub import SerialFramer
+
+PLUG_COUNT = 3
+
+
+@pytest.fixture
+def config(tmp_path):
+    emulator = Emulator(PLUG_COUNT, seed=1)
+    define_file = tmp_path / "device.yaml"
+    define_file.write_text(
+        "".join(f'- addr: "{plug.addr}"\n  name: plug-{i}\n' for i, plug in enumerate(emulator.plug_list))
+    )
+    sharp_hems.device.reload(define_file)
+
+    return {
+        "fluentd": {"host": "localhost", "data": {"tag": "hems", "label": "sharp", "field": "power"}},
+        "device": {"define": str(define_file), "cache": str(tmp_path / "dev_id.dat")},
+    }
+
+
+def dump_packets(emulator, measure_count):
+    # NOTE: packet_dump.load() と同じ (経過時間, ヘッダー, ペイロード) の列にする
+    framer = SerialFramer(MemorySerial(emulator.generate(1 + measure_count)))
+    packet_list = []
+    while (packet := framer.read_packet()) is not None:
+        packet_list.append((len(packet_list) * 0.5, *packet))
+    return packet_list
+
+
+def test_parse_speed():
+    assert sharp_hems.packet_replay.parse_speed("max") is None
+    assert sharp_hems.packet_replay.parse_speed("realtime") == 1.0
+    assert sharp_hems.packet_replay.parse_speed("4") == 4.0
+    assert sharp_hems.packet_replay.parse_speed("2.5x") == 2.5
+    assert sharp_hems.packet_replay.parse_speed("10×") == 10.0
+
+    for text in ["0", "-1x", "fast", ""]:
+        with pytest.raises(ValueError, match="Invalid replay speed"):
+            sharp_hems.packet_replay.parse_speed(text)
+
+
+def test_replay_pacing():
+    pipeline = mock.Mock(sniffer=mock.Mock(measure_count=0, duplicate_count=0))
+    pipeline.enable_profile.return_value = {}
+    pipeline.is_done.return_value = False
+    sleep = mock.Mock()
+
+    packet_list = [(10.0, b"h", b"p"), (11.0, b"h", b"p"), (12.0, b"h", b"p")]
+    report = sharp_hems.packet_replay.replay(pipeline, packet_list, speed=2.0, sleep=sleep)
+
+    # 記録時の間隔 (1 秒) を倍速で詰めて待つこと
+    assert pipeline.process.call_count == 3
+    assert [call.args[0] for call in sleep.call_args_list] == [
+        pytest.approx(0.5, abs=0.05),
+        pytest.approx(1.0, abs=0.05),
+    ]
+    assert report.dump_sec == 2.0
+    assert report.lag_max is not None
+
+    sleep.reset_mock()
+    report = sharp_hems.packet_replay.replay(pipeline, packet_list, sleep=sleep)
+
+    # max では待たないこと
+    sleep.assert_not_called()
+    assert report.lag_max is None
+
+
+def test_replay_report(config):
+    emulator = Emulator(PLUG_COUNT, duplicate_rate=0.3, corrupt_rate=0, seed=1)
+    packet_list = dump_packets(emulator, PLUG_COUNT * 10)
+    pipeline = sharp_hems.pipeline.LoggerPipeline(config, dummy_mode=True)
+
+    report = sharp_hems.packet_replay.replay(pipeline, packet_list)
+
+    assert report.packet_count == len(packet_list)
+    # 重複として捨てた数がエミュレーターで混ぜた数と一致すること
+    assert report.duplicate_count == emulator.duplicate_count
+    assert report.measure_count == PLUG_COUNT * 10 + emulator.duplicate_count
+    assert 0 < report.duplicate_ratio < 1
+    # 解析と各段の処理時間を分けて集計すること
+    assert list(report.stage_time) == ["decode", "log_dummy"]
+    assert all(sec >= 0 for sec in report.stage_time.values())
+    assert report.latency_p99 <= report.latency_max
+    assert report.latency_avg <= report.latency_max
+    assert report.packets_per_sec > 0
+
+
+def test_replay_packet_max(config):
+    packet_list = dump_packets(Emulator(PLUG_COUNT, duplicate_rate=0, corrupt_rate=0, seed=1), PLUG_COUNT * 2)
+    pipeline = sharp_hems.pipeline.LoggerPipeline(config, dummy_mode=True, packet_max=3)
+
+    report = sharp_hems.packet_replay.replay(pipeline, packet_list)
+
+    # -n の件数を処理したら止めること
+    assert pipeline.packet_count == 3
+    assert report.packet_count < len(packet_list)
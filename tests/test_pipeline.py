@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# ruff: noqa: S101
+"""LoggerPipeline (解析 → 名前解決 → 送信 → メトリクス → 無応答監視) の単体テスト"""
+
+from unittest import mock
+
+import pytest
+
+import sharp_hems.device
+import sharp_hems.pipeline
+import sharp_hems.spool
+from sharp_hems.batch_sink import SinkStats
+from sharp_hems.emulator import Emulator, MemorySerial
+from sharp_hems.metrics.collector import TIME_SLOT_SEC
+from sharp_hems.serial_pubsub import PacketMeta, SerialFramer
+
+PLUG_COUNT = 3
+
+
+@pytest.fixture
+def config(tmp_path):
+    emulator = Emulator(PLUG_COUNT, seed=1)
+    define_file = tmp_path / "device.yaml"
+    define_file.write_text(
+        "".join(f'- addr: "{plug.addr}"\n  name: plug-{i}\n' for i, plug in enumerate(emulator.plug_list))
+    )
+    sharp_hems.device.reload(define_file)
+
+    return {
+        "fluentd": {"host": "localhost", "data": {"tag": "hems", "label": "sharp", "field": "power"}},
+        "device": {"define": str(define_file), "cache": str(tmp_path / "dev_id.dat")},
+    }
+
+
+def read_packets(measure_count):
+    # NOTE: 先頭のイベントは IEEE アドレス・dev_id の通知
+    emulator = Emulator(PLUG_COUNT, duplicate_rate=0, corrupt_rate=0, seed=1)
+    framer = SerialFramer(MemorySerial(emulator.generate(1 + measure_count)))
+    packet_list = []
+    while (packet := framer.read_packet()) is not None:
+        packet_list.append(packet)
+    return packet_list
+
+
+def mock_sink(name="Mock", spool=None):
+    sink = mock.Mock(NAME=name, spool=spool)
+    sink.take_stats.return_value = SinkStats(name, 0, 0, 0, 0, 0.0, 0.0)
+    return sink
+
+
+def test_pipeline_stages(config):
+    sink_list = [mock_sink("Fluentd"), mock_sink("Metrics")]
+    pipeline = sharp_hems.pipeline.LoggerPipeline(config, sink_list=sink_list)
+
+    for header, payload in read_packets(PLUG_COUNT * 2):
+        pipeline.process(header, payload)
+
+    # 各送信先に計測値が順に渡されること
+    for sink in sink_list:
+        mock_send = sink.emit_with_time
+        assert mock_send.call_count == PLUG_COUNT * 2
+        assert {call.args[2]["hostname"] for call in mock_send.call_args_list} == {
+            f"plug-{i}" for i in range(PLUG_COUNT)
+        }
+        # 積算電力量も一緒に送ること
+        assert all(call.args[2]["energy"] >= 0 for call in mock_send.call_args_list)
+
+
+def test_pipeline_sink_isolation(config):
+    broken = mock_sink("Broken")
+    broken.emit_with_time.side_effect = RuntimeError("broken")
+    full = mock_sink("Full")
+    full.emit_with_time.return_value = False
+    sink = mock_sink()
+    pipeline = sharp_hems.pipeline.LoggerPipeline(config, sink_list=[broken, full, sink])
+
+    for header, payload in read_packets(PLUG_COUNT):
+        pipeline.process(header, payload)
+
+    # 1 つの送信先が失敗しても、他の送信先には計測値が届くこと
+    assert sink.emit_with_time.call_count == PLUG_COUNT
+
+
+def test_pipeline_sink_stats(config):
+    sink = mock_sink()
+    sink.take_stats.return_value = SinkStats("Mock", 10, 1, 2, 3, 0.25, 1.5)
+    metrics_collector = mock.Mock()
+    pipeline = sharp_hems.pipeline.LoggerPipeline(
+        config, sink_list=[sink], metrics_collector=metrics_collector
+    )
+    now = pipeline.last_record + TIME_SLOT_SEC
+
+    pipeline.update_transport(now)
+
+    # 送信先毎の送信数・キューの深さ・遅延を記録すること
+    metrics_collector.record_sink_stats.assert_called_once_with([sink.take_stats.return_value], int(now))
+
+
+def test_pipeline_receive_time(config):
+    sender = mock_sink()
+    pipeline = sharp_hems.pipeline.LoggerPipeline(config, sink_list=[sender])
+
+    packet_list = read_packets(PLUG_COUNT)
+    for i, (header, payload) in enumerate(packet_list):
+        pipeline.packet_queue.current_meta = PacketMeta(3, 1, i, 1751900000.5 + i)
+        pipeline.process(header, payload)
+
+    # サーバーでの受信時刻を、計測値の時刻として送ること
+    measure_list = [i for i, (header, _payload) in enumerate(packet_list) if header[1] == 0x2C]
+    assert [call.args[1] for call in sender.emit_with_time.call_args_list] == [
+        1751900000.5 + i for i in measure_list
+    ]
+
+
+def test_pipeline_frame_loss(config):
+    metrics_collector = mock.Mock()
+    pipeline = sharp_hems.pipeline.LoggerPipeline(
+        config, sink_list=[mock_sink()], metrics_collector=metrics_collector
+    )
+
+    packet_list = read_packets(PLUG_COUNT * 3)
+    # NOTE: 1 台目の 2 回目の計測パケットを、無線区間で失われたものとして間引く
+    measure_list = [i for i, (header, _payload) in enumerate(packet_list) if header[1] == 0x2C]
+    del packet_list[measure_list[PLUG_COUNT]]
+
+    for header, payload in packet_list:
+        pipeline.process(header, payload)
+    pipeline.update_transport(pipeline.last_record + TIME_SLOT_SEC)
+
+    frame_stats = metrics_collector.record_frame_stats.call_args.args[0]
+    assert sum(lost for _received, lost in frame_stats.values()) == 1
+    assert sum(received for received, _lost in frame_stats.values()) == PLUG_COUNT * 3 - 1
+
+
+def test_pipeline_spool_stats(config, tmp_path):
+    spool = sharp_hems.spool.Spool(tmp_path / "spool.db")
+    metrics_collector = mock.Mock()
+    pipeline = sharp_hems.pipeline.LoggerPipeline(
+        config, sink_list=[mock_sink(spool=spool)], metrics_collector=metrics_collector
+    )
+    now = pipeline.last_record + TIME_SLOT_SEC
+    spool.push([("sharp", now - 100, {"power": i}) for i in range(5)])
+
+    pipeline.update_transport(now)
+
+    # スプールの件数と、最も古い計測値の経過秒数を記録すること
+    metrics_collector.record_spool_stats.assert_called_once_with(5, 100, int(now))
+    spool.close()
+
+
+def test_pipeline_dummy_mode(config):
+    sender = mock_sink()
+    pipeline = sharp_hems.pipeline.LoggerPipeline(config, sink_list=[sender], dummy_mode=True, packet_max=2)
+
+    for header, payload in read_packets(PLUG_COUNT * 2):
+        pipeline.process(header, payload)
+        if pipeline.is_done():
+            break
+
+    # ダミーモードでは送信せず、指定した件数で止まること
+    assert sender.emit_with_time.call_count == 0
+    assert pipeline.packet_count == 2
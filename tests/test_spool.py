@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# ruff: noqa: S101
+"""Spool (送信できなかった計測値のディスクキュー) の単体テスト"""
+
+from sharp_hems.spool import Spool
+
+
+def test_spool_order(tmp_path):
+    spool = Spool(tmp_path / "spool.db")
+    spool.push([("sharp", 100.0 + i, {"power": i}) for i in range(5)])
+    spool.push([("sharp", 105.0, {"power": 5})])
+
+    assert spool.depth == 6
+    assert spool.age(now=110.0) == 10.0
+
+    # 追記した順に、受信時刻と一緒に取り出せること
+    row_list = spool.peek(3)
+    assert [(label, timestamp, record) for _, label, timestamp, record in row_list] == [
+        ("sharp", 100.0 + i, {"power": i}) for i in range(3)
+    ]
+
+    # 送れた分だけ削除できること
+    spool.remove(row_list[-1][0])
+    assert spool.depth == 3
+    assert spool.oldest == 103.0
+    assert [record["power"] for _, _, _, record in spool.peek(10)] == [3, 4, 5]
+    spool.close()
+
+
+def test_spool_max_records(tmp_path):
+    spool = Spool(tmp_path / "spool.db", max_records=4)
+    spool.push([("sharp", float(i), {"power": i}) for i in range(3)])
+    spool.push([("sharp", float(i), {"power": i}) for i in range(3, 6)])
+
+    # 上限を超えたら古いものから捨てること
+    assert spool.depth == 4
+    assert spool.dropped == 2
+    assert spool.oldest == 2.0
+    assert [record["power"] for _, _, _, record in spool.peek(10)] == [2, 3, 4, 5]
+    spool.close()
+
+
+def test_spool_reopen(tmp_path):
+    spool = Spool(tmp_path / "spool.db")
+    spool.push([("sharp", 100.0, {"power": 1})])
+    spool.close()
+
+    # 再起動後も、溜めた分を引き継ぐこと
+    spool = Spool(tmp_path / "spool.db")
+    assert spool.depth == 1
+    assert spool.oldest == 100.0
+    assert spool.peek(1)[0][1:] == ("sharp", 100.0, {"power": 1})
+    spool.close()
+
+
+def test_spool_no_count_scan(tmp_path):
+    spool = Spool(tmp_path / "spool.db")
+    statement_list = []
+    spool._conn.set_trace_callback(statement_list.append)  # noqa: SLF001
+
+    for i in range(3):
+        spool.push([("sharp", 100.0 + i, {"power": i})])
+    spool.remove(spool.peek(2)[-1][0])
+
+    # 件数は追記・削除の度に数え直さないこと (スプールが大きいほど遅くなるため)
+    assert not [statement for statement in statement_list if "COUNT(" in statement]
+    assert spool.depth == 1
+    assert spool.oldest == 102.0
+    spool.close()
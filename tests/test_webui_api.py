@@ -81,6 +81,10 @@ def test_communication_errors(client):
     data = response.get_json()
     assert len(data["histogram"]["bins"]) == 48
     assert "latest_errors" in data
+    assert data["transport"]["lost"] == 0
+    assert data["frame"]["sensors"] == []
+    assert data["spool"]["depth"] == 0
+    assert data["sinks"] == []
 
 
 def test_devices_unknown(client):
@@ -91,6 +95,8 @@ def test_devices_unknown(client):
     addrs = [d["addr"] for d in devices]
     assert UNKNOWN_ADDR in addrs
     assert KNOWN_ADDR not in addrs
+    # IEEE アドレス未学習の dev_id はまだ観測されていない
+    assert response.get_json()["unmapped"] == []
 
 
 def test_power_current(client, monkeypatch):